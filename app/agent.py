@@ -1,55 +1,74 @@
 # app/agent.py
 
-from typing import List, Optional, Union
-
-from app.config import ENABLE_RAG, HISTORY_LIMIT, RAG_TOP_K, RAG_MAX_CHARS
-from app.llm_client import ask_llm
-from app.memory.repository import get_or_create_user, get_last_messages, add_message
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime
+from typing import AsyncIterator, List, Optional, Union
+
+from app.answer_cache import CacheLookup, answer_cache
+from app.config import ENABLE_RAG, HISTORY_LIMIT, RAG_TOP_K
+from app.context import assemble_context
+from app.llm_client import ask_llm, ask_llm_stream
+from app.memory.repository import TurnContext, aload_turn, asave_turn
+from app.memory.summary import summarizer
+from app.memory.write_queue import write_queue
 from app.prompts import load_system_prompt, load_developer_prompt
-from app.rag.retriever import retrieve_documents
-
+from app.rag.retriever import aretrieve_documents
 
-def build_rag_block(docs) -> str:
-    if not docs:
-        return ""
 
-    parts = []
-    for i, doc in enumerate(docs, start=1):
-        title = (doc.title or "Документ").strip()
-        content = (doc.content or "").strip()
-        parts.append(f"[Источник {i}] {title}\n{content}")
+async def save_turn_messages(user_id: int, user_text: str, answer: str) -> None:
+    """
+    Вопрос + ответ: в write-behind очередь (если она запущена) или сразу одним коммитом.
+    """
+    if write_queue.running:
+        now = datetime.utcnow()
+        write_queue.put(user_id, "user", user_text, now)
+        write_queue.put(user_id, "assistant", answer, now)
+    else:
+        await asave_turn(user_id, user_text, answer)
 
-    block = "\n\n---\n\n".join(parts)
 
-    # ограничим размер, чтобы не раздувать контекст
-    if len(block) > RAG_MAX_CHARS:
-        block = block[:RAG_MAX_CHARS].rstrip() + "\n\n[...контекст обрезан...]"
+@dataclass
+class _PreparedTurn:
+    turn: TurnContext
+    messages: List[dict]  # промпт для LLM (пустой, если ответ взят из кэша)
+    cache: Optional[CacheLookup] = None  # поиск в кэше ответов, если он применялся
 
-    return block
+    @property
+    def cached_answer(self) -> Optional[str]:
+        return self.cache.answer if self.cache is not None else None
 
 
-async def run_ainova_agent(
+async def _prepare_turn(
     user_external_id: Union[int, str],
     username: Optional[str],
     user_text: str,
-    client_id: str = "default",
-    channel: str = "web",
-) -> str:
-    # 1) пользователь/память
-    user = get_or_create_user(
-        telegram_id=str(user_external_id),
+    client_id: str,
+    channel: str,
+) -> _PreparedTurn:
+    """
+    Всё, что нужно до запроса к LLM: пользователь, история, кэш ответов, RAG, сборка промпта.
+    """
+    # 1-2) пользователь + история — одна сессия БД (история — из кэша, если он тёплый)
+    turn = await aload_turn(
+        external_id=user_external_id,
         username=username,
+        limit=HISTORY_LIMIT,
+        pending=write_queue.snapshot(),
+        channel=channel,
     )
 
-    # 2) история
-    history_messages = get_last_messages(user_id=user.id, limit=HISTORY_LIMIT)
+    # 2.5) семантический кэш ответов (опционально): похожий вопрос этого же client_id
+    cache = await answer_cache.alookup(client_id, user_text) if answer_cache.applicable(turn) else None
+    if cache is not None and cache.answer is not None:
+        return _PreparedTurn(turn=turn, messages=[], cache=cache)
 
-    # 3) промпты
-    system_prompt = load_system_prompt()
-    developer_prompt = load_developer_prompt()
+    # 3) промпты (из памяти; свой набор, если есть data/prompts/clients/<client_id>/)
+    system_prompt = load_system_prompt(client_id)
+    developer_prompt = load_developer_prompt(client_id)
 
-    # 4) messages
-    messages: List[dict] = [
+    # 4) системная часть
+    system_messages: List[dict] = [
         {"role": "system", "content": system_prompt},
         {"role": "system", "content": developer_prompt},
         {
@@ -58,31 +77,84 @@ async def run_ainova_agent(
         },
     ]
 
-    for msg in history_messages:
-        messages.append({"role": msg.role, "content": msg.content})
-
-    # 5) RAG
+    # 5) RAG: кандидаты по релевантности, сколько войдёт — решает бюджет токенов
+    #    (эмбеддинг вопроса уже посчитан, если заглядывали в кэш ответов)
+    rag_docs = []
     if ENABLE_RAG:
-        rag_docs = retrieve_documents(user_text, top_k=RAG_TOP_K)
-        rag_block = build_rag_block(rag_docs)
-        if rag_block:
-            messages.append({
-                "role": "system",
-                "content": (
-                    "Ниже справочная информация из базы знаний. Используй её как опору для фактов. "
-                    "Если в базе нет ответа — уточни или предложи следующий шаг.\n\n"
-                    f"{rag_block}"
-                ),
-            })
-
-    # 6) user message
-    messages.append({"role": "user", "content": user_text})
-
-    # 7) LLM
-    answer = await ask_llm(messages)
+        rag_docs = await aretrieve_documents(
+            user_text,
+            top_k=RAG_TOP_K,
+            query_emb=cache.embedding if cache is not None else None,
+        )
+
+    # 6) промпт: пересказ + история + база знаний + вопрос в пределах CONTEXT_TOKEN_BUDGET
+    context = assemble_context(
+        system_messages,
+        {"role": "user", "content": user_text},
+        turn.history,
+        summary=turn.summary,
+        summary_until=turn.summary_until,
+        docs=rag_docs,
+    )
+    return _PreparedTurn(turn=turn, messages=context.messages, cache=cache)
+
+
+async def _finish_turn(prepared: _PreparedTurn, user_text: str, answer: str, complete: bool = True) -> None:
+    await save_turn_messages(prepared.turn.user_id, user_text, answer)
+    # пересказ обновляется в фоне, ответ его не ждёт
+    summarizer.schedule(prepared.turn.user_id)
+    if complete and prepared.cache is not None:
+        answer_cache.store(prepared.cache, answer)
+
+
+async def run_ainova_agent(
+    user_external_id: Union[int, str],
+    username: Optional[str],
+    user_text: str,
+    client_id: str = "default",
+    channel: str = "web",
+) -> str:
+    prepared = await _prepare_turn(user_external_id, username, user_text, client_id, channel)
+
+    # 7) LLM (или готовый ответ из кэша)
+    answer = prepared.cached_answer
+    if answer is None:
+        answer = await ask_llm(prepared.messages)
 
     # 8) save memory
-    add_message(user_id=user.id, role="user", content=user_text)
-    add_message(user_id=user.id, role="assistant", content=answer)
+    await _finish_turn(prepared, user_text, answer)
 
     return answer
+
+
+async def run_ainova_agent_stream(
+    user_external_id: Union[int, str],
+    username: Optional[str],
+    user_text: str,
+    client_id: str = "default",
+    channel: str = "web",
+) -> AsyncIterator[str]:
+    """
+    То же, что run_ainova_agent, но ответ отдаётся кусками по мере генерации.
+    В память ход пишется после окончания потока. Если поток оборвался (клиент ушёл,
+    ошибка LLM посреди ответа) — сохраняем то, что пользователь успел увидеть.
+    """
+    prepared = await _prepare_turn(user_external_id, username, user_text, client_id, channel)
+
+    if prepared.cached_answer is not None:
+        yield prepared.cached_answer
+        await _finish_turn(prepared, user_text, prepared.cached_answer)
+        return
+
+    parts: List[str] = []
+    complete = False
+    try:
+        async for delta in ask_llm_stream(prepared.messages):
+            parts.append(delta)
+            yield delta
+        complete = True
+    finally:
+        answer = "".join(parts)
+        if answer:
+            # shield: при отмене задачи (обрыв соединения) запись всё равно доходит до конца
+            await asyncio.shield(_finish_turn(prepared, user_text, answer, complete))
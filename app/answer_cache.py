@@ -0,0 +1,242 @@
+# app/answer_cache.py
+
+"""
+Семантический кэш ответов (опционально, ANSWER_CACHE_ENABLED).
+
+Во входящих много почти одинаковых вопросов («сколько стоит?», «какие у вас услуги»).
+Если новый вопрос по эмбеддингу достаточно похож (косинус >= ANSWER_CACHE_THRESHOLD)
+на уже отвеченный — отдаём сохранённый ответ без запроса к LLM.
+
+- Эмбеддинг вопроса тот же, что считает RAG (и кэширует query_cache), — лишних запросов нет.
+- Кэш у каждого client_id свой: ответ одного клиента другому не отдаётся никогда.
+- Ответ зависит от базы знаний и промптов: кэш клиента сбрасывается, как только
+  меняется версия индекса документов или fingerprint промптов клиента.
+- Ответ зависит и от истории диалога, поэтому по умолчанию (ANSWER_CACHE_SCOPE=first)
+  кэш работает только для вопросов без предыстории — первый вопрос нового диалога.
+  Именно там повторы чаще всего. ANSWER_CACHE_SCOPE=all — для любых вопросов.
+- TTL записи — ANSWER_CACHE_TTL; на клиента — не больше ANSWER_CACHE_MAX_ENTRIES записей
+  (вытесняются самые старые), клиентов — не больше ANSWER_CACHE_MAX_CLIENTS (LRU).
+
+Кэш в памяти процесса: у каждого воркера свой.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.config import (
+    ANSWER_CACHE_ENABLED,
+    ANSWER_CACHE_THRESHOLD,
+    ANSWER_CACHE_TTL,
+    ANSWER_CACHE_SCOPE,
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_MAX_CLIENTS,
+)
+from app.llm_client import LLM_ERROR_ANSWER
+from app.memory.db import run_in_db_thread
+from app.prompts import prompt_fingerprint
+from app.rag.embedding_cache import normalize_query
+from app.rag.embeddings import aget_embedding
+from app.rag.retriever import index_version
+
+
+@dataclass
+class CacheLookup:
+    """
+    Результат поиска в кэше. При промахе по нему же потом сохраняем ответ (store).
+    """
+    client_id: str
+    question: str
+    embedding: list
+    version: tuple
+    answer: Optional[str] = None
+    score: float = 0.0
+
+
+class _ClientCache:
+    """
+    Записи одного client_id: матрица нормированных эмбеддингов (растёт удвоением до max_entries),
+    дальше — кольцо, новые записи затирают самые старые.
+    """
+
+    def __init__(self, version: tuple, max_entries: int):
+        self.version = version
+        self.max_entries = max_entries
+        self.matrix: Optional[np.ndarray] = None
+        self.questions: List[str] = []
+        self.answers: List[str] = []
+        self.created: List[float] = []
+        self.next_pos = 0
+
+    def __len__(self) -> int:
+        return len(self.answers)
+
+    def add(self, vector: np.ndarray, question: str, answer: str, now: float) -> None:
+        n = len(self.answers)
+        if self.matrix is None:
+            self.matrix = np.empty((min(16, self.max_entries), vector.shape[0]), dtype=np.float32)
+        elif self.matrix.shape[1] != vector.shape[0]:
+            return  # сменилась модель эмбеддингов — новые записи сюда не подходят
+
+        if n < self.max_entries:
+            if n == self.matrix.shape[0]:
+                grown = np.empty((min(n * 2, self.max_entries), self.matrix.shape[1]), dtype=np.float32)
+                grown[:n] = self.matrix
+                self.matrix = grown
+            pos = n
+            self.questions.append(question)
+            self.answers.append(answer)
+            self.created.append(now)
+        else:
+            pos = self.next_pos
+            self.next_pos = (self.next_pos + 1) % self.max_entries
+            self.questions[pos] = question
+            self.answers[pos] = answer
+            self.created[pos] = now
+        self.matrix[pos] = vector
+
+    def best(self, vector: np.ndarray, question: str, now: float, ttl: float) -> Tuple[Optional[int], float]:
+        n = len(self.answers)
+        if n == 0 or self.matrix.shape[1] != vector.shape[0]:
+            return None, 0.0
+        scores = self.matrix[:n] @ vector
+        if ttl > 0:
+            expired = now - np.asarray(self.created) > ttl
+            scores[expired] = -np.inf
+        # тот же вопрос слово в слово — попадание независимо от порога
+        for i, q in enumerate(self.questions):
+            if q == question and np.isfinite(scores[i]):
+                return i, 1.0
+        pos = int(np.argmax(scores))
+        return pos, float(scores[pos])
+
+
+def _normalize(embedding: list) -> Optional[np.ndarray]:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm == 0.0:
+        return None
+    return vector / norm
+
+
+class AnswerCache:
+    def __init__(
+        self,
+        enabled: bool = False,
+        threshold: float = 0.95,
+        ttl: float = 3600.0,
+        scope: str = "first",
+        max_entries: int = 1000,
+        max_clients: int = 100,
+    ):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.ttl = ttl
+        self.scope = scope
+        self.max_entries = max(1, max_entries)
+        self.max_clients = max(1, max_clients)
+
+        self._clients: "OrderedDict[str, _ClientCache]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.hits = 0
+        self.stores = 0
+        self.invalidations = 0
+        self.errors = 0
+
+    def applicable(self, turn) -> bool:
+        """
+        Можно ли для этого хода брать/класть ответ в кэш (см. ANSWER_CACHE_SCOPE).
+        """
+        if not self.enabled:
+            return False
+        if self.scope == "all":
+            return True
+        return not turn.history and not turn.summary
+
+    def _client(self, client_id: str, version: tuple) -> _ClientCache:
+        cache = self._clients.get(client_id)
+        if cache is not None and cache.version != version:
+            # переиндексировали документы или поменяли промпты — старые ответы не годятся
+            self.invalidations += 1
+            cache = None
+        if cache is None:
+            cache = _ClientCache(version, self.max_entries)
+            self._clients[client_id] = cache
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        self._clients.move_to_end(client_id)
+        return cache
+
+    def lookup(self, client_id: str, question: str, embedding: list, version: tuple) -> CacheLookup:
+        result = CacheLookup(client_id=client_id, question=normalize_query(question), embedding=embedding, version=version)
+        vector = _normalize(embedding)
+        with self._lock:
+            self.lookups += 1
+            if vector is None:
+                return result
+            cache = self._client(client_id, version)
+            pos, score = cache.best(vector, result.question, time.time(), self.ttl)
+            if pos is not None and score >= self.threshold:
+                self.hits += 1
+                result.answer = cache.answers[pos]
+                result.score = score
+        return result
+
+    async def alookup(self, client_id: str, question: str) -> Optional[CacheLookup]:
+        """
+        Эмбеддинг вопроса (он же потом уйдёт в RAG) + версия индекса и промптов + поиск.
+        None — если кэш сейчас недоступен (например, не удалось получить эмбеддинг).
+        """
+        try:
+            embedding = await aget_embedding(question)
+            version = (await run_in_db_thread(index_version), prompt_fingerprint(client_id))
+        except Exception as e:
+            self.errors += 1
+            print("Кэш ответов: не удалось подготовить поиск:", repr(e))
+            return None
+        return self.lookup(client_id, question, embedding, version)
+
+    def store(self, lookup: CacheLookup, answer: str) -> None:
+        if not answer or answer == LLM_ERROR_ANSWER or lookup.answer is not None:
+            return
+        vector = _normalize(lookup.embedding)
+        if vector is None:
+            return
+        with self._lock:
+            cache = self._client(lookup.client_id, lookup.version)
+            cache.add(vector, lookup.question, answer, time.time())
+            self.stores += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clients.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "clients": len(self._clients),
+                "entries": sum(len(c) for c in self._clients.values()),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                "stores": self.stores,
+                "invalidations": self.invalidations,
+                "errors": self.errors,
+            }
+
+
+answer_cache = AnswerCache(
+    enabled=ANSWER_CACHE_ENABLED,
+    threshold=ANSWER_CACHE_THRESHOLD,
+    ttl=ANSWER_CACHE_TTL,
+    scope=ANSWER_CACHE_SCOPE,
+    max_entries=ANSWER_CACHE_MAX_ENTRIES,
+    max_clients=ANSWER_CACHE_MAX_CLIENTS,
+)
@@ -1,22 +1,57 @@
 # app/api/server.py
 
-from typing import Optional, Union
+import json
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional, Union
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
-from app.agent import run_ainova_agent
-
-# Если WhatsApp/GreenAPI пока не нужен — импорт можно оставить,
-# но эндпоинт ты можешь не использовать.
-from app.integrations.greenapi import send_text_message
+from app.config import MEMORY_WRITE_BEHIND
+from app.memory.db import migrate_db, run_in_db_thread
+from app.memory.identity import identity_cache, stable_user_id
+from app.memory.retention import retention_job
+from app.memory.summary import summarizer
+from app.memory.write_queue import write_queue
+from app.scheduler import QueueFullError, agent_scheduler
+from app.transport import aclose_http_clients, transport_stats
+from app.warmup import warmup
+
+# WhatsApp/GreenAPI без GREEN_API_INSTANCE_ID / GREEN_API_TOKEN выключен:
+# импорт ничего не требует, вебхук отвечает "disabled".
+from app.integrations.greenapi_webhook import greenapi_dispatcher, parse_notification
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # схема БД: создаём таблицы и применяем миграции один раз при старте, а не при импорте
+    await run_in_db_thread(migrate_db)
+    if MEMORY_WRITE_BEHIND:
+        await write_queue.start()
+    # чистка истории — только если включена в .env (RETENTION_*; по умолчанию выключена)
+    await retention_job.start()
+    await greenapi_dispatcher.start()
+    # индекс RAG, клиенты провайдера и т.п. — в фоне; готовность — /ready
+    warmup.start()
+    yield
+    await warmup.stop()
+    # сначала дообрабатываем принятые сообщения WhatsApp, потом останавливаем планировщик
+    await greenapi_dispatcher.stop()
+    await agent_scheduler.stop()
+    await retention_job.stop()
+    await summarizer.stop()
+    # дописываем сообщения, которые ещё лежат в очереди
+    await write_queue.stop()
+    await aclose_http_clients()
 
 
 app = FastAPI(
     title="AINOVA Agent API",
     description="Единый мозг ассистента AINOVA, доступный по HTTP.",
     version="0.2.0",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -41,16 +76,21 @@ class AgentRequest(BaseModel):
 
 class AgentResponse(BaseModel):
     answer: str
+    # True — сообщение склеено с более поздним сообщением того же пользователя
+    # (AGENT_MERGE_WINDOW_MS), общий ответ показывается на последнем
+    merged: bool = False
+
+
+QUEUE_FULL_DETAIL = "Слишком много сообщений подряд. Дождись ответа на предыдущие."
 
 
 def normalize_user_id(raw_id: Union[int, str]) -> int:
     """
     Преобразуем любой user_id (строка или число) в стабильное целое число.
     Нужно, чтобы один и тот же пользователь имел свою память независимо от канала.
+    Строка — 64-битный blake2b: одинаково во всех воркерах и после рестарта.
     """
-    if isinstance(raw_id, int):
-        return raw_id
-    return abs(hash(raw_id)) % (10**9)
+    return stable_user_id(raw_id)
 
 
 @app.get("/health")
@@ -58,6 +98,52 @@ async def health():
     return {"status": "ok"}
 
 
+@app.get("/ready")
+async def ready():
+    """
+    Готовность принимать трафик: 200 — после прогрева (app/warmup.py), до этого 503.
+    /health — только «процесс жив».
+    """
+    status = warmup.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Внутренние счётчики (кэши и т.п.) — для отладки и мониторинга.
+    """
+    from app.answer_cache import answer_cache
+    from app.context import context_stats
+    from app.memory.history_cache import history_cache
+    from app.prompts import prompt_registry
+    from app.llm_client import llm_flight, llm_limiter
+    from app.rag.embeddings import embed_limiter, embedding_flight, query_cache
+
+    return {
+        "embedding_cache": query_cache.stats(),
+        "write_queue": write_queue.stats(),
+        "history_cache": history_cache.stats(),
+        "identity_cache": identity_cache.stats(),
+        "retention": retention_job.stats(),
+        "summarizer": summarizer.stats(),
+        "context": context_stats.stats(),
+        "prompts": prompt_registry.stats(),
+        "answer_cache": answer_cache.stats(),
+        "single_flight": {
+            "llm": llm_flight.stats(),
+            "embeddings": embedding_flight.stats(),
+        },
+        "scheduler": agent_scheduler.stats(),
+        "greenapi": greenapi_dispatcher.stats(),
+        "transport": transport_stats(),
+        "rate_limit": {
+            "llm": llm_limiter.stats(),
+            "embeddings": embed_limiter.stats(),
+        },
+    }
+
+
 @app.post("/agent", response_model=AgentResponse)
 async def agent_endpoint(payload: AgentRequest):
     """
@@ -65,18 +151,66 @@ async def agent_endpoint(payload: AgentRequest):
 
     На вход: user_id, username, message (+ опционально client_id, channel).
     На выход: answer.
+    Сообщения одного пользователя обрабатываются по очереди (app.scheduler).
     """
     ext_id = normalize_user_id(payload.user_id)
 
-    answer = await run_ainova_agent(
-        user_external_id=ext_id,
-        username=payload.username,
-        user_text=payload.message,
-        client_id=payload.client_id or "default",
-        channel=payload.channel or "web",
-    )
+    try:
+        result = await agent_scheduler.submit(
+            user_external_id=ext_id,
+            username=payload.username,
+            user_text=payload.message,
+            client_id=payload.client_id or "default",
+            channel=payload.channel or "web",
+        )
+    except QueueFullError:
+        raise HTTPException(status_code=429, detail=QUEUE_FULL_DETAIL)
+
+    return AgentResponse(answer=result.answer, merged=not result.primary)
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-    return AgentResponse(answer=answer)
+
+@app.post("/agent/stream")
+async def agent_stream_endpoint(payload: AgentRequest):
+    """
+    То же, что /agent, но ответ приходит потоком (Server-Sent Events):
+    event: delta  data: {"text": "..."}   — очередной кусок ответа;
+    event: done   data: {}                — ответ закончен и сохранён;
+    event: error  data: {"detail": "..."} — поток оборвался.
+    Тело запроса — как у /agent (POST, поэтому на клиенте fetch + ReadableStream, а не EventSource).
+    """
+    ext_id = normalize_user_id(payload.user_id)
+
+    async def events() -> AsyncIterator[str]:
+        try:
+            async for delta in agent_scheduler.stream(
+                user_external_id=ext_id,
+                username=payload.username,
+                user_text=payload.message,
+                client_id=payload.client_id or "default",
+                channel=payload.channel or "web",
+            ):
+                yield _sse("delta", {"text": delta})
+        except QueueFullError:
+            yield _sse("error", {"detail": QUEUE_FULL_DETAIL})
+            return
+        except Exception as e:
+            print("Ошибка в /agent/stream:", repr(e))
+            yield _sse("error", {"detail": "Ответ прервался. Попробуй ещё раз позже."})
+            return
+        yield _sse("done", {})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # nginx: не буферизовать поток
+        },
+    )
 
 
 @app.post("/webhooks/greenapi")
@@ -84,38 +218,18 @@ async def greenapi_webhook(request: Request):
     """
     Вебхук для уведомлений от Green API.
     Сейчас WhatsApp отключён — этот эндпоинт можно не трогать.
+
+    Отвечаем сразу: сообщение обрабатывается в фоне (app.integrations.greenapi_webhook),
+    повторные уведомления с тем же idMessage отбрасываются.
     """
     payload = await request.json()
 
-    type_webhook = payload.get("typeWebhook")
-    if type_webhook != "incomingMessageReceived":
-        return {"status": "ignored", "type": type_webhook}
-
-    sender_data = payload.get("senderData", {}) or {}
-    message_data = payload.get("messageData", {}) or {}
-
-    chat_id = sender_data.get("chatId")
-    username = sender_data.get("senderName") or sender_data.get("chatName") or "whatsapp_user"
-
-    text_message_data = message_data.get("textMessageData") or {}
-    user_text = text_message_data.get("textMessage")
-
-    if not chat_id or not user_text:
-        return {"status": "no_text_or_chat", "chat_id": chat_id, "user_text": user_text}
-
-    user_external_id = f"wa:{chat_id}"
-
-    answer = await run_ainova_agent(
-        user_external_id=user_external_id,
-        username=username,
-        user_text=user_text,
-        client_id="default",
-        channel="whatsapp",
-    )
-
-    try:
-        send_text_message(chat_id, answer)
-    except Exception as e:
-        return {"status": "error_send", "detail": str(e)}
+    status, message = parse_notification(payload)
+    if message is None:
+        return {"status": status, "type": payload.get("typeWebhook")}
 
-    return {"status": "ok", "answer": answer}
+    status = await greenapi_dispatcher.accept(message)
+    if status == "busy":
+        # Green API повторит уведомление позже
+        raise HTTPException(status_code=503, detail="too many messages in processing")
+    return {"status": status}
@@ -1,24 +1,117 @@
 # app/bot/telegram_bot.py
 
 import asyncio
+import time
 from typing import Dict, List
 
 from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.types import Message
 from aiogram.filters import CommandStart
 
 
-from app.config import TELEGRAM_BOT_TOKEN
-from app.llm_client import ask_llm, DEFAULT_SYSTEM_PROMPT
+from app.config import (
+    MEMORY_WRITE_BEHIND,
+    TELEGRAM_BOT_TOKEN,
+    TELEGRAM_STREAMING,
+    TELEGRAM_STREAM_EDIT_INTERVAL,
+)
+from app.memory.db import migrate_db, run_in_db_thread
+from app.memory.summary import summarizer
+from app.memory.write_queue import write_queue
+from app.scheduler import QueueFullError, agent_scheduler
+from app.transport import aclose_http_clients
+from app.warmup import warmup
 
-from app.agent import run_ainova_agent
-
-if not TELEGRAM_BOT_TOKEN:
-    raise RuntimeError("TELEGRAM_BOT_TOKEN не найден. Заполни его в .env")
-
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
 dp = Dispatcher()
 
+# лимит длины текста одного сообщения Telegram
+TELEGRAM_MAX_TEXT = 4096
+_CURSOR = " ▌"
+QUEUE_FULL_TEXT = "Слишком много сообщений подряд — дождись ответа на предыдущие 🙏"
+
+
+def _split_text(text: str, limit: int = TELEGRAM_MAX_TEXT) -> List[str]:
+    """
+    Режем длинный ответ на сообщения, по возможности по переносу строки.
+    """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+
+async def _edit_text(msg: Message, text: str, wait_on_limit: bool) -> bool:
+    """
+    edit_text с учётом лимитов Telegram. «message is not modified» — не ошибка.
+    wait_on_limit=False (промежуточные правки): при TelegramRetryAfter просто пропускаем правку,
+    вызывающий сдвигает следующую попытку; True (финальная правка) — ждём и повторяем.
+    """
+    while True:
+        try:
+            await msg.edit_text(text)
+            return True
+        except TelegramRetryAfter as e:
+            if not wait_on_limit:
+                raise
+            await asyncio.sleep(e.retry_after)
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return True
+            raise
+
+
+async def _reply_streaming(message: Message, thinking_msg: Message, user_text: str) -> None:
+    """
+    Ответ потоком: правим «Думаю над ответом...» по мере генерации,
+    не чаще раза в TELEGRAM_STREAM_EDIT_INTERVAL секунд.
+    """
+    tg_user = message.from_user
+    text = ""
+    shown = ""
+    next_edit = time.monotonic() + TELEGRAM_STREAM_EDIT_INTERVAL
+    interrupted = False
+
+    try:
+        async for delta in agent_scheduler.stream(
+            user_external_id=tg_user.id,
+            username=tg_user.username,
+            user_text=user_text,
+            channel="telegram",
+        ):
+            text += delta
+            now = time.monotonic()
+            if now < next_edit or not text.strip() or text == shown:
+                continue
+            next_edit = now + TELEGRAM_STREAM_EDIT_INTERVAL
+            # пока ответ идёт, показываем первые 4096 символов; остальное уйдёт отдельными сообщениями в конце
+            preview = text[: TELEGRAM_MAX_TEXT - len(_CURSOR)] + _CURSOR
+            try:
+                await _edit_text(thinking_msg, preview, wait_on_limit=False)
+                shown = text
+            except TelegramRetryAfter as e:
+                next_edit = time.monotonic() + e.retry_after
+            except TelegramBadRequest as e:
+                print("Telegram: не удалось обновить сообщение:", repr(e))
+    except QueueFullError:
+        await _edit_text(thinking_msg, QUEUE_FULL_TEXT, wait_on_limit=True)
+        return
+    except Exception as e:
+        print("Ошибка потокового ответа:", repr(e))
+        interrupted = True
+
+    if interrupted:
+        text = (text + "\n\n⚠️ Ответ прервался, попробуй ещё раз.").strip()
+    parts = _split_text(text or "Нет ответа 🤔")
+    await _edit_text(thinking_msg, parts[0], wait_on_limit=True)
+    for part in parts[1:]:
+        await message.answer(part)
+
 
 @dp.message(CommandStart())
 async def cmd_start(message: Message):
@@ -37,18 +130,53 @@ async def handle_message(message: Message):
     # Временное сообщение, чтобы показать, что бот думает
     thinking_msg = await message.answer("Думаю над ответом... 🤔")
 
-    # Вызываем единый "мозг" ассистента
-    answer = await run_ainova_agent(
-        user_external_id=tg_user.id,
-        username=tg_user.username,
-        user_text=user_text,
-    )
+    if TELEGRAM_STREAMING:
+        await _reply_streaming(message, thinking_msg, user_text)
+        return
+
+    # Вызываем единый "мозг" ассистента (сообщения пользователя — по очереди, см. app.scheduler)
+    try:
+        result = await agent_scheduler.submit(
+            user_external_id=tg_user.id,
+            username=tg_user.username,
+            user_text=user_text,
+            channel="telegram",
+        )
+    except QueueFullError:
+        await _edit_text(thinking_msg, QUEUE_FULL_TEXT, wait_on_limit=True)
+        return
+
+    if not result.primary:
+        # сообщение склеено с более поздним — общий ответ придёт на него
+        await thinking_msg.delete()
+        return
+
+    parts = _split_text(result.answer)
+    await _edit_text(thinking_msg, parts[0], wait_on_limit=True)
+    for part in parts[1:]:
+        await message.answer(part)
 
-    await thinking_msg.edit_text(answer)
 
 async def main():
+    # токен проверяем при запуске бота, а не при импорте модуля
+    if not TELEGRAM_BOT_TOKEN:
+        raise RuntimeError("TELEGRAM_BOT_TOKEN не найден. Заполни его в .env")
+    bot = Bot(token=TELEGRAM_BOT_TOKEN)
+
+    await run_in_db_thread(migrate_db)
+    # прогрев до polling: первое сообщение не ждёт загрузки индекса и клиентов
+    await warmup.run()
     print("AINOVA Telegram-бот запущен. Нажми Ctrl+C для остановки.")
-    await dp.start_polling(bot)
+    if MEMORY_WRITE_BEHIND:
+        await write_queue.start()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await agent_scheduler.stop()
+        await summarizer.stop()
+        await write_queue.stop()
+        await aclose_http_clients()
+        await bot.session.close()
 
 
 if __name__ == "__main__":
@@ -12,24 +12,193 @@ load_dotenv()
 PROXYAPI_API_KEY = os.getenv("PROXYAPI_API_KEY", "").strip()
 PROXYAPI_BASE_URL = os.getenv("PROXYAPI_BASE_URL", "https://openai.api.proxyapi.ru/v1").strip()
 
+# --- HTTP transport (общий пул соединений к провайдеру) ---
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+# таймауты в секундах: подключение / чтение (между байтами ответа) / запись / ожидание соединения из пула
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+HTTP_WRITE_TIMEOUT = float(os.getenv("HTTP_WRITE_TIMEOUT", "10"))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "5"))
+# HTTP/2: auto — если установлен пакет h2; true / false — принудительно
+HTTP_HTTP2 = os.getenv("HTTP_HTTP2", "auto").strip().lower()
+# Повторы запроса к LLM при временных ошибках (429, таймаут, 5xx)
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+# Circuit breaker: после N сбоев подряд не ходим к апстриму RESET секунд (0 = выключен)
+CIRCUIT_BREAKER_FAILURES = int(os.getenv("CIRCUIT_BREAKER_FAILURES", "5"))
+CIRCUIT_BREAKER_RESET = float(os.getenv("CIRCUIT_BREAKER_RESET", "30"))
+
 # --- LLM settings ---
 LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini").strip()
 LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.7"))
 
 # --- Memory / history ---
 HISTORY_LIMIT = int(os.getenv("HISTORY_LIMIT", "12"))
+# Write-behind: сообщения пишутся фоновой задачей пачками раз в N мс (group commit)
+MEMORY_WRITE_BEHIND = os.getenv("MEMORY_WRITE_BEHIND", "false").lower() in ("1", "true", "yes", "y")
+MEMORY_WRITE_BEHIND_INTERVAL_MS = int(os.getenv("MEMORY_WRITE_BEHIND_INTERVAL_MS", "20"))
+MEMORY_WRITE_BEHIND_MAX_BATCH = int(os.getenv("MEMORY_WRITE_BEHIND_MAX_BATCH", "500"))
+# Кэш последних сообщений в памяти процесса: число пользователей (0 = выключен),
+# лимит памяти в байтах, TTL записи в секундах (0 = без TTL)
+HISTORY_CACHE_USERS = int(os.getenv("HISTORY_CACHE_USERS", "10000"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "3600"))
+# Проверять по БД, не дописал ли историю другой воркер (можно выключить при sticky routing)
+HISTORY_CACHE_VALIDATE = os.getenv("HISTORY_CACHE_VALIDATE", "true").lower() in ("1", "true", "yes", "y")
+# Кэш (channel, external_id) -> пользователь в памяти процесса (0 = выключен)
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "100000"))
+
+# Одинаковые одновременные запросы к LLM / embeddings делят один вызов (single-flight)
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() in ("1", "true", "yes", "y")
+# Лимит запросов в минуту к провайдеру на каждую модель (token bucket; 0 = без лимита),
+# BURST — сколько запросов можно сделать разом (0 = лимит за 10 секунд)
+LLM_RATE_LIMIT_RPM = float(os.getenv("LLM_RATE_LIMIT_RPM", "0"))
+LLM_RATE_LIMIT_BURST = float(os.getenv("LLM_RATE_LIMIT_BURST", "0"))
+EMBED_RATE_LIMIT_RPM = float(os.getenv("EMBED_RATE_LIMIT_RPM", "0"))
+EMBED_RATE_LIMIT_BURST = float(os.getenv("EMBED_RATE_LIMIT_BURST", "0"))
+
+# --- Agent scheduler ---
+# Ходы одного пользователя выполняются строго по очереди; всего одновременно — не больше
+# AGENT_MAX_CONCURRENCY. Сообщения, пришедшие подряд в течение AGENT_MERGE_WINDOW_MS,
+# можно склеить в один ход (0 = не склеивать)
+AGENT_MAX_CONCURRENCY = int(os.getenv("AGENT_MAX_CONCURRENCY", "16"))
+AGENT_MERGE_WINDOW_MS = int(os.getenv("AGENT_MERGE_WINDOW_MS", "0"))
+AGENT_MERGE_MAX_MESSAGES = int(os.getenv("AGENT_MERGE_MAX_MESSAGES", "5"))
+AGENT_MAX_QUEUE_PER_USER = int(os.getenv("AGENT_MAX_QUEUE_PER_USER", "20"))
+
+# --- WhatsApp (Green API) ---
+# Без INSTANCE_ID / TOKEN интеграция выключена: сервер стартует, вебхук отвечает "disabled"
+GREEN_API_URL = os.getenv("GREEN_API_URL", "https://api.green-api.com").strip()
+GREEN_API_INSTANCE_ID = os.getenv("GREEN_API_INSTANCE_ID", "").strip()
+GREEN_API_TOKEN = os.getenv("GREEN_API_TOKEN", "").strip()
+GREEN_API_ENABLED = bool(GREEN_API_INSTANCE_ID and GREEN_API_TOKEN)
+# повторы отправки при сетевых ошибках, 429 и 5xx
+GREEN_API_MAX_RETRIES = int(os.getenv("GREEN_API_MAX_RETRIES", "3"))
+# Вебхук отвечает сразу, сообщения обрабатываются в фоне (параллельность — у планировщика агента);
+# QUEUE_SIZE — сколько сообщений может быть в обработке одновременно, сверх — 503
+GREEN_API_WEBHOOK_QUEUE_SIZE = int(os.getenv("GREEN_API_WEBHOOK_QUEUE_SIZE", "1000"))
+# Повторы вебхука с тем же idMessage отбрасываются в течение DEDUP_TTL секунд;
+# DEDUP_DB — помнить idMessage и в БД (общая память для нескольких воркеров uvicorn)
+GREEN_API_DEDUP_TTL = float(os.getenv("GREEN_API_DEDUP_TTL", "86400"))
+GREEN_API_DEDUP_DB = os.getenv("GREEN_API_DEDUP_DB", "true").lower() in ("1", "true", "yes", "y")
+
+# --- Startup ---
+# Прогрев после старта (индекс RAG, токенайзер, промпты, клиенты провайдера) — в фоне;
+# /ready отвечает 200 только после него. WARMUP_ENABLED=false — /ready готов сразу
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes", "y")
 
 # --- RAG settings ---
 ENABLE_RAG = os.getenv("ENABLE_RAG", "true").lower() in ("1", "true", "yes", "y")
 RAG_TOP_K = int(os.getenv("RAG_TOP_K", "2"))
-RAG_MAX_CHARS = int(os.getenv("RAG_MAX_CHARS", "4000"))  # ограничение на размер контекста
+
+# --- Context budget ---
+# Весь промпт (без ответа) — не больше CONTEXT_TOKEN_BUDGET токенов. Порядок заполнения:
+# системные промпты и вопрос -> пересказ -> последние CONTEXT_MIN_RECENT_MESSAGES сообщений
+# -> фрагменты базы знаний (до RAG_TOKEN_BUDGET) -> более старая история (до HISTORY_TOKEN_BUDGET)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+RAG_TOKEN_BUDGET = int(os.getenv("RAG_TOKEN_BUDGET", "1500"))
+CONTEXT_MIN_RECENT_MESSAGES = int(os.getenv("CONTEXT_MIN_RECENT_MESSAGES", "2"))
+# auto — tiktoken, если установлен и словарь доступен, иначе эвристика | tiktoken | heuristic
+TOKENIZER = os.getenv("TOKENIZER", "auto").strip().lower()
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base").strip()
+
+# --- RAG chunking ---
+# Размер фрагмента и перекрытие — в символах; sentence — резать по абзацам/заголовкам/предложениям
+RAG_CHUNK_SIZE = int(os.getenv("RAG_CHUNK_SIZE", "1500"))
+RAG_CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "200"))
+RAG_CHUNK_MODE = os.getenv("RAG_CHUNK_MODE", "sentence").strip().lower()  # sentence | fixed
+
+# --- Embeddings ---
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small").strip()
+# В каком виде храним вектора в БД: float32 (точно) или float16 (в 2 раза компактнее)
+EMBEDDING_STORAGE_DTYPE = os.getenv("EMBEDDING_STORAGE_DTYPE", "float32").strip().lower()
+# Пакетная индексация: бюджет токенов и число текстов на запрос, пакетов в полёте, ретраи
+EMBED_BATCH_MAX_TOKENS = int(os.getenv("EMBED_BATCH_MAX_TOKENS", "100000"))
+EMBED_BATCH_MAX_ITEMS = int(os.getenv("EMBED_BATCH_MAX_ITEMS", "256"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "5"))
+# На пути запроса пользователь ждёт ответа — повторов меньше
+EMBED_QUERY_MAX_RETRIES = int(os.getenv("EMBED_QUERY_MAX_RETRIES", "1"))
+# Кэш эмбеддингов запросов: размер LRU (0 = выключен), TTL в секундах,
+# путь к SQLite-файлу для персистентного уровня (пусто = только память)
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "2048"))
+EMBED_CACHE_TTL = float(os.getenv("EMBED_CACHE_TTL", "86400"))
+EMBED_CACHE_DB_PATH = os.getenv("EMBED_CACHE_DB_PATH", "").strip()
 
 # --- Paths ---
-# Структура: data/prompts/*.txt
+# Структура: data/prompts/*.txt, data/prompts/clients/<client_id>/*.txt
 PROJECT_ROOT = Path(os.getenv("PROJECT_ROOT", Path(__file__).resolve().parents[1]))
 DATA_DIR = Path(os.getenv("DATA_DIR", str(PROJECT_ROOT / "data")))
 PROMPTS_DIR = Path(os.getenv("PROMPTS_DIR", str(DATA_DIR / "prompts")))
+# Словарь tiktoken (TOKENIZER_ENCODING) лежит локально: положить при сборке — python -m app.tokenizer
+TIKTOKEN_CACHE_DIR = os.getenv("TIKTOKEN_CACHE_DIR", "").strip() or str(DATA_DIR / "tiktoken")
+# Промпты кэшируются в памяти; раз в N секунд проверяем mtime файлов (0 — на каждом ходу, -1 — никогда)
+PROMPTS_RELOAD_INTERVAL = float(os.getenv("PROMPTS_RELOAD_INTERVAL", "5"))
+
+# --- RAG index file ---
+# Плоский файл индекса, который пишет index_docs и мапят все воркеры (пусто = только БД)
+RAG_INDEX_PATH = os.getenv("RAG_INDEX_PATH", str(DATA_DIR / "index" / "documents.idx")).strip()
+
+# --- RAG search engine ---
+# exact — полный перебор, ivf — приближённый поиск (k-means списки)
+RAG_ANN_BACKEND = os.getenv("RAG_ANN_BACKEND", "exact").strip().lower()
+RAG_ANN_MIN_DOCS = int(os.getenv("RAG_ANN_MIN_DOCS", "5000"))  # меньше — всегда exact
+RAG_IVF_NLIST = int(os.getenv("RAG_IVF_NLIST", "0"))  # 0 = авто (~sqrt(N))
+RAG_IVF_NPROBE = int(os.getenv("RAG_IVF_NPROBE", "8"))  # больше — выше recall, медленнее
 
 # --- Database ---
 DEFAULT_DB_PATH = PROJECT_ROOT / "ainova_assistant.db"
 DB_URL = os.getenv("DB_URL", f"sqlite:///{DEFAULT_DB_PATH.as_posix()}")
+# Пул соединений и потоков БД (async-код ходит в БД через пул потоков)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "4"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# SQLite: production = WAL + synchronous=NORMAL + mmap/cache + busy_timeout; default = как есть
+DB_SQLITE_PROFILE = os.getenv("DB_SQLITE_PROFILE", "production").strip().lower()
+DB_SQLITE_MMAP_SIZE = int(os.getenv("DB_SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_SQLITE_CACHE_KB = int(os.getenv("DB_SQLITE_CACHE_KB", str(64 * 1024)))
+DB_SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("DB_SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# --- Messages retention ---
+# По умолчанию выключено: история хранится вся, как раньше. Чтобы включить — задать лимиты
+# (например 5000 сообщений / 365 дней) и RETENTION_INTERVAL=86400 для фоновой чистки в сервере.
+# Сколько сообщений хранить на пользователя и сколько дней (0 = без ограничения).
+# Всё, что старше, уезжает в сжатый JSONL-архив и удаляется из таблицы messages.
+RETENTION_MAX_MESSAGES_PER_USER = int(os.getenv("RETENTION_MAX_MESSAGES_PER_USER", "0"))
+RETENTION_MAX_AGE_DAYS = int(os.getenv("RETENTION_MAX_AGE_DAYS", "0"))
+# Архив: auto (zstd, если установлен zstandard, иначе gzip) | zstd | gzip | none (просто удалять)
+RETENTION_ARCHIVE_FORMAT = os.getenv("RETENTION_ARCHIVE_FORMAT", "auto").strip().lower()
+RETENTION_ARCHIVE_DIR = Path(os.getenv("RETENTION_ARCHIVE_DIR", str(DATA_DIR / "archive")))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "2000"))  # строк на транзакцию
+# Период фонового запуска в сервере, секунды (0 = только вручную: python -m app.memory.retention)
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "0"))
+# VACUUM, только если свободных страниц в файле БД не меньше этой доли (ANALYZE — всегда)
+RETENTION_VACUUM_MIN_FREE = float(os.getenv("RETENTION_VACUUM_MIN_FREE", "0.2"))
+
+# --- Conversation summary ---
+# Старая история пересказывается фоновой задачей после хода; в промпт идёт
+# пересказ + последние сообщения в пределах HISTORY_TOKEN_BUDGET токенов
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "true").lower() in ("1", "true", "yes", "y")
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", LLM_MODEL).strip()
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))  # пересказ + сырые сообщения
+SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", "4"))  # сколько последних сообщений не пересказывать
+SUMMARY_MIN_BATCH = int(os.getenv("SUMMARY_MIN_BATCH", "6"))  # пересказываем, когда накопилось столько старых
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "400"))  # длина пересказа
+
+# --- Telegram ---
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "").strip()
+# Потоковый ответ: сообщение «Думаю над ответом...» редактируется по мере генерации,
+# не чаще раза в TELEGRAM_STREAM_EDIT_INTERVAL секунд (лимиты Telegram на edit)
+TELEGRAM_STREAMING = os.getenv("TELEGRAM_STREAMING", "true").lower() in ("1", "true", "yes", "y")
+TELEGRAM_STREAM_EDIT_INTERVAL = float(os.getenv("TELEGRAM_STREAM_EDIT_INTERVAL", "1.0"))
+
+# --- Semantic answer cache ---
+# Похожий вопрос (косинус >= порога) того же client_id — ответ из кэша без запроса к LLM.
+# SCOPE: first — только вопросы без предыстории диалога | all — любые
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() in ("1", "true", "yes", "y")
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_SCOPE = os.getenv("ANSWER_CACHE_SCOPE", "first").strip().lower()
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))  # на client_id
+ANSWER_CACHE_MAX_CLIENTS = int(os.getenv("ANSWER_CACHE_MAX_CLIENTS", "100"))
@@ -0,0 +1,203 @@
+# app/context.py
+
+"""
+Сборка промпта в пределах бюджета токенов.
+
+Раньше размер контекста задавали три несвязанные ручки (HISTORY_LIMIT в сообщениях,
+RAG_TOP_K в документах, RAG_MAX_CHARS в символах). Теперь есть один общий бюджет
+CONTEXT_TOKEN_BUDGET, который заполняется по приоритету:
+
+1. системные промпты и вопрос пользователя — всегда;
+2. пересказ старой истории (app/memory/summary.py);
+3. последние CONTEXT_MIN_RECENT_MESSAGES сообщений — без них ответ теряет нить;
+4. фрагменты базы знаний в порядке релевантности, не больше RAG_TOKEN_BUDGET;
+5. остальная история от новых к старым; пересказ + история — не больше HISTORY_TOKEN_BUDGET.
+
+Режем только по границам: сообщение или фрагмент либо входит целиком, либо не входит.
+История берётся сплошным хвостом (без дыр), фрагменты — какие влезут по порядку.
+Токены сообщений истории берутся из сохранённого token_count (см. app/tokenizer.py).
+"""
+
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+from app.config import (
+    CONTEXT_TOKEN_BUDGET,
+    HISTORY_TOKEN_BUDGET,
+    RAG_TOKEN_BUDGET,
+    CONTEXT_MIN_RECENT_MESSAGES,
+)
+from app.memory.summary import summary_block
+from app.tokenizer import count_message_tokens, count_tokens, message_tokens
+
+RAG_HEADER = (
+    "Ниже справочная информация из базы знаний. Используй её как опору для фактов. "
+    "Если в базе нет ответа — уточни или предложи следующий шаг."
+)
+_PASSAGE_SEPARATOR = "\n\n---\n\n"
+_SEPARATOR_TOKENS = 3
+
+
+def format_passage(number: int, doc) -> str:
+    title = (doc.title or "Документ").strip()
+    if getattr(doc, "chunk_index", None) is not None:
+        title = f"{title}, фрагмент {doc.chunk_index + 1}"
+    content = (doc.content or "").strip()
+    return f"[Источник {number}] {title}\n{content}"
+
+
+@dataclass
+class ContextReport:
+    budget: int
+    tokens: Dict[str, int] = field(default_factory=dict)  # по разделам: system / summary / history / rag / user
+    history_messages: int = 0
+    history_dropped: int = 0
+    passages: int = 0
+    passages_dropped: int = 0
+
+    @property
+    def total(self) -> int:
+        return sum(self.tokens.values())
+
+
+@dataclass
+class AssembledContext:
+    messages: List[dict]
+    report: ContextReport
+
+
+def assemble_context(
+    system_messages: List[dict],
+    user_message: dict,
+    history: List,
+    summary: Optional[str] = None,
+    summary_until: Optional[datetime] = None,
+    docs: Sequence = (),
+    budget: int = CONTEXT_TOKEN_BUDGET,
+    history_budget: int = HISTORY_TOKEN_BUDGET,
+    rag_budget: int = RAG_TOKEN_BUDGET,
+    min_recent: int = CONTEXT_MIN_RECENT_MESSAGES,
+) -> AssembledContext:
+    """
+    history — сообщения от старых к новым (Message / CachedMessage),
+    docs — фрагменты базы знаний по убыванию релевантности.
+    """
+    report = ContextReport(budget=budget)
+    report.tokens["system"] = sum(count_message_tokens(m) for m in system_messages)
+    report.tokens["user"] = count_message_tokens(user_message)
+    remaining = budget - report.tokens["system"] - report.tokens["user"]
+    history_used = 0
+
+    # 2) пересказ
+    summary_message = None
+    if summary:
+        candidate = {"role": "system", "content": summary_block(summary)}
+        cost = count_message_tokens(candidate)
+        if cost <= remaining and cost <= history_budget:
+            summary_message = candidate
+            remaining -= cost
+            history_used += cost
+            report.tokens["summary"] = cost
+
+    # сообщения, уже вошедшие в пересказ, не повторяем (если сам пересказ влез)
+    fresh = [
+        m for m in history
+        if summary_message is None or summary_until is None or m.created_at is None or m.created_at > summary_until
+    ]
+
+    picked: List = []  # от новых к старым
+    history_closed = False
+
+    def take_history(limit: Optional[int]) -> None:
+        nonlocal remaining, history_used, history_closed
+        while not history_closed and len(picked) < len(fresh) and (limit is None or len(picked) < limit):
+            msg = fresh[len(fresh) - 1 - len(picked)]
+            cost = message_tokens(msg)
+            if cost > remaining or history_used + cost > history_budget:
+                history_closed = True  # дальше — только более старые, без дыр не получится
+                return
+            picked.append(msg)
+            remaining -= cost
+            history_used += cost
+
+    # 3) последние сообщения — важнее базы знаний
+    take_history(max(0, min_recent))
+
+    # 4) база знаний
+    parts: List[str] = []
+    if docs:
+        header_cost = count_message_tokens({"content": RAG_HEADER})
+        rag_used = 0
+        for doc in docs:
+            part = format_passage(len(parts) + 1, doc)
+            cost = count_tokens(part) + _SEPARATOR_TOKENS + (header_cost if not parts else 0)
+            if cost > remaining or rag_used + cost > rag_budget:
+                report.passages_dropped += 1
+                continue
+            parts.append(part)
+            remaining -= cost
+            rag_used += cost
+        if parts:
+            report.tokens["rag"] = rag_used
+        report.passages = len(parts)
+
+    # 5) остальная история
+    take_history(None)
+    picked.reverse()
+    report.tokens["history"] = sum(message_tokens(m) for m in picked)
+    report.history_messages = len(picked)
+    report.history_dropped = len(fresh) - len(picked)
+
+    messages: List[dict] = list(system_messages)
+    if summary_message is not None:
+        messages.append(summary_message)
+    messages.extend({"role": m.role, "content": m.content} for m in picked)
+    if parts:
+        messages.append({
+            "role": "system",
+            "content": f"{RAG_HEADER}\n\n{_PASSAGE_SEPARATOR.join(parts)}",
+        })
+    messages.append(user_message)
+
+    context_stats.record(report)
+    return AssembledContext(messages=messages, report=report)
+
+
+class ContextStats:
+    """
+    Счётчики по собранным промптам — для /metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.tokens = 0
+        self.max_tokens = 0
+        self.over_budget = 0
+        self.history_dropped = 0
+        self.passages_dropped = 0
+
+    def record(self, report: ContextReport) -> None:
+        with self._lock:
+            self.turns += 1
+            self.tokens += report.total
+            self.max_tokens = max(self.max_tokens, report.total)
+            self.over_budget += int(report.total > report.budget)
+            self.history_dropped += report.history_dropped
+            self.passages_dropped += report.passages_dropped
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "turns": self.turns,
+                "avg_tokens": round(self.tokens / self.turns, 1) if self.turns else 0.0,
+                "max_tokens": self.max_tokens,
+                "over_budget": self.over_budget,
+                "history_dropped": self.history_dropped,
+                "passages_dropped": self.passages_dropped,
+            }
+
+
+context_stats = ContextStats()
@@ -1,17 +1,15 @@
-import os
-import requests
-from dotenv import load_dotenv
+import asyncio
 
-# Загружаем .env (на случай, если ещё не подхвачен)
-load_dotenv()
+import httpx
 
-GREEN_API_URL = os.getenv("GREEN_API_URL", "https://api.green-api.com")
-GREEN_API_INSTANCE_ID = os.getenv("GREEN_API_INSTANCE_ID")
-GREEN_API_TOKEN = os.getenv("GREEN_API_TOKEN")
-
-
-if not GREEN_API_INSTANCE_ID or not GREEN_API_TOKEN:
-    raise RuntimeError("GREEN_API_INSTANCE_ID или GREEN_API_TOKEN не заданы в .env")
+from app.config import (
+    GREEN_API_URL,
+    GREEN_API_INSTANCE_ID,
+    GREEN_API_TOKEN,
+    GREEN_API_ENABLED,
+    GREEN_API_MAX_RETRIES,
+)
+from app.transport import get_http_client, retry_delay
 
 
 def _build_url(method_path: str) -> str:
@@ -22,16 +20,40 @@ def _build_url(method_path: str) -> str:
     return f"{GREEN_API_URL}/waInstance{GREEN_API_INSTANCE_ID}{method_path}/{GREEN_API_TOKEN}"
 
 
-def send_text_message(chat_id: str, text: str) -> dict:
+def _retryable(error: Exception) -> bool:
+    if isinstance(error, httpx.TransportError):  # таймауты, обрывы соединения
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return False
+
+
+async def send_text_message(chat_id: str, text: str) -> dict:
     """
     Отправить текстовое сообщение в чат WhatsApp.
     chat_id — строка формата '79991234567@c.us'
+    Соединения — из общего пула (app.transport); временные ошибки повторяем
+    с паузой по Retry-After или экспонентой с джиттером.
     """
+    if not GREEN_API_ENABLED:
+        raise RuntimeError("GREEN_API_INSTANCE_ID или GREEN_API_TOKEN не заданы в .env")
+
     url = _build_url("/sendMessage")
     payload = {
         "chatId": chat_id,
         "message": text,
     }
-    response = requests.post(url, json=payload, timeout=10)
-    response.raise_for_status()
-    return response.json()
+    attempt = 0
+    while True:
+        try:
+            response = await get_http_client().post(url, json=payload)
+            response.raise_for_status()
+            return response.json()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            if not _retryable(e) or attempt >= GREEN_API_MAX_RETRIES:
+                raise
+            delay = retry_delay(e, attempt)
+            attempt += 1
+            print(f"Green API: {type(e).__name__}, повтор {attempt} через {delay:.1f} с")
+            await asyncio.sleep(delay)
@@ -0,0 +1,291 @@
+# app/integrations/greenapi_webhook.py
+
+"""
+Обработка входящих сообщений WhatsApp (вебхук Green API) в фоне.
+
+Green API ждёт ответа на вебхук недолго и при таймауте присылает уведомление повторно.
+Раньше вебхук ждал весь ход LLM и отправку ответа — медленный ход превращался
+в повтор вебхука и второй (платный) ход по тому же сообщению. Теперь:
+
+- вебхук только разбирает уведомление, отбрасывает повторы по idMessage и кладёт
+  сообщение в очередь — ответ Green API уходит сразу;
+- каждое принятое сообщение обрабатывается своей фоновой задачей: ход идёт через
+  планировщик агента (app.scheduler) — он и ограничивает параллельность (общий семафор,
+  очередь на пользователя), так что медленный чат не задерживает остальные; ответ
+  отправляется асинхронным клиентом, недоставленные ответы видны в логе и в stats();
+- повторы отсекаются в памяти процесса (TTL GREEN_API_DEDUP_TTL), а при
+  GREEN_API_DEDUP_DB — ещё и в таблице processed_webhooks, общей для всех воркеров uvicorn.
+
+В обработке уже GREEN_API_WEBHOOK_QUEUE_SIZE сообщений — вебхук отвечает 503, и Green API
+повторит уведомление позже (idMessage при этом не запоминается).
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Set, Tuple
+
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
+
+from app.config import (
+    GREEN_API_ENABLED,
+    GREEN_API_WEBHOOK_QUEUE_SIZE,
+    GREEN_API_DEDUP_TTL,
+    GREEN_API_DEDUP_DB,
+)
+from app.integrations.greenapi import send_text_message
+from app.memory.db import SessionLocal, run_in_db_thread
+from app.memory.models import ProcessedWebhook
+from app.scheduler import QueueFullError, agent_scheduler
+
+# сколько ждём при остановке, пока дообработаются принятые сообщения
+_SHUTDOWN_TIMEOUT = 10.0
+# раз в сколько принятых сообщений чистим старые idMessage в БД
+_DB_PURGE_EVERY = 1000
+
+
+@dataclass
+class IncomingMessage:
+    message_id: Optional[str]
+    chat_id: str
+    username: str
+    text: str
+
+
+def parse_notification(payload: Dict[str, Any]) -> Tuple[str, Optional[IncomingMessage]]:
+    """
+    Разбираем уведомление Green API. Возвращаем (статус, сообщение или None).
+    """
+    type_webhook = payload.get("typeWebhook")
+    if type_webhook != "incomingMessageReceived":
+        return "ignored", None
+
+    sender_data = payload.get("senderData", {}) or {}
+    message_data = payload.get("messageData", {}) or {}
+
+    chat_id = sender_data.get("chatId")
+    username = sender_data.get("senderName") or sender_data.get("chatName") or "whatsapp_user"
+
+    text_message_data = message_data.get("textMessageData") or {}
+    user_text = text_message_data.get("textMessage")
+
+    if not chat_id or not user_text:
+        return "no_text_or_chat", None
+
+    return "ok", IncomingMessage(
+        message_id=payload.get("idMessage"),
+        chat_id=chat_id,
+        username=username,
+        text=user_text,
+    )
+
+
+class MessageDeduplicator:
+    """
+    Помним idMessage уже принятых сообщений: в памяти (LRU + TTL) и, опционально, в БД.
+    """
+
+    def __init__(self, ttl: float = 86400.0, use_db: bool = True, max_size: int = 100_000):
+        self.ttl = ttl
+        self.use_db = use_db
+        self.max_size = max_size
+
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db_claims = 0
+
+        self.duplicates = 0
+        self.db_errors = 0
+
+    def _claim_memory(self, message_id: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            seen_at = self._seen.get(message_id)
+            if seen_at is not None and now - seen_at < self.ttl:
+                return False
+            self._seen[message_id] = now
+            self._seen.move_to_end(message_id)
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            return True
+
+    def _claim_db(self, message_id: str) -> bool:
+        with SessionLocal() as session:
+            session.add(ProcessedWebhook(message_id=message_id))
+            try:
+                session.commit()
+            except IntegrityError:
+                session.rollback()
+                return False
+
+            self._db_claims += 1
+            if self._db_claims % _DB_PURGE_EVERY == 0:
+                cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+                session.execute(delete(ProcessedWebhook).where(ProcessedWebhook.received_at < cutoff))
+                session.commit()
+        return True
+
+    def _release_db(self, message_id: str) -> None:
+        with SessionLocal() as session:
+            session.execute(delete(ProcessedWebhook).where(ProcessedWebhook.message_id == message_id))
+            session.commit()
+
+    async def claim(self, message_id: Optional[str]) -> bool:
+        """
+        True — сообщение видим впервые, его нужно обработать.
+        """
+        if not message_id:
+            return True  # без idMessage дедуплицировать нечем
+        if not self._claim_memory(message_id):
+            self.duplicates += 1
+            return False
+        if not self.use_db:
+            return True
+        try:
+            claimed = await run_in_db_thread(self._claim_db, message_id)
+        except Exception as e:
+            # БД недоступна — лучше обработать сообщение, чем потерять его
+            self.db_errors += 1
+            print("Green API: не удалось записать idMessage:", repr(e))
+            return True
+        if not claimed:
+            self.duplicates += 1
+        return claimed
+
+    async def release(self, message_id: Optional[str]) -> None:
+        """
+        Забываем idMessage (сообщение не взяли в работу — повтор вебхука должен пройти).
+        """
+        if not message_id:
+            return
+        with self._lock:
+            self._seen.pop(message_id, None)
+        if self.use_db:
+            try:
+                await run_in_db_thread(self._release_db, message_id)
+            except Exception as e:
+                self.db_errors += 1
+                print("Green API: не удалось удалить idMessage:", repr(e))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "remembered": len(self._seen),
+                "duplicates": self.duplicates,
+                "db_errors": self.db_errors,
+            }
+
+
+class GreenApiDispatcher:
+    def __init__(self, max_pending: int = 1000, deduplicator: Optional[MessageDeduplicator] = None):
+        self.max_pending = max(1, max_pending)
+        self.dedup = deduplicator or MessageDeduplicator()
+
+        # по задаче на принятое сообщение: ход одного чата не держит остальные,
+        # параллельность ограничивает планировщик (семафор и очередь пользователя)
+        self._tasks: Set[asyncio.Task] = set()
+        self._stopping = False
+
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.sent = 0
+        self.undelivered = 0
+        self.errors = 0
+
+    async def start(self) -> None:
+        self._stopping = False
+
+    async def stop(self) -> None:
+        """
+        Даём дообработать принятые сообщения (не дольше _SHUTDOWN_TIMEOUT), остальные отменяем.
+        """
+        self._stopping = True
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(set(self._tasks), timeout=_SHUTDOWN_TIMEOUT)
+        if pending:
+            print(f"Green API: при остановке не обработано сообщений: {len(pending)}")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def accept(self, message: IncomingMessage) -> str:
+        """
+        Вызывается из вебхука: "accepted" | "duplicate" | "busy" | "disabled".
+        """
+        if not GREEN_API_ENABLED:
+            return "disabled"
+        if not await self.dedup.claim(message.message_id):
+            return "duplicate"
+        if self._stopping or len(self._tasks) >= self.max_pending:
+            self.rejected += 1
+            await self.dedup.release(message.message_id)
+            return "busy"
+        task = asyncio.create_task(self._process(message), name=f"greenapi-{message.chat_id}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self.accepted += 1
+        return "accepted"
+
+    async def _process(self, message: IncomingMessage) -> None:
+        try:
+            await self._handle(message)
+        except Exception as e:
+            self.errors += 1
+            print("Green API: ошибка обработки сообщения:", repr(e))
+
+    async def _handle(self, message: IncomingMessage) -> None:
+        try:
+            result = await agent_scheduler.submit(
+                user_external_id=f"wa:{message.chat_id}",
+                username=message.username,
+                user_text=message.text,
+                client_id="default",
+                channel="whatsapp",
+            )
+        except QueueFullError:
+            self.errors += 1
+            print(f"Green API: очередь пользователя {message.chat_id} переполнена, сообщение пропущено")
+            return
+        self.processed += 1
+
+        if not result.primary:
+            # сообщение ушло в общий ход с более поздним — ответ отправит тот
+            return
+        try:
+            # временные ошибки send_text_message повторяет сам (GREEN_API_MAX_RETRIES)
+            await send_text_message(message.chat_id, result.answer)
+        except Exception as e:
+            # ход уже сделан и записан в память; вебхук подтверждён — Green API его не повторит
+            self.undelivered += 1
+            print(
+                f"Green API: ответ в чат {message.chat_id} не доставлен "
+                f"(idMessage={message.message_id}):", repr(e)
+            )
+            return
+        self.sent += 1
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "enabled": GREEN_API_ENABLED,
+            "in_flight": len(self._tasks),
+            "max_pending": self.max_pending,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "sent": self.sent,
+            "undelivered": self.undelivered,
+            "errors": self.errors,
+            "dedup": self.dedup.stats(),
+        }
+
+
+greenapi_dispatcher = GreenApiDispatcher(
+    max_pending=GREEN_API_WEBHOOK_QUEUE_SIZE,
+    deduplicator=MessageDeduplicator(ttl=GREEN_API_DEDUP_TTL, use_db=GREEN_API_DEDUP_DB),
+)
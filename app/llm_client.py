@@ -1,52 +1,150 @@
 # app/llm_client.py
 
-from typing import Dict, List, Optional
-
-from openai import AsyncOpenAI
+import hashlib
+import json
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Optional
 
 from app.config import (
     PROXYAPI_API_KEY,
     PROXYAPI_BASE_URL,
     LLM_MODEL,
     LLM_TEMPERATURE,
+    SINGLE_FLIGHT_ENABLED,
+    LLM_RATE_LIMIT_RPM,
+    LLM_RATE_LIMIT_BURST,
+    LLM_MAX_RETRIES,
 )
+from app.ratelimit import ModelRateLimiter
+from app.singleflight import SingleFlight
+from app.transport import get_http_client, http_timeout, llm_breaker, retry_call
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+_client: Optional["AsyncOpenAI"] = None
+
+LLM_ERROR_ANSWER = "Что-то пошло не так при запросе к AI. Попробуй ещё раз позже 🙏"
 
-_client: Optional[AsyncOpenAI] = None
+# одинаковый промпт, пока ответ на него ещё генерируется, — один запрос на всех
+llm_flight = SingleFlight("llm", enabled=SINGLE_FLIGHT_ENABLED)
 
+# token bucket на модель: всплеск трафика ждёт здесь, а не получает 429 от провайдера
+llm_limiter = ModelRateLimiter(LLM_RATE_LIMIT_RPM, LLM_RATE_LIMIT_BURST)
 
-def get_client() -> AsyncOpenAI:
+
+def get_client() -> "AsyncOpenAI":
     """
     Лениво создаём клиента (не падаем при импорте).
+    Соединения — из общего пула app.transport; повторы делаем сами (retry_call),
+    поэтому встроенные в SDK отключены.
     """
     global _client
-    if _client is not None:
+    if _client is not None and not _client.is_closed():
         return _client
 
     if not PROXYAPI_API_KEY:
         raise RuntimeError("PROXYAPI_API_KEY не найден. Заполни его в .env")
 
+    from openai import AsyncOpenAI
+
     _client = AsyncOpenAI(
         api_key=PROXYAPI_API_KEY,
         base_url=PROXYAPI_BASE_URL,
+        http_client=get_http_client(),
+        timeout=http_timeout(),
+        max_retries=0,
     )
     return _client
 
 
+async def complete(
+    messages: List[Dict[str, str]],
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+) -> str:
+    """
+    Запрос к LLM без перехвата ошибок — для фоновых задач, которым нужно
+    отличать сбой от ответа (например, пересказ истории).
+    """
+    kwargs = {}
+    if max_tokens:
+        kwargs["max_tokens"] = max_tokens
+    model = model or LLM_MODEL
+    response = await retry_call(
+        lambda: get_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=LLM_TEMPERATURE if temperature is None else temperature,
+            stream=False,
+            **kwargs,
+        ),
+        breaker=llm_breaker,
+        max_retries=LLM_MAX_RETRIES,
+        label="LLM",
+        before_attempt=lambda: llm_limiter.acquire(model),
+    )
+    return response.choices[0].message.content or ""
+
+
+def _prompt_key(messages: List[Dict[str, str]]) -> str:
+    raw = json.dumps([LLM_MODEL, LLM_TEMPERATURE, messages], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _prompt_label(messages: List[Dict[str, str]]) -> str:
+    text = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+    return " ".join(text.split())[:60]
+
+
 async def ask_llm(messages: List[Dict[str, str]]) -> str:
     """
     Запрос к LLM через ProxyAPI (OpenAI-compatible).
     Настройки модели/температуры берём из config.
+    Одновременные запросы с точно таким же промптом (модель, температура, все сообщения)
+    получают один и тот же ответ одного вызова.
     """
     try:
-        client = get_client()
-        response = await client.chat.completions.create(
-            model=LLM_MODEL,
-            messages=messages,
-            temperature=LLM_TEMPERATURE,
-            stream=False,
-        )
-        content = response.choices[0].message.content
-        return content or ""
+        return await llm_flight.do(_prompt_key(messages), lambda: complete(messages), label=_prompt_label(messages))
     except Exception as e:
         print("Ошибка при запросе к LLM через ProxyAPI:", repr(e))
-        return "Что-то пошло не так при запросе к AI. Попробуй ещё раз позже 🙏"
+        return LLM_ERROR_ANSWER
+
+
+async def ask_llm_stream(messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+    """
+    Потоковый вариант ask_llm: отдаём текст кусками по мере генерации.
+    Ошибка до первого куска — отдаём то же запасное сообщение, что и ask_llm;
+    ошибка посреди ответа пробрасывается (часть ответа пользователь уже видел).
+    Повторяется только открытие потока — до первого куска.
+    """
+    started = False
+    stream = None
+    try:
+        stream = await retry_call(
+            lambda: get_client().chat.completions.create(
+                model=LLM_MODEL,
+                messages=messages,
+                temperature=LLM_TEMPERATURE,
+                stream=True,
+            ),
+            breaker=llm_breaker,
+            max_retries=LLM_MAX_RETRIES,
+            label="LLM (поток)",
+            before_attempt=lambda: llm_limiter.acquire(LLM_MODEL),
+        )
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                started = True
+                yield delta
+    except Exception as e:
+        if started:
+            raise
+        print("Ошибка при потоковом запросе к LLM через ProxyAPI:", repr(e))
+        yield LLM_ERROR_ANSWER
+    finally:
+        if stream is not None:
+            await stream.close()
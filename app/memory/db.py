@@ -1,9 +1,36 @@
 # app/memory/db.py
 
-from sqlalchemy import create_engine
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
 
-from app.config import DB_URL
+from app.config import (
+    DB_URL,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_SQLITE_PROFILE,
+    DB_SQLITE_MMAP_SIZE,
+    DB_SQLITE_CACHE_KB,
+    DB_SQLITE_BUSY_TIMEOUT_MS,
+)
+
+T = TypeVar("T")
+
+_in_memory = DB_URL.startswith("sqlite") and (DB_URL in ("sqlite://", "sqlite:///") or ":memory:" in DB_URL)
+
+# Пул соединений: столько же, сколько потоков в _db_executor (+ запас для скриптов),
+# чтобы поток никогда не ждал свободного соединения
+_pool_kwargs = {} if _in_memory else {
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT,
+    "pool_pre_ping": True,
+}
 
 # Создаём движок (подключение к БД)
 # Для SQLite это будет файл, путь к которому задан в DB_URL
@@ -11,8 +38,25 @@ engine = create_engine(
     DB_URL,
     echo=False,      # можно поставить True, если хочешь видеть SQL в консоли
     future=True,
+    **_pool_kwargs,
 )
 
+# Профиль SQLite для продакшена: WAL (читатели не блокируют писателя),
+# synchronous=NORMAL (fsync только на чекпойнтах WAL), mmap и большой page cache,
+# busy_timeout вместо мгновенного "database is locked" при конкурентной записи.
+if DB_URL.startswith("sqlite") and not _in_memory and DB_SQLITE_PROFILE == "production":
+
+    @event.listens_for(engine, "connect")
+    def _sqlite_production_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA mmap_size={int(DB_SQLITE_MMAP_SIZE)}")
+        cursor.execute(f"PRAGMA cache_size=-{int(DB_SQLITE_CACHE_KB)}")  # минус = в КиБ
+        cursor.execute(f"PRAGMA busy_timeout={int(DB_SQLITE_BUSY_TIMEOUT_MS)}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
 # Фабрика сессий — через неё будем общаться с БД
 SessionLocal = sessionmaker(
     bind=engine,
@@ -24,10 +68,26 @@ SessionLocal = sessionmaker(
 # Базовый класс для моделей (таблиц)
 Base = declarative_base()
 
-# app/memory/db.py
+# Отдельный пул потоков под синхронный SQLAlchemy: async-код отдаёт туда работу с БД
+# и не блокирует event loop. Размер = размер пула соединений.
+_db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+
+async def run_in_db_thread(fn: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Выполнить синхронную функцию работы с БД в пуле потоков БД и дождаться результата.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(fn, *args, **kwargs))
+
 
 def migrate_db():
     """
     Создаём новые таблицы или обновляем существующие.
     """
+    # модели должны быть зарегистрированы в Base.metadata до create_all
+    import app.memory.models
+    from app.memory.migrations import run_migrations
+
     Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
@@ -2,8 +2,9 @@
 
 from textwrap import shorten
 
-from app.memory.db import SessionLocal
+from app.memory.db import SessionLocal, migrate_db
 from app.memory.models import User, Message, Document
+from app.rag.vectors import decode_embedding_with_model, is_binary_embedding
 
 
 def print_users(session):
@@ -25,38 +26,46 @@ def print_messages(session, limit_per_user: int = 5):
 
     for u in users:
         print(f"\n--- Диалог с пользователем id={u.id} (tg_id={u.telegram_id}) ---")
+        # последние limit_per_user — запросом с LIMIT по индексу (user_id, created_at),
+        # а не загрузкой всего диалога
         msgs = (
             session.query(Message)
             .filter(Message.user_id == u.id)
-            .order_by(Message.created_at.asc())
+            .order_by(Message.created_at.desc(), Message.id.desc())
+            .limit(limit_per_user)
             .all()
         )
         if not msgs:
             print("  Сообщений нет")
             continue
 
-        # Покажем не больше limit_per_user
-        for msg in msgs[-limit_per_user:]:
+        for msg in reversed(msgs):
             snippet = shorten(msg.content.replace("\n", " "), width=80, placeholder="...")
             print(f"  [{msg.created_at}] {msg.role:9} | {snippet}")
 
 
 def print_documents(session, limit: int = 5):
     print("\n=== DOCUMENTS (RAG) ===")
-    docs = session.query(Document).all()
+    docs = session.query(Document).order_by(Document.id).limit(limit).all()
     if not docs:
         print("Нет документов в базе")
         return
 
-    for doc in docs[:limit]:
+    for doc in docs:
         snippet = shorten(doc.content.replace("\n", " "), width=100, placeholder="...")
         print(f"[id={doc.id}] title={doc.title}, created_at={doc.created_at}")
         print(f"  content: {snippet}")
-        print(f"  embedding length: приблизительно {len(doc.embedding)} символов (JSON-строка)")
+        try:
+            vec, model = decode_embedding_with_model(doc.embedding)
+            fmt = f"binary {vec.dtype}" if is_binary_embedding(doc.embedding) else "JSON (legacy)"
+            print(f"  embedding: dim={vec.shape[0]}, model={model or '?'}, {fmt}, {len(doc.embedding)} байт")
+        except Exception as e:
+            print(f"  embedding: не удалось прочитать ({e!r})")
         print()
 
 
 def main():
+    migrate_db()
     with SessionLocal() as session:
         print_users(session)
         print_messages(session, limit_per_user=10)
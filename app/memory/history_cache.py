@@ -0,0 +1,202 @@
+# app/memory/history_cache.py
+
+"""
+Кэш «горячей» истории диалогов в памяти процесса.
+
+Для каждого пользователя держим кольцевой буфер (deque) последних сообщений,
+по пользователям — LRU с ограничением по числу пользователей и по памяти.
+Новые сообщения пишутся в кэш сразу при сохранении хода (write-through),
+поэтому для активного чата история на каждом ходу берётся из памяти.
+
+Несколько воркеров. Кэш у каждого процесса свой, два варианта:
+- HISTORY_CACHE_VALIDATE=true (по умолчанию): на попадании делаем одну дешёвую
+  проверку по индексу — max(created_at) сообщений пользователя в БД. Если там есть
+  что-то новее, чем последнее сообщение в кэше (ответил другой воркер), — перечитываем
+  историю из БД. Сообщения, которые этот воркер ещё не дописал (write-behind), новее
+  всего, что есть в БД, и проверку не ломают.
+- sticky routing (все сообщения пользователя приходят в один воркер: Telegram-бот
+  в одном процессе, балансировщик с hash по user_id) — проверку можно выключить,
+  тогда горячий путь вообще не читает историю из БД.
+TTL в любом случае ограничивает время жизни записи.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Deque, Dict, Iterable, List, NamedTuple, Optional
+
+from app.config import (
+    HISTORY_LIMIT,
+    HISTORY_CACHE_USERS,
+    HISTORY_CACHE_MAX_BYTES,
+    HISTORY_CACHE_TTL,
+)
+from app.tokenizer import count_tokens
+
+# примерные накладные расходы на одно сообщение в памяти (объекты, deque, datetime)
+_MESSAGE_OVERHEAD = 200
+
+
+class CachedMessage(NamedTuple):
+    role: str
+    content: str
+    created_at: Optional[datetime]
+    token_count: int
+
+
+class _Entry:
+    __slots__ = ("messages", "size", "loaded_at")
+
+    def __init__(self, max_messages: int):
+        self.messages: Deque[CachedMessage] = deque(maxlen=max_messages)
+        self.size = 0
+        self.loaded_at = time.monotonic()
+
+    def append(self, msg: CachedMessage) -> int:
+        """
+        Добавляем сообщение, возвращаем изменение размера (в байтах, примерно).
+        """
+        delta = _message_size(msg)
+        if len(self.messages) == self.messages.maxlen:
+            delta -= _message_size(self.messages[0])
+        self.messages.append(msg)
+        self.size += delta
+        return delta
+
+    @property
+    def last_created_at(self) -> Optional[datetime]:
+        return self.messages[-1].created_at if self.messages else None
+
+
+def _message_size(msg: CachedMessage) -> int:
+    return len(msg.content) * 2 + _MESSAGE_OVERHEAD
+
+
+class HistoryCache:
+    def __init__(
+        self,
+        max_messages: int = HISTORY_LIMIT,
+        max_users: int = HISTORY_CACHE_USERS,
+        max_bytes: int = HISTORY_CACHE_MAX_BYTES,
+        ttl: float = HISTORY_CACHE_TTL,
+    ):
+        self.max_messages = max_messages
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_users > 0 and self.max_messages > 0
+
+    def get(self, user_id: int) -> Optional[List[CachedMessage]]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            if self.ttl > 0 and time.monotonic() - entry.loaded_at > self.ttl:
+                self._drop(user_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return list(entry.messages)
+
+    def last_created_at(self, user_id: int) -> Optional[datetime]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            return entry.last_created_at if entry is not None else None
+
+    def set(self, user_id: int, messages: Iterable) -> List[CachedMessage]:
+        """
+        Прогреваем кэш историей из БД (старые -> новые). Возвращаем то, что положили.
+        """
+        entry = _Entry(self.max_messages)
+        for msg in messages:
+            token_count = getattr(msg, "token_count", None)
+            if token_count is None:
+                token_count = count_tokens(msg.content)
+            entry.append(CachedMessage(msg.role, msg.content, msg.created_at, token_count))
+        result = list(entry.messages)
+
+        if not self.enabled:
+            return result
+
+        with self._lock:
+            self._drop(user_id)
+            self._entries[user_id] = entry
+            self._bytes += entry.size
+            self._evict()
+        return result
+
+    def append(
+        self,
+        user_id: int,
+        role: str,
+        content: str,
+        created_at: Optional[datetime],
+        token_count: Optional[int] = None,
+    ) -> None:
+        """
+        Write-through: дописываем сообщение, только если история пользователя уже в кэше
+        (иначе в кэше оказался бы обрывок без старых сообщений).
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            if token_count is None:
+                token_count = count_tokens(content)
+            self._bytes += entry.append(CachedMessage(role, content, created_at, token_count))
+            self._entries.move_to_end(user_id)
+            self._evict()
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._drop(user_id)
+
+    def mark_stale(self, user_id: int) -> None:
+        with self._lock:
+            self.stale += 1
+            self._drop(user_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _drop(self, user_id: int) -> None:
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _evict(self) -> None:
+        while self._entries and (len(self._entries) > self.max_users or self._bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "users": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+            }
+
+
+history_cache = HistoryCache()
@@ -0,0 +1,125 @@
+# app/memory/identity.py
+
+"""
+Идентичность пользователя между каналами и процессами.
+
+- stable_user_id(): стабильный 64-битный ключ для строкового id (blake2b, 8 байт).
+  Раньше строки превращались в число через hash(), который в Python случайный
+  для каждого процесса: тот же веб-пользователь после рестарта или на другом воркере
+  получал новую строку в users и терял память. Целые id (Telegram) остаются как есть.
+- Таблица user_identities: (channel, external_id) -> users.id, уникальный индекс
+  по (channel, external_id). Вход из любого канала резолвится через неё; новая связка
+  получает пользователя по user_key(): один и тот же id в разных каналах — разные люди.
+- IdentityCache: LRU уже разрешённых (channel, external_id) -> (user_id, username) в памяти
+  процесса; на горячем пути хода пользователь не ищется в БД вообще.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Union
+
+from app.config import IDENTITY_CACHE_SIZE
+
+ExternalId = Union[int, str]
+IdentityKey = Tuple[str, str]  # (channel, external_id)
+
+# users.telegram_id — BigInteger со знаком: держим ключ в 63 битах
+_KEY_MASK = (1 << 63) - 1
+
+
+def stable_user_id(raw_id: ExternalId) -> int:
+    """
+    Детерминированное целое для внешнего id: одинаковое во всех процессах и после рестарта.
+    """
+    if isinstance(raw_id, int):
+        return raw_id
+    digest = hashlib.blake2b(raw_id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") & _KEY_MASK
+
+
+def legacy_user_key(raw_id: ExternalId) -> int:
+    """
+    Ключ в users.telegram_id, под которым пользователь жил до user_identities:
+    числовой id (в том числе строкой "12345") — сам id, иначе stable_user_id.
+    """
+    if isinstance(raw_id, str) and raw_id.isdigit():
+        return int(raw_id)
+    return stable_user_id(raw_id)
+
+
+# каналы, которые писали в users.telegram_id до user_identities, и вид их id
+def _legacy_owner(channel: str, external_id: ExternalId) -> bool:
+    if channel == "telegram":
+        return isinstance(external_id, int) or str(external_id).lstrip("-").isdigit()
+    if channel == "whatsapp":
+        return str(external_id).startswith("wa:")
+    return False
+
+
+def user_key(channel: str, external_id: ExternalId) -> int:
+    """
+    users.telegram_id для новой связки (channel, external_id).
+    Исторический ключ (legacy_user_key) — только каналу, который его записал: числовой id
+    в telegram, "wa:..." в whatsapp. Остальные получают ключ в пространстве своего канала,
+    иначе web-пользователь 777 попал бы в историю Telegram-пользователя 777.
+    """
+    channel = channel or "default"
+    if _legacy_owner(channel, external_id):
+        return legacy_user_key(external_id)
+    return stable_user_id(f"{channel}:{external_id}")
+
+
+def identity_key(channel: str, external_id: ExternalId) -> IdentityKey:
+    return (channel or "default", str(external_id))
+
+
+class IdentityCache:
+    def __init__(self, max_size: int = 100_000):
+        self.max_size = max_size  # 0 — выключен
+
+        self._entries: "OrderedDict[IdentityKey, Tuple[int, Optional[str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: IdentityKey) -> Optional[Tuple[int, Optional[str]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: IdentityKey, user_id: int, username: Optional[str]) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (user_id, username)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def forget(self, key: IdentityKey) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+identity_cache = IdentityCache(max_size=IDENTITY_CACHE_SIZE)
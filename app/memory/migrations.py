@@ -0,0 +1,180 @@
+# app/memory/migrations.py
+
+"""
+Простые версионные миграции схемы (без Alembic).
+
+create_all() умеет только создавать новые таблицы, но не меняет существующие.
+Всё, что касается уже живых БД (новые колонки, индексы, конвертация данных),
+описываем здесь шагами с номером версии. Применённые версии храним в таблице
+schema_migrations, каждый шаг выполняется в своей транзакции.
+
+Шаги должны быть идемпотентными: на свежей БД create_all() уже создал
+актуальную схему, и шаг не должен на этом падать. Это же позволяет нескольким
+воркерам стартовать одновременно: проигравший гонку просто пропускает шаг.
+
+Запуск вручную: python -m app.memory.migrations
+"""
+
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+
+
+def _has_column(conn: Connection, table: str, column: str) -> bool:
+    return any(col["name"] == column for col in inspect(conn).get_columns(table))
+
+
+def _add_column_if_missing(conn: Connection, table: str, column: str, ddl: str) -> None:
+    if not _has_column(conn, table, column):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+# --- шаги ---
+
+def _m001_binary_embeddings(conn: Connection) -> None:
+    """
+    documents.embedding: JSON-текст -> бинарный формат (app/rag/vectors.py).
+    """
+    from app.config import EMBEDDING_MODEL, EMBEDDING_STORAGE_DTYPE
+    from app.rag.vectors import encode_embedding, decode_embedding, is_binary_embedding
+
+    if conn.dialect.name == "postgresql":
+        col_type = next(
+            col["type"] for col in inspect(conn).get_columns("documents") if col["name"] == "embedding"
+        )
+        if col_type.__class__.__name__.upper() != "BYTEA":
+            conn.execute(text(
+                "ALTER TABLE documents ALTER COLUMN embedding TYPE BYTEA "
+                "USING convert_to(embedding, 'UTF8')"
+            ))
+
+    rows = conn.execute(text("SELECT id, embedding FROM documents")).all()
+    for doc_id, raw in rows:
+        if raw is None or is_binary_embedding(raw):
+            continue
+        try:
+            vec = decode_embedding(raw)
+        except Exception:
+            # битую строку не трогаем — ретривер её всё равно пропустит
+            continue
+        conn.execute(
+            text("UPDATE documents SET embedding = :emb WHERE id = :id"),
+            {"emb": encode_embedding(vec, EMBEDDING_MODEL, EMBEDDING_STORAGE_DTYPE), "id": doc_id},
+        )
+
+
+def _m002_document_sources(conn: Connection) -> None:
+    """
+    documents.source_id -> document_sources (сама таблица создаётся через create_all).
+    """
+    _add_column_if_missing(
+        conn,
+        "documents",
+        "source_id",
+        "INTEGER REFERENCES document_sources(id) ON DELETE CASCADE",
+    )
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_documents_source_id ON documents (source_id)"))
+
+
+def _m003_document_chunks(conn: Connection) -> None:
+    """
+    documents: номер фрагмента и смещение в исходном файле.
+    Старые строки — это целые файлы, т.е. фрагмент 0 со смещением 0.
+    """
+    _add_column_if_missing(conn, "documents", "chunk_index", "INTEGER NOT NULL DEFAULT 0")
+    _add_column_if_missing(conn, "documents", "char_offset", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _m004_messages_user_created_index(conn: Connection) -> None:
+    """
+    Составной индекс под выборку истории: WHERE user_id = ? ORDER BY created_at DESC.
+    """
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_messages_user_id_created_at ON messages (user_id, created_at)"
+    ))
+    if conn.dialect.name == "sqlite":
+        conn.execute(text("ANALYZE messages"))
+
+
+def _m005_message_token_count(conn: Connection) -> None:
+    """
+    Кэш числа токенов сообщения. Старые строки остаются NULL — считаются при чтении.
+    """
+    _add_column_if_missing(conn, "messages", "token_count", "INTEGER")
+
+
+def _m006_text_user_keys(conn: Connection) -> None:
+    """
+    users.telegram_id: строковые id (например "wa:7999...@c.us"), которые SQLite молча
+    сохранял текстом в BigInteger-колонку, -> стабильный 64-битный ключ (app/memory/identity.py).
+    Если такой ключ уже занят другой строкой, запись не трогаем.
+    """
+    if conn.dialect.name != "sqlite":
+        return  # другие СУБД такие значения не принимали
+    from app.memory.identity import legacy_user_key
+
+    rows = conn.execute(text("SELECT id, telegram_id FROM users WHERE typeof(telegram_id) = 'text'")).fetchall()
+    for user_id, raw_id in rows:
+        key = legacy_user_key(raw_id)
+        taken = conn.execute(text("SELECT 1 FROM users WHERE telegram_id = :k"), {"k": key}).first()
+        if taken is None:
+            conn.execute(text("UPDATE users SET telegram_id = :k WHERE id = :id"), {"k": key, "id": user_id})
+
+
+def _m007_document_pending(conn: Connection) -> None:
+    """
+    documents.pending: фрагменты незаконченной переиндексации файла не видны поиску.
+    """
+    _add_column_if_missing(conn, "documents", "pending", "BOOLEAN NOT NULL DEFAULT 0")
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "binary_embeddings", _m001_binary_embeddings),
+    (2, "document_sources", _m002_document_sources),
+    (3, "document_chunks", _m003_document_chunks),
+    (4, "messages_user_created_index", _m004_messages_user_created_index),
+    (5, "message_token_count", _m005_message_token_count),
+    (6, "text_user_keys", _m006_text_user_keys),
+    (7, "document_pending", _m007_document_pending),
+]
+
+
+def run_migrations(engine: Engine) -> List[int]:
+    """
+    Применяем все ещё не применённые шаги. Возвращаем список применённых версий.
+    """
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL, applied_at TIMESTAMP)"
+        ))
+        applied = {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+    done = []
+    for version, name, step in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            with engine.begin() as conn:
+                step(conn)
+                conn.execute(
+                    text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:v, :n, :t)"),
+                    {"v": version, "n": name, "t": datetime.utcnow()},
+                )
+        except IntegrityError:
+            # шаг параллельно применил другой воркер (шаги идемпотентны)
+            continue
+        done.append(version)
+    return done
+
+
+if __name__ == "__main__":
+    from app.memory.db import engine, migrate_db
+
+    migrate_db()
+    with engine.connect() as conn:
+        versions = [row[0] for row in conn.execute(text("SELECT version FROM schema_migrations ORDER BY version"))]
+    print(f"Миграции применены. Версии схемы: {versions}")
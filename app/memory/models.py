@@ -10,10 +10,15 @@ from sqlalchemy import (
     DateTime,
     ForeignKey,
     Text,
+    LargeBinary,
+    Float,
+    Boolean,
+    Index,
+    UniqueConstraint,
 )
 from sqlalchemy.orm import relationship
 
-from app.memory.db import Base, engine
+from app.memory.db import Base, migrate_db
 
 
 class User(Base):
@@ -35,6 +40,36 @@ class User(Base):
         back_populates="user",
         cascade="all, delete-orphan",
     )
+    identities = relationship(
+        "UserIdentity",
+        back_populates="user",
+        cascade="all, delete-orphan",
+    )
+
+
+class UserIdentity(Base):
+    """
+    Внешний id пользователя в канале ("telegram" / "web" / "whatsapp" ...) -> users.id.
+    users.telegram_id остаётся историческим ключом (см. app/memory/identity.py).
+    """
+    __tablename__ = "user_identities"
+
+    id = Column(Integer, primary_key=True)
+    channel = Column(String(32), nullable=False)
+    external_id = Column(String(255), nullable=False)
+    user_id = Column(
+        Integer,
+        ForeignKey("users.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    user = relationship("User", back_populates="identities")
+
+    __table_args__ = (
+        UniqueConstraint("channel", "external_id", name="uq_user_identities_channel_external_id"),
+    )
 
 
 class Message(Base):
@@ -48,29 +83,97 @@ class Message(Base):
     )
     role = Column(String(20), nullable=False)  # "user" или "assistant"
     content = Column(Text, nullable=False)
+    # число токенов content (app/tokenizer.py), чтобы не считать его на каждом ходу
+    token_count = Column(Integer, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow, index=True)
 
     user = relationship("User", back_populates="messages")
 
+    __table_args__ = (
+        # горячий запрос: WHERE user_id = ? ORDER BY created_at DESC LIMIT N
+        Index("ix_messages_user_id_created_at", "user_id", "created_at"),
+    )
+
+
+class ConversationSummary(Base):
+    """
+    Сжатая история диалога: всё, что было до covered_until включительно,
+    пересказано в summary. В промпт идёт summary + несколько последних сообщений.
+    """
+    __tablename__ = "conversation_summaries"
+
+    user_id = Column(
+        Integer,
+        ForeignKey("users.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    summary = Column(Text, nullable=False)
+    covered_until = Column(DateTime, nullable=False)  # created_at последнего пересказанного сообщения
+    message_count = Column(Integer, nullable=False, default=0)  # сколько сообщений пересказано всего
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class ProcessedWebhook(Base):
+    """
+    idMessage входящих сообщений Green API, которые уже приняты в обработку.
+    Green API повторяет вебхук, если не дождался ответа, — по этой таблице повтор
+    отбрасывается даже тогда, когда его принял другой воркер.
+    """
+    __tablename__ = "processed_webhooks"
+
+    message_id = Column(String(128), primary_key=True)
+    received_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+
+class DocumentSource(Base):
+    """
+    Исходный файл базы знаний. По хэшу/mtime понимаем, нужно ли его переиндексировать.
+    """
+    __tablename__ = "document_sources"
+
+    id = Column(Integer, primary_key=True, index=True)
+    path = Column(String(1024), unique=True, nullable=False)  # путь относительно data/docs
+    content_hash = Column(String(64), nullable=False)  # sha256 содержимого
+    mtime = Column(Float, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    indexed_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    documents = relationship(
+        "Document",
+        back_populates="source",
+        cascade="all, delete-orphan",
+    )
+
 
 class Document(Base):
     __tablename__ = "documents"
 
     id = Column(Integer, primary_key=True, index=True)
+    source_id = Column(
+        Integer,
+        ForeignKey("document_sources.id", ondelete="CASCADE"),
+        nullable=True,  # NULL — строки, проиндексированные до появления document_sources
+        index=True,
+    )
     title = Column(String(255), index=True)
+    # Документ = фрагмент исходного файла: номер фрагмента и смещение (в символах)
+    chunk_index = Column(Integer, nullable=False, default=0)
+    char_offset = Column(Integer, nullable=False, default=0)
     content = Column(Text, nullable=False)
-    # Храним embedding как JSON-строку (для SQLite это самый простой вариант)
-    embedding = Column(Text, nullable=False)
+    # Бинарный формат из app/rag/vectors.py (старые строки могут быть JSON-текстом)
+    embedding = Column(LargeBinary, nullable=False)
+    # True — фрагмент новой версии файла, индексация которого ещё идёт: в поиск не попадает,
+    # подменяет старые фрагменты одной короткой транзакцией в конце файла (app/rag/index_docs.py)
+    pending = Column(Boolean, nullable=False, default=False, server_default="0")
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    source = relationship("DocumentSource", back_populates="documents")
+
 
 def init_db():
     """
-    Создаём таблицы, если их ещё нет.
-    ВАЖНО: вызываем после ОПРЕДЕЛЕНИЯ всех моделей.
+    Создаём таблицы и применяем миграции.
+    Не вызывается при импорте: это делают точки входа (сервер, бот, скрипты)
+    или вручную: python -m app.memory.migrations
     """
-    Base.metadata.create_all(bind=engine)
-
-
-# вызываем после определения User, Message, Document
-init_db()
+    migrate_db()
@@ -1,12 +1,21 @@
 # app/memory/repository.py
 
-from typing import List, Optional
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple, Union
 
-from sqlalchemy import select, desc
+from sqlalchemy import select, desc, func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from app.memory.db import SessionLocal
-from app.memory.models import User, Message
+from app.config import HISTORY_CACHE_VALIDATE, SUMMARY_ENABLED
+from app.memory.db import SessionLocal, run_in_db_thread
+from app.memory.history_cache import history_cache
+from app.memory.identity import identity_cache, identity_key, user_key
+from app.memory.models import User, UserIdentity, Message, ConversationSummary
+from app.tokenizer import count_tokens
+
+Row = Tuple[int, str, str, datetime]  # (user_id, role, content, created_at)
 
 
 def get_session() -> Session:
@@ -17,27 +26,101 @@ def get_session() -> Session:
     return SessionLocal()
 
 
+def _get_or_create_user(session: Session, telegram_id: int, username: Optional[str]) -> User:
+    stmt = select(User).where(User.telegram_id == telegram_id)
+    user = session.execute(stmt).scalar_one_or_none()
+
+    if user is None:
+        user = User(telegram_id=telegram_id, username=username)
+        session.add(user)
+        try:
+            session.commit()
+            session.refresh(user)
+        except IntegrityError:
+            # параллельный запрос (другой поток/воркер) успел создать пользователя
+            session.rollback()
+            user = session.execute(stmt).scalar_one()
+    else:
+        _update_username(session, user, username)
+
+    return user
+
+
+def _update_username(session: Session, user: User, username: Optional[str]) -> None:
+    # Обновим username, если он изменился
+    if username and user.username != username:
+        user.username = username
+        session.commit()
+        session.refresh(user)
+
+
+def _resolve_user(
+    session: Session,
+    channel: str,
+    external_id: Union[int, str],
+    username: Optional[str],
+) -> Tuple[int, Optional[str]]:
+    """
+    (channel, external_id) -> (users.id, username).
+    Горячий путь — кэш процесса без запросов к БД; дальше user_identities;
+    первый вход — пользователь по user_key() (исторический ключ — только для канала,
+    который его записал, иначе новый в пространстве канала) и новая строка user_identities.
+    """
+    key = identity_key(channel, external_id)
+    cached = identity_cache.get(key)
+    if cached is not None:
+        user_id, known_username = cached
+        if not username or username == known_username:
+            return user_id, known_username
+        user = session.get(User, user_id)
+        if user is not None:
+            _update_username(session, user, username)
+            identity_cache.put(key, user.id, user.username)
+            return user.id, user.username
+        identity_cache.forget(key)
+
+    stmt = (
+        select(User)
+        .join(UserIdentity, UserIdentity.user_id == User.id)
+        .where(UserIdentity.channel == key[0], UserIdentity.external_id == key[1])
+    )
+    user = session.execute(stmt).scalar_one_or_none()
+    if user is not None:
+        _update_username(session, user, username)
+    else:
+        user = _get_or_create_user(session, user_key(key[0], external_id), username)
+        session.add(UserIdentity(channel=key[0], external_id=key[1], user_id=user.id))
+        try:
+            session.commit()
+        except IntegrityError:
+            # ту же связку параллельно записал другой поток/воркер
+            session.rollback()
+            user = session.execute(stmt).scalar_one()
+
+    identity_cache.put(key, user.id, user.username)
+    return user.id, user.username
+
+
+def _last_messages(session: Session, user_id: int, limit: int) -> List[Message]:
+    stmt = (
+        select(Message)
+        .where(Message.user_id == user_id)
+        .order_by(desc(Message.created_at), desc(Message.id))
+        .limit(limit)
+    )
+    result = session.execute(stmt).scalars().all()
+
+    # Мы забирали по убыванию, нужно развернуть обратно
+    return list(reversed(result))
+
+
 def get_or_create_user(telegram_id: int, username: Optional[str] = None) -> User:
     """
     Находим пользователя по telegram_id.
     Если его нет — создаём.
     """
     with get_session() as session:
-        stmt = select(User).where(User.telegram_id == telegram_id)
-        user = session.execute(stmt).scalar_one_or_none()
-
-        if user is None:
-            user = User(telegram_id=telegram_id, username=username)
-            session.add(user)
-            session.commit()
-            session.refresh(user)
-        else:
-            # Обновим username, если он изменился
-            if username and user.username != username:
-                user.username = username
-                session.commit()
-
-        return user
+        return _get_or_create_user(session, telegram_id, username)
 
 
 def add_message(user_id: int, role: str, content: str) -> None:
@@ -45,9 +128,37 @@ def add_message(user_id: int, role: str, content: str) -> None:
     Сохраняем новое сообщение в БД.
     """
     with get_session() as session:
-        msg = Message(user_id=user_id, role=role, content=content)
+        msg = Message(
+            user_id=user_id,
+            role=role,
+            content=content,
+            token_count=count_tokens(content),
+            created_at=datetime.utcnow(),
+        )
         session.add(msg)
         session.commit()
+        history_cache.append(user_id, role, content, msg.created_at, msg.token_count)
+
+
+def add_messages(rows: Iterable[Row]) -> int:
+    """
+    Пачка сообщений (user_id, role, content, created_at) одним коммитом.
+    Число токенов считаем здесь — в потоке БД, а не в event loop.
+    """
+    with get_session() as session:
+        msgs = [
+            Message(
+                user_id=user_id,
+                role=role,
+                content=content,
+                token_count=count_tokens(content),
+                created_at=created_at,
+            )
+            for user_id, role, content, created_at in rows
+        ]
+        session.add_all(msgs)
+        session.commit()
+        return len(msgs)
 
 
 def get_last_messages(user_id: int, limit: int = 10) -> List[Message]:
@@ -56,13 +167,122 @@ def get_last_messages(user_id: int, limit: int = 10) -> List[Message]:
     отсортированные по времени по возрастанию (от старых к новым).
     """
     with get_session() as session:
-        stmt = (
-            select(Message)
-            .where(Message.user_id == user_id)
-            .order_by(desc(Message.created_at))
-            .limit(limit)
+        return _last_messages(session, user_id, limit)
+
+
+# --- unit of work на один ход диалога ---
+
+@dataclass
+class TurnContext:
+    user_id: int
+    username: Optional[str]
+    history: List  # Message или CachedMessage: у обоих есть role / content / created_at
+    summary: Optional[str] = None  # пересказ истории до summary_until включительно
+    summary_until: Optional[datetime] = None
+
+
+def merge_pending(history: List, pending: List[Row], user_id: int, limit: int) -> List:
+    """
+    Добавляем к истории ещё не записанные сообщения пользователя из write-behind очереди
+    (без дублей, если запись успела пройти между снимком очереди и чтением БД)
+    и оставляем последние limit.
+    """
+    seen = {(m.role, m.content, m.created_at) for m in history}
+    extra = [
+        Message(user_id=uid, role=role, content=content, created_at=created_at)
+        for uid, role, content, created_at in pending
+        if uid == user_id and (role, content, created_at) not in seen
+    ]
+    if not extra:
+        return history
+    merged = list(history) + extra
+    return merged[-limit:] if limit > 0 else merged
+
+
+def _cached_history(session: Session, user_id: int):
+    """
+    История из кэша процесса, если она там есть и не устарела.
+    Проверка — один запрос по индексу (user_id, created_at), без чтения самих сообщений.
+    """
+    cached = history_cache.get(user_id)
+    if cached is None or not HISTORY_CACHE_VALIDATE:
+        return cached
+
+    db_last = session.execute(
+        select(func.max(Message.created_at)).where(Message.user_id == user_id)
+    ).scalar_one_or_none()
+    cache_last = cached[-1].created_at if cached else None
+    if db_last is not None and (cache_last is None or db_last > cache_last):
+        # другой воркер дописал историю — перечитываем
+        history_cache.mark_stale(user_id)
+        return None
+    return cached
+
+
+def load_turn(
+    external_id: Union[int, str],
+    username: Optional[str] = None,
+    limit: int = 10,
+    pending: Optional[List[Row]] = None,
+    channel: str = "telegram",
+) -> TurnContext:
+    """
+    Начало хода: пользователь + история — одна сессия, одна короткая транзакция чтения
+    (плюс коммит, только если пользователя пришлось создать/обновить).
+    Пользователь — по (channel, external_id) через кэш идентичностей,
+    история — из кэша процесса, в БД идём только при промахе.
+    pending — снимок write-behind очереди, сделанный до вызова.
+    """
+    use_cache = history_cache.enabled and limit <= history_cache.max_messages
+
+    with get_session() as session:
+        user_id, user_name = _resolve_user(session, channel, external_id, username)
+
+        history = _cached_history(session, user_id) if use_cache else None
+        if history is None:
+            fetched = _last_messages(session, user_id, history_cache.max_messages if use_cache else limit)
+            history = merge_pending(fetched, pending or [], user_id, 0)
+            if use_cache:
+                history = history_cache.set(user_id, history)
+        else:
+            history = merge_pending(history, pending or [], user_id, 0)
+
+        summary = session.get(ConversationSummary, user_id) if SUMMARY_ENABLED else None
+
+        return TurnContext(
+            user_id=user_id,
+            username=user_name,
+            history=history[-limit:] if limit > 0 else [],
+            summary=summary.summary if summary is not None else None,
+            summary_until=summary.covered_until if summary is not None else None,
         )
-        result = session.execute(stmt).scalars().all()
 
-        # Мы забирали по убыванию, нужно развернуть обратно
-        return list(reversed(result))
+
+def save_turn(user_id: int, user_text: str, answer: str) -> None:
+    """
+    Конец хода: вопрос и ответ — одной транзакцией, один коммит (один fsync).
+    Порядок внутри хода при равном created_at держится на id (см. _last_messages).
+    """
+    now = datetime.utcnow()
+    add_messages([
+        (user_id, "user", user_text, now),
+        (user_id, "assistant", answer, now),
+    ])
+    history_cache.append(user_id, "user", user_text, now, count_tokens(user_text))
+    history_cache.append(user_id, "assistant", answer, now, count_tokens(answer))
+
+
+# --- async-обёртки: синхронный код выполняется в пуле потоков БД ---
+
+async def aload_turn(
+    external_id: Union[int, str],
+    username: Optional[str] = None,
+    limit: int = 10,
+    pending: Optional[List[Row]] = None,
+    channel: str = "telegram",
+) -> TurnContext:
+    return await run_in_db_thread(load_turn, external_id, username, limit, pending, channel)
+
+
+async def asave_turn(user_id: int, user_text: str, answer: str) -> None:
+    await run_in_db_thread(save_turn, user_id, user_text, answer)
@@ -0,0 +1,330 @@
+# app/memory/retention.py
+
+"""
+Хранение истории диалогов: таблица messages не должна расти бесконечно.
+
+Политика:
+- на пользователя храним не больше RETENTION_MAX_MESSAGES_PER_USER последних сообщений;
+- сообщения старше RETENTION_MAX_AGE_DAYS удаляем у всех.
+По умолчанию оба лимита и RETENTION_INTERVAL равны 0 — ничего не удаляется, фоновой
+задачи нет. Включается явно в .env (лимиты + RETENTION_INTERVAL, см. .env.example).
+
+Удаляемые строки сначала дописываются в сжатый JSONL-архив
+(RETENTION_ARCHIVE_DIR/messages-<время>.jsonl.zst или .jsonl.gz, одна строка — одно сообщение),
+потом удаляются из БД. Работаем пачками по RETENTION_BATCH_SIZE строк, каждая пачка —
+своя короткая транзакция, чтобы не держать блокировку записи SQLite надолго.
+Архив сбрасывается на диск до коммита удаления: при падении в архиве могут оказаться
+дубли, но не потери.
+
+После чистки — ANALYZE (статистика для планировщика) и, если в файле БД много
+свободных страниц, VACUUM. Так горячая таблица и её индексы помещаются в page cache.
+
+Запуск:
+- в сервере — фоновой задачей раз в RETENTION_INTERVAL секунд (см. lifespan);
+- вручную / из cron: python -m app.memory.retention [--dry-run]
+При запуске отдельным процессом кэш истории в воркерах не сбрасывается: удалённые
+старые сообщения могут ещё мелькать там до истечения HISTORY_CACHE_TTL.
+"""
+
+import argparse
+import asyncio
+import gzip
+import io
+import json
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import delete, desc, func, select, text
+
+from app.config import (
+    RETENTION_MAX_MESSAGES_PER_USER,
+    RETENTION_MAX_AGE_DAYS,
+    RETENTION_ARCHIVE_FORMAT,
+    RETENTION_ARCHIVE_DIR,
+    RETENTION_BATCH_SIZE,
+    RETENTION_INTERVAL,
+    RETENTION_VACUUM_MIN_FREE,
+)
+from app.memory.db import SessionLocal, engine, migrate_db, run_in_db_thread
+from app.memory.history_cache import history_cache
+from app.memory.models import Message
+
+try:  # zstd сжимает JSONL заметно лучше и быстрее gzip, но это необязательная зависимость
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+def _archive_format(fmt: str) -> str:
+    if fmt == "auto":
+        return "zstd" if zstandard is not None else "gzip"
+    if fmt == "zstd" and zstandard is None:
+        print("RETENTION_ARCHIVE_FORMAT=zstd, но пакет zstandard не установлен — пишем gzip")
+        return "gzip"
+    return fmt
+
+
+class _ArchiveWriter:
+    """
+    JSONL-архив удалённых сообщений. Файл создаётся при первой записи.
+    """
+
+    def __init__(self, directory: Path, fmt: str):
+        self.directory = Path(directory)
+        self.fmt = _archive_format(fmt)
+        self.path: Optional[Path] = None
+        self.written = 0
+        self._raw = None
+        self._stream = None
+
+    def _open(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        if self.fmt == "zstd":
+            self.path = self.directory / f"messages-{stamp}.jsonl.zst"
+            self._raw = open(self.path, "ab")
+            compressed = zstandard.ZstdCompressor(level=10).stream_writer(self._raw, closefd=False)
+            self._stream = io.TextIOWrapper(compressed, encoding="utf-8")
+        else:
+            self.path = self.directory / f"messages-{stamp}.jsonl.gz"
+            self._raw = open(self.path, "ab")
+            self._stream = io.TextIOWrapper(gzip.GzipFile(fileobj=self._raw, mode="ab"), encoding="utf-8")
+
+    def write(self, messages: List[Message]) -> None:
+        if self.fmt == "none" or not messages:
+            return
+        if self._stream is None:
+            self._open()
+        for m in messages:
+            record = {
+                "id": m.id,
+                "user_id": m.user_id,
+                "role": m.role,
+                "content": m.content,
+                "created_at": m.created_at.isoformat() if m.created_at else None,
+            }
+            self._stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.written += len(messages)
+        self.flush()
+
+    def flush(self) -> None:
+        """
+        Сбрасываем всё записанное на диск (до коммита удаления в БД).
+        """
+        if self._stream is None:
+            return
+        self._stream.flush()
+        compressed = self._stream.buffer
+        if self.fmt == "zstd":
+            compressed.flush(zstandard.FLUSH_FRAME)
+        else:
+            compressed.flush()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+
+    def close(self) -> None:
+        if self._stream is not None:
+            self._stream.close()  # закрывает и компрессор
+            self._raw.close()
+            self._stream = None
+
+
+def _purge_batch(session, messages: List[Message], archive: _ArchiveWriter, affected: Set[int]) -> int:
+    archive.write(messages)
+    ids = [m.id for m in messages]
+    session.execute(delete(Message).where(Message.id.in_(ids)))
+    session.commit()
+    affected.update(m.user_id for m in messages)
+    return len(ids)
+
+
+def _purge_old(session, cutoff: datetime, batch: int, archive: _ArchiveWriter, affected: Set[int], dry_run: bool) -> int:
+    """
+    Сообщения старше cutoff — по индексу created_at.
+    """
+    if dry_run:
+        return session.execute(select(func.count()).where(Message.created_at < cutoff)).scalar_one()
+    total = 0
+    while True:
+        messages = session.execute(
+            select(Message).where(Message.created_at < cutoff).order_by(Message.id).limit(batch)
+        ).scalars().all()
+        if not messages:
+            return total
+        total += _purge_batch(session, messages, archive, affected)
+
+
+def _purge_over_cap(session, cap: int, batch: int, archive: _ArchiveWriter, affected: Set[int], dry_run: bool) -> int:
+    """
+    Всё, что у пользователя дальше cap последних сообщений, — по индексу (user_id, created_at).
+    """
+    over = session.execute(
+        select(Message.user_id, func.count()).group_by(Message.user_id).having(func.count() > cap)
+    ).all()
+    if dry_run:
+        return sum(count - cap for _, count in over)
+    total = 0
+    for user_id, _ in over:
+        while True:
+            messages = session.execute(
+                select(Message)
+                .where(Message.user_id == user_id)
+                .order_by(desc(Message.created_at), desc(Message.id))
+                .offset(cap)
+                .limit(batch)
+            ).scalars().all()
+            if not messages:
+                break
+            total += _purge_batch(session, messages, archive, affected)
+    return total
+
+
+def compact_db(vacuum_min_free: float = RETENTION_VACUUM_MIN_FREE) -> Dict[str, object]:
+    """
+    ANALYZE всегда; VACUUM — только если свободных страниц достаточно много
+    (VACUUM переписывает весь файл и на это время блокирует запись).
+    """
+    result: Dict[str, object] = {"vacuum": False}
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        if conn.dialect.name != "sqlite":
+            conn.execute(text("VACUUM ANALYZE messages") if conn.dialect.name == "postgresql" else text("ANALYZE"))
+            return result
+
+        conn.execute(text("ANALYZE"))
+        pages = conn.execute(text("PRAGMA page_count")).scalar_one()
+        free = conn.execute(text("PRAGMA freelist_count")).scalar_one()
+        result["free_ratio"] = round(free / pages, 4) if pages else 0.0
+        if pages and free / pages >= vacuum_min_free:
+            conn.execute(text("VACUUM"))
+            if conn.execute(text("PRAGMA journal_mode")).scalar_one() == "wal":
+                conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+            result["vacuum"] = True
+    return result
+
+
+def run_retention(
+    max_per_user: int = RETENTION_MAX_MESSAGES_PER_USER,
+    max_age_days: int = RETENTION_MAX_AGE_DAYS,
+    archive_format: str = RETENTION_ARCHIVE_FORMAT,
+    archive_dir: Path = RETENTION_ARCHIVE_DIR,
+    batch: int = RETENTION_BATCH_SIZE,
+    dry_run: bool = False,
+) -> Dict[str, object]:
+    """
+    Один проход политики хранения + компактизация. Возвращаем сводку.
+    """
+    batch = max(1, batch)
+    archive = _ArchiveWriter(archive_dir, archive_format)
+    affected: Set[int] = set()
+    summary: Dict[str, object] = {"dry_run": dry_run}
+
+    try:
+        with SessionLocal() as session:
+            summary["by_age"] = (
+                _purge_old(session, datetime.utcnow() - timedelta(days=max_age_days), batch, archive, affected, dry_run)
+                if max_age_days > 0 else 0
+            )
+            summary["by_cap"] = (
+                _purge_over_cap(session, max_per_user, batch, archive, affected, dry_run)
+                if max_per_user > 0 else 0
+            )
+    finally:
+        archive.close()
+        # history_cache держит только хвост истории, но при маленьком cap/возрасте
+        # удалённое могло попасть и туда — перечитаем при следующем ходе
+        for user_id in affected:
+            history_cache.invalidate(user_id)
+
+    summary["users"] = len(affected)
+    summary["archive"] = str(archive.path) if archive.path else None
+    if not dry_run:
+        summary.update(compact_db())
+    return summary
+
+
+class RetentionJob:
+    """
+    Фоновый запуск run_retention раз в interval секунд (в пуле потоков БД).
+    """
+
+    def __init__(self, interval: float = RETENTION_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+        self.runs = 0
+        self.deleted = 0
+        self.errors = 0
+        self.last_run: Optional[datetime] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        if self.running or self.interval <= 0:
+            return
+        if RETENTION_MAX_MESSAGES_PER_USER <= 0 and RETENTION_MAX_AGE_DAYS <= 0:
+            print("Retention: RETENTION_INTERVAL задан, но лимиты равны 0 — фоновая чистка не запущена")
+            return
+        self._task = asyncio.create_task(self._run(), name="messages-retention")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run_once(self) -> Dict[str, object]:
+        summary = await run_in_db_thread(run_retention)
+        self.runs += 1
+        self.deleted += summary["by_age"] + summary["by_cap"]
+        self.last_run = datetime.utcnow()
+        return summary
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                summary = await self.run_once()
+                print("Retention:", summary)
+            except Exception as e:
+                self.errors += 1
+                print("Retention: проход не удался:", repr(e))
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "runs": self.runs,
+            "deleted": self.deleted,
+            "errors": self.errors,
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+        }
+
+
+retention_job = RetentionJob()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Чистка и архивирование старых сообщений")
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать, что будет удалено")
+    parser.add_argument("--max-per-user", type=int, default=RETENTION_MAX_MESSAGES_PER_USER)
+    parser.add_argument("--max-age-days", type=int, default=RETENTION_MAX_AGE_DAYS)
+    args = parser.parse_args()
+
+    migrate_db()
+    summary = run_retention(
+        max_per_user=args.max_per_user,
+        max_age_days=args.max_age_days,
+        dry_run=args.dry_run,
+    )
+    for key, value in summary.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
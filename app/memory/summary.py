@@ -0,0 +1,266 @@
+# app/memory/summary.py
+
+"""
+Скользящий пересказ диалога (rolling summary).
+
+Вместо полного текста последних HISTORY_LIMIT сообщений в промпт идёт:
+- пересказ всего, что было раньше (таблица conversation_summaries);
+- последние сообщения после пересказа — сколько влезет в HISTORY_TOKEN_BUDGET
+  (сборка промпта — app/context.py).
+
+Пересказ обновляется фоновой задачей после ответа пользователю (не на пути ответа):
+когда за пересказом накопилось хотя бы SUMMARY_MIN_BATCH сообщений сверх
+SUMMARY_KEEP_RECENT последних (или они перестали влезать в бюджет), старые
+сообщения дописываются в пересказ одним запросом к LLM.
+
+Пересказ двигается только вперёд: запись — compare-and-set по covered_until,
+поэтому две параллельные задачи (два воркера) не затрут друг друга.
+"""
+
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import desc, select
+from sqlalchemy.exc import IntegrityError
+
+from app.config import (
+    SUMMARY_ENABLED,
+    SUMMARY_MODEL,
+    SUMMARY_KEEP_RECENT,
+    SUMMARY_MIN_BATCH,
+    SUMMARY_MAX_TOKENS,
+    HISTORY_TOKEN_BUDGET,
+)
+from app.llm_client import complete
+from app.memory.db import SessionLocal, run_in_db_thread
+from app.memory.models import ConversationSummary, Message
+from app.tokenizer import count_tokens, message_tokens
+
+# сколько непересказанных сообщений читаем за один проход (и длина каждого в пересказе)
+_MAX_FOLD_MESSAGES = 100
+_MAX_FOLD_CHARS = 2000
+
+_SUMMARY_SYSTEM_PROMPT = (
+    "Ты ведёшь конспект переписки ассистента студии AINOVA с клиентом. "
+    "Обнови конспект, дописав в него новые сообщения. Сохрани: что известно о клиенте "
+    "(имя, компания, контакты), его задачи и вопросы, что ему уже ответили и предложили, "
+    "договорённости, цифры, открытые вопросы. Без приветствий и воды, от третьего лица, "
+    f"по-русски, не длиннее {SUMMARY_MAX_TOKENS // 2} слов. Верни только текст конспекта."
+)
+
+_ROLE_LABELS = {"user": "Клиент", "assistant": "Ассистент"}
+
+
+def summary_block(summary: str) -> str:
+    return f"Краткое содержание предыдущего разговора с клиентом:\n{summary}"
+
+
+@dataclass
+class _SummaryState:
+    summary: Optional[str]
+    covered_until: Optional[datetime]
+    message_count: int
+    messages: List[Message]  # ещё не пересказанные, от старых к новым
+
+
+def _load_state(user_id: int) -> _SummaryState:
+    with SessionLocal() as session:
+        row = session.get(ConversationSummary, user_id)
+        stmt = select(Message).where(Message.user_id == user_id)
+        if row is not None:
+            stmt = stmt.where(Message.created_at > row.covered_until)
+        # берём хвост: при первом включении всё, что старше, в промпт и раньше не попадало
+        stmt = stmt.order_by(desc(Message.created_at), desc(Message.id)).limit(_MAX_FOLD_MESSAGES)
+        messages = list(reversed(session.execute(stmt).scalars().all()))
+        return _SummaryState(
+            summary=row.summary if row is not None else None,
+            covered_until=row.covered_until if row is not None else None,
+            message_count=row.message_count if row is not None else 0,
+            messages=messages,
+        )
+
+
+def _store_summary(
+    user_id: int,
+    expected_until: Optional[datetime],
+    summary: str,
+    covered_until: datetime,
+    message_count: int,
+) -> bool:
+    """
+    Compare-and-set: пишем, только если пересказ не сдвинул кто-то другой.
+    """
+    with SessionLocal() as session:
+        row = session.get(ConversationSummary, user_id)
+        if row is None:
+            if expected_until is not None:
+                return False
+            session.add(ConversationSummary(
+                user_id=user_id,
+                summary=summary,
+                covered_until=covered_until,
+                message_count=message_count,
+            ))
+            try:
+                session.commit()
+            except IntegrityError:
+                session.rollback()
+                return False
+            return True
+
+        if row.covered_until != expected_until:
+            return False
+        row.summary = summary
+        row.covered_until = covered_until
+        row.message_count = message_count
+        session.commit()
+        return True
+
+
+def _messages_to_fold(state: _SummaryState, keep_recent: int, min_batch: int, budget_tokens: int) -> List[Message]:
+    messages = state.messages
+    if len(messages) <= keep_recent:
+        return []
+
+    # граница — по created_at: вопрос и ответ одного хода (одинаковое время) не разрываем
+    boundary = messages[-keep_recent - 1].created_at if keep_recent > 0 else messages[-1].created_at
+    fold = [m for m in messages if m.created_at <= boundary]
+
+    used = count_tokens(state.summary or "") + sum(message_tokens(m) for m in messages)
+    if len(fold) < min_batch and used <= budget_tokens:
+        return []
+    return fold
+
+
+def _transcript(messages: List[Message]) -> str:
+    lines = []
+    for m in messages:
+        content = m.content.strip()
+        if len(content) > _MAX_FOLD_CHARS:
+            content = content[:_MAX_FOLD_CHARS].rstrip() + " […]"
+        lines.append(f"{_ROLE_LABELS.get(m.role, m.role)}: {content}")
+    return "\n\n".join(lines)
+
+
+class ConversationSummarizer:
+    def __init__(
+        self,
+        enabled: bool = True,
+        model: str = SUMMARY_MODEL,
+        keep_recent: int = 4,
+        min_batch: int = 6,
+        max_tokens: int = 400,
+        budget_tokens: int = 1500,
+    ):
+        self.enabled = enabled
+        self.model = model
+        self.keep_recent = max(0, keep_recent)
+        self.min_batch = max(1, min_batch)
+        self.max_tokens = max_tokens
+        self.budget_tokens = budget_tokens
+
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+        self.runs = 0
+        self.updated = 0
+        self.folded = 0
+        self.conflicts = 0
+        self.errors = 0
+
+    def schedule(self, user_id: int) -> None:
+        """
+        Запускаем обновление пересказа в фоне. Если для пользователя оно уже идёт —
+        ничего не делаем: следующий ход запустит его снова.
+        """
+        if not self.enabled:
+            return
+        task = self._tasks.get(user_id)
+        if task is not None and not task.done():
+            return
+        task = asyncio.create_task(self._refresh_safe(user_id), name=f"summary-{user_id}")
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda t, uid=user_id: self._tasks.pop(uid, None) if self._tasks.get(uid) is t else None)
+
+    async def refresh(self, user_id: int) -> bool:
+        """
+        Один проход: если старых сообщений накопилось достаточно — дописываем их в пересказ.
+        True — пересказ обновлён.
+        """
+        self.runs += 1
+        state = await run_in_db_thread(_load_state, user_id)
+        fold = _messages_to_fold(state, self.keep_recent, self.min_batch, self.budget_tokens)
+        if not fold:
+            return False
+
+        summary = (await complete(
+            [
+                {"role": "system", "content": _SUMMARY_SYSTEM_PROMPT},
+                {
+                    "role": "user",
+                    "content": (
+                        f"Текущий конспект:\n{state.summary or '(пока пусто)'}\n\n"
+                        f"Новые сообщения:\n{_transcript(fold)}"
+                    ),
+                },
+            ],
+            model=self.model,
+            temperature=0.2,
+            max_tokens=self.max_tokens,
+        )).strip()
+        if not summary:
+            raise RuntimeError("LLM вернула пустой пересказ")
+
+        stored = await run_in_db_thread(
+            _store_summary,
+            user_id,
+            state.covered_until,
+            summary,
+            fold[-1].created_at,
+            state.message_count + len(fold),
+        )
+        if not stored:
+            self.conflicts += 1
+            return False
+        self.updated += 1
+        self.folded += len(fold)
+        return True
+
+    async def _refresh_safe(self, user_id: int) -> None:
+        try:
+            await self.refresh(user_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            print(f"Пересказ истории (user_id={user_id}) не удался:", repr(e))
+
+    async def stop(self) -> None:
+        """
+        Отменяем незавершённые обновления (пересказ не обязателен — догонится на следующем ходу).
+        """
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._tasks),
+            "runs": self.runs,
+            "updated": self.updated,
+            "folded_messages": self.folded,
+            "conflicts": self.conflicts,
+            "errors": self.errors,
+        }
+
+
+summarizer = ConversationSummarizer(
+    enabled=SUMMARY_ENABLED,
+    keep_recent=SUMMARY_KEEP_RECENT,
+    min_batch=SUMMARY_MIN_BATCH,
+    max_tokens=SUMMARY_MAX_TOKENS,
+    budget_tokens=HISTORY_TOKEN_BUDGET,
+)
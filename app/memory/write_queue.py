@@ -0,0 +1,132 @@
+# app/memory/write_queue.py
+
+"""
+Write-behind очередь для сообщений диалогов.
+
+Ход диалога не ждёт записи в БД: сообщения кладутся в очередь, фоновая задача
+раз в MEMORY_WRITE_BEHIND_INTERVAL_MS забирает всё накопленное от всех чатов
+и пишет одним коммитом (group commit). На SQLite это вместо десятков мелких
+транзакций с fsync — одна.
+
+Пока сообщение не записано, оно видно через snapshot(), чтобы следующий ход
+того же пользователя не потерял его в истории. При остановке (stop) очередь
+дописывает всё, что осталось.
+"""
+
+import asyncio
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from app.config import MEMORY_WRITE_BEHIND_INTERVAL_MS, MEMORY_WRITE_BEHIND_MAX_BATCH
+from app.memory.db import run_in_db_thread
+from app.memory.history_cache import history_cache
+from app.memory.repository import Row, add_messages
+
+
+class MessageWriteQueue:
+    def __init__(self, interval_ms: int = 20, max_batch: int = 500):
+        self.interval = interval_ms / 1000.0
+        self.max_batch = max_batch
+
+        self._items: List[Row] = []
+        self._inflight: List[Row] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run(), name="message-write-queue")
+
+    async def stop(self) -> None:
+        """
+        Останавливаем фоновую задачу и дописываем всё, что осталось в очереди.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._items:
+            if not await self.flush():
+                break
+
+    def put(self, user_id: int, role: str, content: str, created_at: Optional[datetime] = None) -> None:
+        created_at = created_at or datetime.utcnow()
+        self._items.append((user_id, role, content, created_at))
+        history_cache.append(user_id, role, content, created_at)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def snapshot(self) -> List[Row]:
+        """
+        Ещё не записанные сообщения всех пользователей.
+        Снимок берём ДО чтения истории из БД: тогда сообщение, записанное
+        между снимком и чтением, попадёт хотя бы в одно из двух мест (дубли убирает repository.merge_pending).
+        """
+        return self._inflight + self._items
+
+    async def flush(self) -> bool:
+        """
+        Пишем накопленное одним коммитом. False — если запись не удалась
+        (сообщения возвращаются в начало очереди и будут записаны в следующий раз).
+        """
+        lock = self._lock or asyncio.Lock()
+        async with lock:
+            if not self._items:
+                return True
+            batch, self._items = self._items[:self.max_batch], self._items[self.max_batch:]
+            self._inflight = batch
+            try:
+                await run_in_db_thread(add_messages, batch)
+            except Exception as e:
+                print("Write-behind: не удалось записать сообщения, повторим:", repr(e))
+                self._items = batch + self._items
+                self.errors += 1
+                return False
+            finally:
+                self._inflight = []
+            self.written += len(batch)
+            self.batches += 1
+            return True
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # даём накопиться сообщениям от других чатов — это и есть group commit
+            await asyncio.sleep(self.interval)
+            ok = await self.flush()
+            if self._items:
+                if not ok:
+                    await asyncio.sleep(max(self.interval, 1.0))
+                self._wakeup.set()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self._items) + len(self._inflight),
+            "written": self.written,
+            "batches": self.batches,
+            "errors": self.errors,
+        }
+
+
+# Общая на процесс очередь. Запускается в lifespan сервера / main() бота,
+# только если включено MEMORY_WRITE_BEHIND.
+write_queue = MessageWriteQueue(
+    interval_ms=MEMORY_WRITE_BEHIND_INTERVAL_MS,
+    max_batch=MEMORY_WRITE_BEHIND_MAX_BATCH,
+)
@@ -1,9 +1,33 @@
 # app/prompts.py
 
+"""
+Промпты из data/prompts, закэшированные в памяти.
+
+Файлы читаются один раз и дальше отдаются из памяти. Не чаще раза в
+PROMPTS_RELOAD_INTERVAL секунд делаем os.stat(): изменились mtime/размер — перечитываем,
+так что правка промпта подхватывается без рестарта, но без чтения диска на каждом ходу.
+
+Наборы промптов по client_id (multi-tenant):
+    data/prompts/system.txt                      — общий
+    data/prompts/clients/<client_id>/system.txt  — свой для клиента (если есть)
+Чего нет у клиента, берётся из общего набора, чего нет и там — встроенный запасной текст.
+Допускается и двойное расширение (system.txt.txt) — так файл сохраняет Windows
+со скрытыми расширениями.
+
+fingerprint(client_id) — хэш текущих текстов набора; меняется при любой правке промпта
+(нужен кэшам, которые зависят от промпта).
+"""
+
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
-from app.config import PROMPTS_DIR
+from app.config import PROMPTS_DIR, PROMPTS_RELOAD_INTERVAL
 
 DEFAULT_SYSTEM_PROMPT_FALLBACK = (
     "Ты AI-ассистент студии AINOVA. Отвечай по делу, простым языком."
@@ -13,22 +37,137 @@ DEFAULT_DEVELOPER_PROMPT_FALLBACK = (
     "Отвечай структурно и кратко. Если не хватает данных — уточняй."
 )
 
+_FALLBACKS = {
+    "system": DEFAULT_SYSTEM_PROMPT_FALLBACK,
+    "developer": DEFAULT_DEVELOPER_PROMPT_FALLBACK,
+}
+PROMPT_NAMES = tuple(_FALLBACKS)
+
+# client_id приходит из запроса — в путь пускаем только безопасные имена
+_CLIENT_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+StatKey = Tuple[Optional[str], int, int]  # (путь, mtime_ns, размер)
+
+
+class _Entry:
+    __slots__ = ("key", "text", "digest", "checked_at")
 
-def _read_text(path: Path) -> Optional[str]:
+    def __init__(self, key: StatKey, text: str, checked_at: float):
+        self.key = key
+        self.text = text
+        self.digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        self.checked_at = checked_at
+
+
+def _read_text(path: str) -> Optional[str]:
     try:
-        if path.exists() and path.is_file():
-            text = path.read_text(encoding="utf-8").strip()
-            return text or None
+        text = Path(path).read_text(encoding="utf-8").strip()
+        return text or None
     except Exception:
         return None
-    return None
 
 
-def load_system_prompt() -> str:
-    path = Path(PROMPTS_DIR) / "system.txt"
-    return _read_text(path) or DEFAULT_SYSTEM_PROMPT_FALLBACK
+class PromptRegistry:
+    def __init__(self, base_dir: Path = PROMPTS_DIR, reload_interval: float = 5.0, max_entries: int = 256):
+        self.base_dir = Path(base_dir)
+        self.reload_interval = reload_interval  # < 0 — не перечитывать никогда
+        self.max_entries = max_entries
+
+        self._entries: "OrderedDict[Tuple[str, str], _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.stat_calls = 0
+        self.reloads = 0
+
+    def _candidates(self, name: str, client_id: str) -> List[Path]:
+        dirs = []
+        if client_id != "default":
+            dirs.append(self.base_dir / "clients" / client_id)
+        dirs.append(self.base_dir)
+        return [d / filename for d in dirs for filename in (f"{name}.txt", f"{name}.txt.txt")]
+
+    def _stat(self, name: str, client_id: str) -> StatKey:
+        self.stat_calls += 1
+        for path in self._candidates(name, client_id):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_size > 0:
+                return str(path), st.st_mtime_ns, st.st_size
+        return None, 0, 0
+
+    @staticmethod
+    def _client(client_id: Optional[str]) -> str:
+        if client_id and _CLIENT_ID_RE.match(client_id):
+            return client_id
+        return "default"
+
+    def _entry(self, name: str, client_id: Optional[str]) -> _Entry:
+        client = self._client(client_id)
+        cache_key = (client, name)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                self._entries.move_to_end(cache_key)
+                if self.reload_interval < 0 or now - entry.checked_at < self.reload_interval:
+                    self.hits += 1
+                    return entry
+
+            key = self._stat(name, client)
+            if entry is not None and entry.key == key:
+                entry.checked_at = now
+                self.hits += 1
+                return entry
+
+            path = key[0]
+            text = (_read_text(path) if path else None) or _FALLBACKS.get(name, "")
+            entry = _Entry(key, text, now)
+            self.reloads += 1
+            self._entries[cache_key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return entry
+
+    def get(self, name: str, client_id: Optional[str] = None) -> str:
+        return self._entry(name, client_id).text
+
+    def fingerprint(self, client_id: Optional[str] = None) -> str:
+        """
+        Короткий хэш всех промптов набора клиента.
+        """
+        digest = hashlib.sha256()
+        for name in PROMPT_NAMES:
+            digest.update(self._entry(name, client_id).digest.encode("ascii"))
+        return digest.hexdigest()[:16]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "stat_calls": self.stat_calls,
+                "reloads": self.reloads,
+            }
+
+
+prompt_registry = PromptRegistry(reload_interval=PROMPTS_RELOAD_INTERVAL)
+
+
+def load_system_prompt(client_id: Optional[str] = None) -> str:
+    return prompt_registry.get("system", client_id)
+
+
+def load_developer_prompt(client_id: Optional[str] = None) -> str:
+    return prompt_registry.get("developer", client_id)
 
 
-def load_developer_prompt() -> str:
-    path = Path(PROMPTS_DIR) / "developer.txt"
-    return _read_text(path) or DEFAULT_DEVELOPER_PROMPT_FALLBACK
+def prompt_fingerprint(client_id: Optional[str] = None) -> str:
+    return prompt_registry.fingerprint(client_id)
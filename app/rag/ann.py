@@ -0,0 +1,201 @@
+# app/rag/ann.py
+
+"""
+Поисковые движки поверх нормированной матрицы эмбеддингов.
+
+- exact — полный перебор: один matvec по всей матрице, O(N·d) на запрос;
+- ivf   — inverted file: k-means центроиды (NumPy), запрос сравнивается
+          с центроидами и сканирует только nprobe ближайших списков.
+
+Чем больше nprobe, тем выше recall и медленнее запрос (nprobe = nlist — тот же
+точный перебор). Для маленьких корпусов (меньше RAG_ANN_MIN_DOCS) всегда
+используем exact: там IVF ничего не выигрывает, а recall теряет.
+
+Все функции принимают уже нормированный запрос и возвращают
+(позиции строк, scores) по убыванию сходства.
+"""
+
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+
+def top_k_scores(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """
+    Позиции top_k максимальных scores по убыванию (argpartition + сортировка только k).
+    """
+    n = scores.shape[0]
+    k = min(top_k, n)
+    if k <= 0:
+        return np.zeros((0,), dtype=np.int64)
+    if k < n:
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(n)
+    return top[np.argsort(-scores[top])]
+
+
+class ExactSearcher:
+    """
+    Точный перебор по всей матрице.
+    """
+
+    name = "exact"
+
+    def __init__(self, matrix: np.ndarray):
+        self.matrix = matrix
+
+    def search(self, query: np.ndarray, top_k: int, **_) -> Tuple[np.ndarray, np.ndarray]:
+        scores = self.matrix @ query
+        top = top_k_scores(scores, top_k)
+        return top, scores[top]
+
+
+def spherical_kmeans(
+    matrix: np.ndarray,
+    n_clusters: int,
+    n_iter: int = 10,
+    seed: int = 0,
+    batch_size: int = 8192,
+) -> np.ndarray:
+    """
+    k-means по косинусу (центроиды нормируются после каждого шага).
+    Возвращаем матрицу центроидов (n_clusters x d).
+    """
+    rng = np.random.default_rng(seed)
+    n = matrix.shape[0]
+    n_clusters = max(1, min(n_clusters, n))
+
+    centroids = np.array(matrix[rng.choice(n, size=n_clusters, replace=False)], dtype=np.float32)
+
+    for _ in range(n_iter):
+        assign = assign_to_centroids(matrix, centroids, batch_size)
+
+        counts = np.bincount(assign, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        nonempty = np.flatnonzero(counts)
+        order = np.argsort(assign, kind="stable")
+        starts = np.concatenate(([0], np.cumsum(counts[nonempty])[:-1]))
+        sums[nonempty] = np.add.reduceat(matrix[order], starts, axis=0)
+
+        # пустые кластеры переинициализируем случайными точками
+        empty = np.flatnonzero(counts == 0)
+        if empty.size:
+            sums[empty] = matrix[rng.choice(n, size=empty.size, replace=False)]
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0.0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+
+    return centroids
+
+
+def assign_to_centroids(matrix: np.ndarray, centroids: np.ndarray, batch_size: int = 8192) -> np.ndarray:
+    """
+    Номер ближайшего центроида для каждой строки (батчами, чтобы не раздувать память).
+    """
+    n = matrix.shape[0]
+    assign = np.empty(n, dtype=np.int64)
+    for start in range(0, n, batch_size):
+        chunk = np.asarray(matrix[start:start + batch_size], dtype=np.float32)
+        assign[start:start + batch_size] = np.argmax(chunk @ centroids.T, axis=1)
+    return assign
+
+
+class IVFSearcher:
+    """
+    Inverted file index. Строки сгруппированы по ближайшему центроиду (CSR: order + offsets),
+    запрос сканирует только nprobe самых близких списков.
+    """
+
+    name = "ivf"
+
+    def __init__(self, matrix: np.ndarray, centroids: np.ndarray, assign: np.ndarray, nprobe: int):
+        self.matrix = matrix
+        self.centroids = centroids
+        self.nprobe = nprobe
+
+        self.order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=centroids.shape[0])
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    @property
+    def nlist(self) -> int:
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(
+        cls,
+        matrix: np.ndarray,
+        nlist: int = 0,
+        nprobe: int = 8,
+        n_iter: int = 10,
+        train_size: int = 0,
+        seed: int = 0,
+    ) -> "IVFSearcher":
+        """
+        nlist=0 — подобрать автоматически (~sqrt(N)).
+        train_size=0 — обучать k-means на выборке до 64 точек на кластер.
+        """
+        n = matrix.shape[0]
+        if nlist <= 0:
+            nlist = max(1, int(np.sqrt(n)))
+        nlist = min(nlist, n)
+
+        if train_size <= 0:
+            train_size = 64 * nlist
+        rng = np.random.default_rng(seed)
+        if train_size < n:
+            sample = np.sort(rng.choice(n, size=train_size, replace=False))
+            train = np.asarray(matrix[sample], dtype=np.float32)
+        else:
+            train = np.asarray(matrix, dtype=np.float32)
+
+        centroids = spherical_kmeans(train, nlist, n_iter=n_iter, seed=seed)
+        assign = assign_to_centroids(matrix, centroids)
+        return cls(matrix, centroids, assign, nprobe)
+
+    def search(
+        self,
+        query: np.ndarray,
+        top_k: int,
+        nprobe: Optional[int] = None,
+        **_,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        nprobe = min(max(1, nprobe or self.nprobe), self.nlist)
+
+        probe = top_k_scores(self.centroids @ query, nprobe)
+        candidates = np.concatenate([
+            self.order[self.offsets[c]:self.offsets[c + 1]] for c in probe
+        ])
+        if candidates.size == 0:
+            return candidates, np.zeros((0,), dtype=np.float32)
+
+        candidates.sort()  # последовательное чтение строк (важно для memmap)
+        scores = np.asarray(self.matrix[candidates], dtype=np.float32) @ query
+        top = top_k_scores(scores, top_k)
+        return candidates[top], scores[top]
+
+
+SearcherFactory = Callable[..., object]
+
+BACKENDS: Dict[str, SearcherFactory] = {
+    "exact": lambda matrix, **_: ExactSearcher(matrix),
+    "ivf": lambda matrix, nlist=0, nprobe=8, **_: IVFSearcher.build(matrix, nlist=nlist, nprobe=nprobe),
+}
+
+
+def build_searcher(
+    matrix: np.ndarray,
+    backend: str = "exact",
+    min_docs: int = 0,
+    **options,
+):
+    """
+    Выбираем движок по имени. Если документов меньше min_docs — exact.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Неизвестный ANN backend: {backend} (доступны: {', '.join(BACKENDS)})")
+    if matrix.shape[0] < min_docs:
+        backend = "exact"
+    return BACKENDS[backend](matrix, **options)
@@ -0,0 +1,102 @@
+# app/rag/bench_ann.py
+
+"""
+Бенчмарк recall@k / латентности: IVF против точного перебора.
+
+Синтетика (кластеризованные вектора, похоже на реальные эмбеддинги):
+    python -m app.rag.bench_ann --n 50000 --dim 256 --k 5 --nprobe 1,4,8,16
+
+На реальной базе знаний (эмбеддинги из таблицы documents, запросы — сами документы
+с небольшим шумом):
+    python -m app.rag.bench_ann --from-db --k 5
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from app.rag.ann import ExactSearcher, IVFSearcher
+from app.rag.index_file import normalize_rows
+
+
+def synthetic_corpus(n: int, dim: int, n_topics: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    topics = 0.5 * rng.normal(size=(n_topics, dim))
+    labels = rng.integers(0, n_topics, size=n)
+    data = topics[labels] + rng.normal(size=(n, dim))
+    matrix, _ = normalize_rows(data.astype(np.float32))
+    return matrix
+
+
+def db_corpus() -> np.ndarray:
+    from app.memory.db import SessionLocal
+    from app.rag.index_file import load_document_vectors
+
+    with SessionLocal() as session:
+        _, _, matrix, _ = load_document_vectors(session)
+    return matrix
+
+
+def make_queries(matrix: np.ndarray, n_queries: int, noise: float, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed + 1)
+    base = matrix[rng.integers(0, matrix.shape[0], size=n_queries)]
+    queries = base + noise * rng.normal(size=base.shape) * base.std()
+    queries, _ = normalize_rows(queries.astype(np.float32))
+    return queries
+
+
+def run(matrix: np.ndarray, queries: np.ndarray, k: int, nlist: int, nprobes) -> None:
+    n, dim = matrix.shape
+    print(f"Корпус: N={n}, d={dim}, запросов={len(queries)}, k={k}")
+
+    exact = ExactSearcher(matrix)
+    t0 = time.perf_counter()
+    truth = [set(exact.search(q, k)[0].tolist()) for q in queries]
+    exact_ms = (time.perf_counter() - t0) * 1000 / len(queries)
+    print(f"exact:            {exact_ms:8.3f} мс/запрос, recall@{k}=1.000")
+
+    t0 = time.perf_counter()
+    ivf = IVFSearcher.build(matrix, nlist=nlist)
+    print(f"ivf build:        {time.perf_counter() - t0:8.2f} с, nlist={ivf.nlist}")
+
+    for nprobe in nprobes:
+        t0 = time.perf_counter()
+        found = [set(ivf.search(q, k, nprobe=nprobe)[0].tolist()) for q in queries]
+        ivf_ms = (time.perf_counter() - t0) * 1000 / len(queries)
+        recall = np.mean([len(f & t) / max(1, len(t)) for f, t in zip(found, truth)])
+        print(
+            f"ivf nprobe={nprobe:<4} {ivf_ms:8.3f} мс/запрос, recall@{k}={recall:.3f}, "
+            f"ускорение x{exact_ms / ivf_ms:.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="recall@k бенчмарк IVF против exact")
+    parser.add_argument("--from-db", action="store_true", help="взять эмбеддинги из таблицы documents")
+    parser.add_argument("--n", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=1.0)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--nlist", type=int, default=0)
+    parser.add_argument("--nprobe", default="1,2,4,8,16,32")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.from_db:
+        matrix = db_corpus()
+        if matrix.shape[0] == 0:
+            print("В таблице documents нет эмбеддингов.")
+            return
+    else:
+        matrix = synthetic_corpus(args.n, args.dim, args.topics, args.seed)
+
+    queries = make_queries(matrix, args.queries, args.noise, args.seed)
+    nprobes = [int(x) for x in args.nprobe.split(",") if x.strip()]
+    run(matrix, queries, args.k, args.nlist, nprobes)
+
+
+if __name__ == "__main__":
+    main()
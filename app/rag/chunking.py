@@ -0,0 +1,138 @@
+# app/rag/chunking.py
+
+"""
+Нарезка документов базы знаний на фрагменты (chunks) для эмбеддингов.
+
+Файл читается потоково, блоками по read_size символов: в памяти держим только
+окно в пару фрагментов, поэтому большие инструкции не грузятся целиком.
+
+Режимы:
+- sentence — режем по границам абзацев, заголовков и предложений (с учётом
+             русской пунктуации: «», …, заглавные Ё/А-Я), иначе по пробелу;
+- fixed    — только по пробелу (или жёстко по размеру, если пробелов нет).
+
+Соседние фрагменты перекрываются на ~overlap символов, чтобы мысль на стыке
+не терялась. offset — позиция начала фрагмента в файле (в символах).
+"""
+
+import re
+from dataclasses import dataclass
+from typing import Iterator, Optional, TextIO
+
+# Пустая строка между абзацами
+_PARAGRAPH_RE = re.compile(r"\n[ \t]*\n")
+# Перенос строки перед заголовком: markdown (#), нумерация «1.», «2.3)», «Раздел ...»
+_HEADING_RE = re.compile(r"\n(?=[ \t]*(?:#{1,6}\s|\d+(?:\.\d+)*[.)]\s+\S|(?:Раздел|Глава|Часть)\s))")
+# Конец предложения: . ! ? … (+ закрывающие кавычки/скобки) и пробел перед началом следующего
+_SENTENCE_RE = re.compile(r"(?<=[.!?…])[\"»”)\]]*\s+(?=[\"«“(\[]*[А-ЯЁA-Z0-9—–-])")
+_NEWLINE_RE = re.compile(r"\n")
+_SPACE_RE = re.compile(r"\s+")
+
+
+@dataclass
+class Chunk:
+    index: int
+    offset: int
+    text: str
+
+
+def _last_break(pattern: re.Pattern, text: str, lo: int, hi: int) -> Optional[int]:
+    """
+    Последняя граница pattern в text[lo:hi] — возвращаем позицию сразу после разделителя.
+    """
+    best = None
+    for match in pattern.finditer(text, lo, hi):
+        best = match.end()
+    return best
+
+
+def _find_end(buffer: str, limit: int, mode: str) -> int:
+    """
+    Где закончить фрагмент: ищем лучшую границу во второй половине окна [limit/2, limit].
+    """
+    lo = limit // 2
+    patterns = (
+        (_PARAGRAPH_RE, _HEADING_RE, _SENTENCE_RE, _NEWLINE_RE, _SPACE_RE)
+        if mode == "sentence"
+        else (_SPACE_RE,)
+    )
+    for pattern in patterns:
+        pos = _last_break(pattern, buffer, lo, limit)
+        if pos is not None and pos > 0:
+            return pos
+    return limit
+
+
+def _find_next_start(buffer: str, end: int, overlap: int, mode: str) -> int:
+    """
+    Откуда начать следующий фрагмент: примерно за overlap символов до end,
+    но с начала предложения/слова, а не посреди слова.
+    """
+    if overlap <= 0:
+        return end
+    start = max(1, end - overlap)
+    patterns = (_SENTENCE_RE, _SPACE_RE) if mode == "sentence" else (_SPACE_RE,)
+    for pattern in patterns:
+        match = pattern.search(buffer, start, end)
+        if match is not None and match.end() < end:
+            return match.end()
+    return end
+
+
+def iter_chunks(
+    stream: TextIO,
+    chunk_size: int = 1500,
+    overlap: int = 200,
+    mode: str = "sentence",
+    read_size: int = 64 * 1024,
+) -> Iterator[Chunk]:
+    """
+    Потоково режем текст из stream на фрагменты не длиннее chunk_size символов.
+    """
+    chunk_size = max(1, chunk_size)
+    overlap = max(0, min(overlap, chunk_size // 2))
+
+    buffer = ""
+    buffer_offset = 0  # позиция buffer[0] в исходном тексте
+    eof = False
+    index = 0
+
+    while True:
+        while not eof and len(buffer) < 2 * chunk_size:
+            data = stream.read(read_size)
+            if not data:
+                eof = True
+            else:
+                buffer += data
+
+        if not buffer:
+            return
+
+        if eof and len(buffer) <= chunk_size:
+            end = len(buffer)
+        else:
+            end = _find_end(buffer, chunk_size, mode)
+
+        piece = buffer[:end]
+        stripped = piece.strip()
+        if stripped:
+            lead = len(piece) - len(piece.lstrip())
+            yield Chunk(index=index, offset=buffer_offset + lead, text=stripped)
+            index += 1
+
+        if eof and end >= len(buffer):
+            return
+
+        step = _find_next_start(buffer, end, overlap, mode)
+        buffer = buffer[step:]
+        buffer_offset += step
+
+
+def iter_file_chunks(
+    path: str,
+    chunk_size: int = 1500,
+    overlap: int = 200,
+    mode: str = "sentence",
+) -> Iterator[Chunk]:
+    with open(path, "r", encoding="utf-8") as stream:
+        yield from iter_chunks(stream, chunk_size=chunk_size, overlap=overlap, mode=mode)
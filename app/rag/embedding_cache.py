@@ -0,0 +1,217 @@
+# app/rag/embedding_cache.py
+
+"""
+Кэш эмбеддингов запросов: приветствия и типовые вопросы повторяются постоянно,
+и каждый раз платить за сетевой запрос к embeddings API незачем.
+
+Два уровня:
+- память процесса — LRU (OrderedDict) с ограничением по числу записей и TTL;
+- опционально SQLite-файл — переживает рестарты и общий для всех воркеров;
+  из async-кода (aget/aput) к нему ходим через пул потоков БД, не блокируя event loop.
+  TTL проверяется при чтении, а протухшие строки удаляет prune_disk(): при прогреве
+  и раз в prune_every записей — иначе файл растёт без ограничений.
+
+Ключ — (модель, нормализованный текст): регистр и лишние пробелы не важны.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from app.memory.db import run_in_db_thread
+from app.rag.vectors import decode_embedding, encode_embedding
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+class EmbeddingCache:
+    def __init__(self, max_size: int = 2048, ttl: float = 86400.0, db_path: str = "", prune_every: int = 1000):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_path = db_path
+        self.prune_every = prune_every  # 0 — только вручную / при прогреве
+
+        self._items: "OrderedDict[Tuple[str, str], Tuple[float, list]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # SQLite-соединение — под своим замком: диск не держит быстрый путь по памяти
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._db_puts = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.pruned = 0
+
+    # --- SQLite уровень (вызывать под self._db_lock) ---
+
+    def _get_db(self) -> Optional[sqlite3.Connection]:
+        if not self.db_path:
+            return None
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.db_path, check_same_thread=False, timeout=5.0)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS embedding_cache ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db = db
+        return self._db
+
+    @staticmethod
+    def _db_key(key: Tuple[str, str]) -> str:
+        model, text = key
+        return f"{model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def _db_get(self, key: Tuple[str, str], now: float) -> Optional[list]:
+        try:
+            db = self._get_db()
+            if db is None:
+                return None
+            row = db.execute(
+                "SELECT vector, created_at FROM embedding_cache WHERE key = ?",
+                (self._db_key(key),),
+            ).fetchone()
+        except sqlite3.Error as e:
+            print("Кэш эмбеддингов (SQLite) недоступен:", repr(e))
+            return None
+        if row is None or (self.ttl > 0 and now - row[1] > self.ttl):
+            return None
+        return decode_embedding(row[0]).tolist()
+
+    def _db_put(self, key: Tuple[str, str], vector: list, now: float) -> None:
+        try:
+            db = self._get_db()
+            if db is None:
+                return
+            db.execute(
+                "INSERT OR REPLACE INTO embedding_cache (key, vector, created_at) VALUES (?, ?, ?)",
+                (self._db_key(key), encode_embedding(vector, key[0]), now),
+            )
+            db.commit()
+        except sqlite3.Error as e:
+            print("Не удалось записать в кэш эмбеддингов (SQLite):", repr(e))
+
+    def _get_disk(self, key: Tuple[str, str], now: float) -> Optional[list]:
+        with self._db_lock:
+            vector = self._db_get(key, now)
+        with self._lock:
+            if vector is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._put_memory(key, vector, now)
+            return vector
+
+    def _put_disk(self, key: Tuple[str, str], vector: list, now: float) -> None:
+        with self._db_lock:
+            self._db_put(key, vector, now)
+            self._db_puts += 1
+            if self.prune_every > 0 and self._db_puts % self.prune_every == 0:
+                self._db_prune()
+
+    def _db_prune(self) -> int:
+        if self.ttl <= 0:
+            return 0
+        try:
+            db = self._get_db()
+            if db is None:
+                return 0
+            cur = db.execute("DELETE FROM embedding_cache WHERE created_at < ?", (time.time() - self.ttl,))
+            db.commit()
+        except sqlite3.Error as e:
+            print("Не удалось почистить кэш эмбеддингов (SQLite):", repr(e))
+            return 0
+        self.pruned += cur.rowcount
+        return cur.rowcount
+
+    # --- память ---
+
+    def _get_memory(self, key: Tuple[str, str], now: float) -> Optional[list]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                if not self.db_path:
+                    self.misses += 1
+                return None
+            created_at, vector = item
+            if self.ttl <= 0 or now - created_at <= self.ttl:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return vector
+            del self._items[key]
+            if not self.db_path:
+                self.misses += 1
+            return None
+
+    def _put_memory(self, key: Tuple[str, str], vector: list, now: float) -> None:
+        if self.max_size <= 0:
+            return
+        self._items[key] = (now, vector)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    # --- публичное API ---
+
+    def get(self, text: str, model: str) -> Optional[list]:
+        key = (model, normalize_query(text))
+        now = time.time()
+        vector = self._get_memory(key, now)
+        if vector is None and self.db_path:
+            vector = self._get_disk(key, now)
+        return vector
+
+    def put(self, text: str, model: str, vector: list) -> None:
+        key = (model, normalize_query(text))
+        now = time.time()
+        with self._lock:
+            self._put_memory(key, vector, now)
+        if self.db_path:
+            self._put_disk(key, vector, now)
+
+    async def aget(self, text: str, model: str) -> Optional[list]:
+        """
+        get() для event loop: память — сразу, SQLite-уровень — в пуле потоков БД.
+        """
+        key = (model, normalize_query(text))
+        now = time.time()
+        vector = self._get_memory(key, now)
+        if vector is None and self.db_path:
+            vector = await run_in_db_thread(self._get_disk, key, now)
+        return vector
+
+    async def aput(self, text: str, model: str, vector: list) -> None:
+        key = (model, normalize_query(text))
+        now = time.time()
+        with self._lock:
+            self._put_memory(key, vector, now)
+        if self.db_path:
+            await run_in_db_thread(self._put_disk, key, vector, now)
+
+    def prune_disk(self) -> int:
+        """
+        Удаляем протухшие записи из SQLite-уровня. Возвращаем число удалённых.
+        """
+        with self._db_lock:
+            return self._db_prune()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {
+                "size": len(self._items),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "pruned": self.pruned,
+                "hit_rate": round((self.hits + self.disk_hits) / total, 4) if total else 0.0,
+            }
@@ -1,24 +1,214 @@
 # app/rag/embeddings.py
 
-from openai import OpenAI
-from app.config import PROXYAPI_API_KEY
+import asyncio
+import threading
+from typing import TYPE_CHECKING, List, Optional, Sequence
 
-if not PROXYAPI_API_KEY:
-    raise RuntimeError("PROXYAPI_API_KEY не найден в .env")
+from app.config import (
+    PROXYAPI_API_KEY,
+    PROXYAPI_BASE_URL,
+    EMBEDDING_MODEL,
+    EMBED_BATCH_MAX_TOKENS,
+    EMBED_BATCH_MAX_ITEMS,
+    EMBED_CONCURRENCY,
+    EMBED_MAX_RETRIES,
+    EMBED_QUERY_MAX_RETRIES,
+    EMBED_CACHE_SIZE,
+    EMBED_CACHE_TTL,
+    EMBED_CACHE_DB_PATH,
+    SINGLE_FLIGHT_ENABLED,
+    EMBED_RATE_LIMIT_RPM,
+    EMBED_RATE_LIMIT_BURST,
+)
+from app.ratelimit import ModelRateLimiter
+from app.rag.embedding_cache import EmbeddingCache, normalize_query
+from app.singleflight import SingleFlight
+from app.transport import (
+    embedding_breaker,
+    get_http_client,
+    get_sync_http_client,
+    http_timeout,
+    retry_call,
+)
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
+
+# Клиенты ProxyAPI (OpenAI-совместимые) создаются лениво, соединения — из общего пула app.transport
+_client: Optional["OpenAI"] = None
+_async_client: Optional["AsyncOpenAI"] = None
+_client_lock = threading.Lock()
 
-# Клиент для ProxyAPI (OpenAI-совместимый)
-client = OpenAI(
-    api_key=PROXYAPI_API_KEY,
-    base_url="https://openai.api.proxyapi.ru/v1",
+# Кэш эмбеддингов пользовательских запросов (LRU + TTL, опционально SQLite)
+query_cache = EmbeddingCache(
+    max_size=EMBED_CACHE_SIZE,
+    ttl=EMBED_CACHE_TTL,
+    db_path=EMBED_CACHE_DB_PATH,
 )
 
+# Один и тот же запрос (после нормализации, как в кэше), пока эмбеддинг для него в полёте
+embedding_flight = SingleFlight("embeddings", enabled=SINGLE_FLIGHT_ENABLED)
+
+# token bucket на модель эмбеддингов (общий для запросов пользователей и индексации)
+embed_limiter = ModelRateLimiter(EMBED_RATE_LIMIT_RPM, EMBED_RATE_LIMIT_BURST)
+
+
+def _require_api_key() -> None:
+    if not PROXYAPI_API_KEY:
+        raise RuntimeError("PROXYAPI_API_KEY не найден в .env")
+
+
+def get_client() -> "OpenAI":
+    """
+    Синхронный клиент (retrieve_documents без event loop: CLI, отладка).
+    """
+    global _client
+    if _client is None or _client.is_closed():
+        _require_api_key()
+        from openai import OpenAI
+
+        with _client_lock:
+            if _client is None or _client.is_closed():
+                _client = OpenAI(
+                    api_key=PROXYAPI_API_KEY,
+                    base_url=PROXYAPI_BASE_URL,
+                    http_client=get_sync_http_client(),
+                    timeout=http_timeout(),
+                )
+    return _client
+
+
 def get_embedding(text: str) -> list:
     """
     Получаем эмбеддинг текста через ProxyAPI / OpenAI.
     Используем современный метод embeddings.create().
+    Повторяющиеся запросы отдаём из кэша без сетевого запроса.
     """
-    response = client.embeddings.create(
-        model="text-embedding-3-small",  # современная быстрая модель
+    cached = query_cache.get(text, EMBEDDING_MODEL)
+    if cached is not None:
+        return cached
+
+    response = get_client().embeddings.create(
+        model=EMBEDDING_MODEL,  # по умолчанию text-embedding-3-small
         input=text
     )
-    return response.data[0].embedding
+    embedding = response.data[0].embedding
+    query_cache.put(text, EMBEDDING_MODEL, embedding)
+    return embedding
+
+
+def get_async_client() -> "AsyncOpenAI":
+    """
+    Асинхронный клиент (пакетная индексация и эмбеддинги запросов).
+    Ретраи делаем сами (с учётом Retry-After), поэтому встроенные отключены.
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed():
+        _require_api_key()
+        from openai import AsyncOpenAI
+
+        _async_client = AsyncOpenAI(
+            api_key=PROXYAPI_API_KEY,
+            base_url=PROXYAPI_BASE_URL,
+            http_client=get_http_client(),
+            timeout=http_timeout(),
+            max_retries=0,
+        )
+    return _async_client
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая оценка числа токенов с запасом (для кириллицы ~2-3 символа на токен).
+    """
+    return len(text) // 2 + 1
+
+
+def make_batches(
+    texts: Sequence[str],
+    max_tokens: int = EMBED_BATCH_MAX_TOKENS,
+    max_items: int = EMBED_BATCH_MAX_ITEMS,
+) -> List[List[int]]:
+    """
+    Режем список текстов на пакеты по бюджету токенов и числу элементов.
+    Возвращаем индексы текстов для каждого пакета.
+    """
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_items):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+async def _create_embeddings(texts: List[str], max_retries: int) -> List[list]:
+    """
+    Один запрос embeddings.create (список входов) с повторами при временных ошибках.
+    """
+    response = await retry_call(
+        lambda: get_async_client().embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=texts,
+        ),
+        breaker=embedding_breaker,
+        max_retries=max_retries,
+        label="Эмбеддинги",
+        before_attempt=lambda: embed_limiter.acquire(EMBEDDING_MODEL),
+    )
+    data = sorted(response.data, key=lambda item: item.index)
+    return [item.embedding for item in data]
+
+
+async def _embed_batch(texts: List[str], semaphore: asyncio.Semaphore) -> List[list]:
+    async with semaphore:
+        return await _create_embeddings(texts, EMBED_MAX_RETRIES)
+
+
+async def aget_embedding(text: str) -> list:
+    """
+    Асинхронный вариант get_embedding для пути обработки запроса:
+    не блокирует event loop FastAPI / aiogram, пока ждём ответ провайдера.
+    Кэш -> single-flight -> провайдер.
+    """
+    cached = await query_cache.aget(text, EMBEDDING_MODEL)
+    if cached is not None:
+        return cached
+
+    async def fetch() -> list:
+        embedding = (await _create_embeddings([text], EMBED_QUERY_MAX_RETRIES))[0]
+        await query_cache.aput(text, EMBEDDING_MODEL, embedding)
+        return embedding
+
+    # одинаковые запросы, пришедшие одновременно, ждут один вызов
+    normalized = normalize_query(text)
+    return await embedding_flight.do((EMBEDDING_MODEL, normalized), fetch, label=normalized[:60])
+
+
+async def embed_texts(texts: Sequence[str], concurrency: int = EMBED_CONCURRENCY) -> List[list]:
+    """
+    Пакетно получаем эмбеддинги для списка текстов (порядок сохраняется).
+    Одновременно в полёте не больше concurrency пакетов.
+    """
+    if not texts:
+        return []
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    batches = make_batches(texts)
+    results = await asyncio.gather(*[
+        _embed_batch([texts[i] for i in batch], semaphore) for batch in batches
+    ])
+
+    embeddings: List[Optional[list]] = [None] * len(texts)
+    for batch, vectors in zip(batches, results):
+        for i, vec in zip(batch, vectors):
+            embeddings[i] = vec
+    return embeddings
@@ -1,43 +1,213 @@
 # app/rag/index_docs.py
 
+import asyncio
+import hashlib
 import os
-import json
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
 
-from app.rag.embeddings import get_embedding
-from app.memory.db import SessionLocal
-from app.memory.models import Document
+from sqlalchemy import delete, select, update
+
+from app.config import (
+    EMBEDDING_MODEL,
+    EMBEDDING_STORAGE_DTYPE,
+    EMBED_BATCH_MAX_ITEMS,
+    EMBED_CONCURRENCY,
+    RAG_INDEX_PATH,
+    RAG_CHUNK_SIZE,
+    RAG_CHUNK_OVERLAP,
+    RAG_CHUNK_MODE,
+)
+from app.rag.chunking import Chunk, iter_file_chunks
+from app.rag.embeddings import embed_texts
+from app.rag.index_file import export_index
+from app.rag.vectors import encode_embedding
+from app.transport import aclose_http_clients
+from app.memory.db import SessionLocal, migrate_db
+from app.memory.models import Document, DocumentSource
 
 DOCUMENTS_PATH = "data/docs"
 
 
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    sha256 файла, читаем кусками (не тянем весь файл в память).
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan_files() -> Dict[str, os.stat_result]:
+    """
+    Все .txt в data/docs: {путь относительно data/docs: stat}.
+    """
+    result = {}
+    for filename in sorted(os.listdir(DOCUMENTS_PATH)):
+        if not filename.endswith(".txt"):
+            continue
+        filepath = os.path.join(DOCUMENTS_PATH, filename)
+        if os.path.isfile(filepath):
+            result[filename] = os.stat(filepath)
+    return result
+
+
+@dataclass
+class _PendingFile:
+    path: str
+    stat: os.stat_result
+    content_hash: str
+    source: DocumentSource
+    chunks: int = 0
+
+
+def _iter_pending_chunks(pending: List[_PendingFile]) -> Iterator[Tuple[_PendingFile, Optional[Chunk]]]:
+    """
+    Поток фрагментов по всем изменённым файлам. После последнего фрагмента файла
+    отдаём (file, None) — маркер, что файл проиндексирован полностью.
+    """
+    for item in pending:
+        filepath = os.path.join(DOCUMENTS_PATH, item.path)
+        for chunk in iter_file_chunks(filepath, RAG_CHUNK_SIZE, RAG_CHUNK_OVERLAP, RAG_CHUNK_MODE):
+            yield item, chunk
+        yield item, None
+
+
+def _promote(session, item: _PendingFile) -> None:
+    """
+    Файл записан целиком: старые фрагменты -> удалить, новые (pending) -> в поиск.
+    """
+    source_id = item.source.id
+    session.execute(delete(Document).where(Document.source_id == source_id, Document.pending.is_(False)))
+    session.execute(update(Document).where(Document.source_id == source_id).values(pending=False))
+    # Хэш/mtime фиксируем только вместе с подменой: если индексация упадёт посередине,
+    # следующий запуск увидит несовпадение хэша и переиндексирует файл.
+    item.source.content_hash = item.content_hash
+    item.source.mtime = item.stat.st_mtime
+    item.source.size = item.stat.st_size
+
+
+async def _store_window(session, window: List[Tuple[_PendingFile, Optional[Chunk]]]) -> None:
+    chunks = [(item, chunk) for item, chunk in window if chunk is not None]
+    embeddings = await embed_texts([chunk.text for _, chunk in chunks])
+
+    # Новые фрагменты пишутся как pending и коммитятся каждым окном (транзакция записи
+    # не висит, пока ждём сеть); поиск по-прежнему видит старую версию файла.
+    for (item, chunk), embedding in zip(chunks, embeddings):
+        session.add(Document(
+            source_id=item.source.id,
+            title=item.path,
+            chunk_index=chunk.index,
+            char_offset=chunk.offset,
+            content=chunk.text,
+            embedding=encode_embedding(embedding, EMBEDDING_MODEL, EMBEDDING_STORAGE_DTYPE),
+            pending=True,
+        ))
+        item.chunks += 1
+
+    session.flush()  # autoflush выключен: новые строки должны попасть под _promote
+    for item, chunk in window:
+        if chunk is None:
+            _promote(session, item)
+
+    session.commit()
+
+
+async def _embed_pending(session, pending: List[_PendingFile]) -> None:
+    """
+    Эмбеддим фрагменты окнами фиксированного размера: в памяти одновременно только
+    одно окно, внутри окна пакеты embeddings.create идут параллельно.
+    """
+    window_size = max(1, EMBED_BATCH_MAX_ITEMS * EMBED_CONCURRENCY)
+    window = []
+    try:
+        for entry in _iter_pending_chunks(pending):
+            window.append(entry)
+            if len(window) >= window_size:
+                await _store_window(session, window)
+                window = []
+        if window:
+            await _store_window(session, window)
+    finally:
+        # пул соединений привязан к этому event loop (asyncio.run) — закрываем вместе с ним
+        await aclose_http_clients()
+
+
 def index_documents():
     """
-    Индексируем все текстовые файлы в папке data/docs/
-    и сохраняем их эмбеддинги в БД.
+    Инкрементально индексируем текстовые файлы в папке data/docs/:
+    файлы режем на фрагменты, эмбеддинги считаем только для новых и изменённых файлов,
+    строки удалённых файлов убираем из БД.
     """
-    files = [f for f in os.listdir(DOCUMENTS_PATH) if f.endswith(".txt")]
+    files = scan_files() if os.path.isdir(DOCUMENTS_PATH) else {}
     if not files:
         print("В папке data/docs нет .txt файлов.")
-        return
+
+    added, updated, unchanged, removed = [], [], [], []
+    pending: List[_PendingFile] = []
 
     with SessionLocal() as session:
-        for filename in files:
-            filepath = os.path.join(DOCUMENTS_PATH, filename)
-            with open(filepath, "r", encoding="utf-8") as file:
-                content = file.read()
+        sources = {src.path: src for src in session.execute(select(DocumentSource)).scalars()}
+
+        for path, st in files.items():
+            filepath = os.path.join(DOCUMENTS_PATH, path)
+            src = sources.get(path)
+
+            # mtime и размер не менялись — файл даже не читаем
+            if src is not None and src.mtime == st.st_mtime and src.size == st.st_size:
+                unchanged.append(path)
+                continue
+
+            content_hash = file_sha256(filepath)
+            if src is not None and src.content_hash == content_hash:
+                # файл «тронули», но содержимое то же — обновим только метаданные
+                src.mtime = st.st_mtime
+                src.size = st.st_size
+                unchanged.append(path)
+                continue
 
-            embedding = get_embedding(content)
+            if src is None:
+                # хэш пустой, пока файл не записан целиком (см. _promote)
+                src = DocumentSource(path=path, content_hash="", mtime=0.0, size=0)
+                session.add(src)
+                added.append(path)
+            else:
+                updated.append(path)
+            pending.append(_PendingFile(path=path, stat=st, content_hash=content_hash, source=src))
 
-            doc = Document(
-                title=filename,
-                content=content,
-                embedding=json.dumps(embedding),  # Сохраняем как JSON-строку
-            )
-            session.add(doc)
+        for path, src in sources.items():
+            if path not in files:
+                session.execute(delete(Document).where(Document.source_id == src.id))
+                session.delete(src)
+                removed.append(path)
+
+        # строки, проиндексированные старой версией (без source) — дубли, убираем
+        legacy = session.execute(delete(Document).where(Document.source_id.is_(None))).rowcount
+        # недописанные фрагменты прошлого упавшего запуска
+        session.execute(delete(Document).where(Document.pending.is_(True)))
 
         session.commit()
-        print(f"Индексация завершена. Загружено {len(files)} документов.")
+
+        asyncio.run(_embed_pending(session, pending))
+
+        print(
+            f"Индексация завершена: добавлено {len(added)}, обновлено {len(updated)}, "
+            f"без изменений {len(unchanged)}, удалено {len(removed)}"
+            + (f", удалено старых строк без источника {legacy}" if legacy else "")
+            + f"; фрагментов записано {sum(item.chunks for item in pending)}."
+        )
+        for label, paths in (("+", added), ("~", updated), ("-", removed)):
+            for path in paths:
+                print(f"  {label} {path}")
+
+        changed = added or updated or removed or legacy
+        if RAG_INDEX_PATH and (changed or not os.path.exists(RAG_INDEX_PATH)):
+            version, count = export_index(session, RAG_INDEX_PATH)
+            print(f"Файл индекса {RAG_INDEX_PATH}: версия {version}, векторов {count}.")
 
 
 if __name__ == "__main__":
+    migrate_db()
     index_documents()
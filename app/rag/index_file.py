@@ -0,0 +1,175 @@
+# app/rag/index_file.py
+
+"""
+Плоский файл индекса эмбеддингов, который воркеры открывают через np.memmap.
+
+Все uvicorn-воркеры мапят один и тот же файл read-only, поэтому матрица лежит
+в page cache ОС один раз, а не копируется в память каждого процесса.
+Новая версия пишется во временный файл и подменяется через os.replace()
+(атомарный rename) — читатели замечают смену inode и переоткрывают файл,
+старые mmap продолжают работать, пока на них есть ссылки.
+
+Раскладка (little-endian), все секции выровнены на 64 байта:
+    header   64 байта   magic, версии формата/индекса, N, d, смещения секций
+    ids      int64[N]   id строк documents
+    norms    float32[N] исходные нормы векторов (0 = пустой/битый вектор)
+    matrix   float32[N x d], строки уже нормированы
+"""
+
+import os
+import struct
+from typing import List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select
+
+from app.memory.models import Document
+from app.rag.vectors import decode_embedding
+
+MAGIC = b"AINOVAIX"
+FORMAT_VERSION = 1
+_ALIGN = 64
+# magic, format, reserved, version, n, dim, reserved, ids_off, norms_off, matrix_off
+_HEADER = struct.Struct("<8sIIQQIIQQQ")
+_HEADER_SIZE = 64
+
+
+def _align(offset: int) -> int:
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def normalize_rows(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Нормируем строки матрицы на единичную длину (нулевые строки оставляем нулями).
+    После этого косинусное сходство = обычное скалярное произведение.
+    Возвращаем (нормированная матрица, исходные нормы).
+    """
+    norms = np.linalg.norm(matrix, axis=1)
+    safe = norms.copy()
+    safe[safe == 0.0] = 1.0
+    return (matrix / safe[:, None]).astype(np.float32), norms.astype(np.float32)
+
+
+def load_document_vectors(session) -> Tuple[np.ndarray, List[str], np.ndarray, np.ndarray]:
+    """
+    Читаем эмбеддинги всех документов из БД.
+    Возвращаем (ids, titles, нормированная матрица, нормы).
+    """
+    rows = session.execute(
+        select(Document.id, Document.title, Document.embedding).where(Document.pending.is_(False))
+    ).all()
+
+    ids, titles, vectors = [], [], []
+    dim = None
+    for doc_id, title, raw_emb in rows:
+        try:
+            vec = decode_embedding(raw_emb)
+        except Exception:
+            # Если какой-то документ битый — просто пропускаем, не валим индекс.
+            continue
+        if dim is None:
+            dim = vec.shape[0]
+        if vec.ndim != 1 or vec.shape[0] != dim:
+            continue
+        ids.append(doc_id)
+        titles.append(title)
+        vectors.append(vec)
+
+    if vectors:
+        matrix, norms = normalize_rows(np.vstack(vectors).astype(np.float32))
+    else:
+        matrix = np.zeros((0, 0), dtype=np.float32)
+        norms = np.zeros((0,), dtype=np.float32)
+
+    return np.asarray(ids, dtype=np.int64), titles, matrix, norms
+
+
+def read_version(path) -> Optional[int]:
+    try:
+        with open(path, "rb") as f:
+            header = f.read(_HEADER.size)
+        magic, fmt, _, version, *_ = _HEADER.unpack(header)
+    except (OSError, struct.error):
+        return None
+    if magic != MAGIC or fmt != FORMAT_VERSION:
+        return None
+    return version
+
+
+def write_index_file(path, ids: np.ndarray, matrix: np.ndarray, norms: np.ndarray) -> int:
+    """
+    Пишем новую версию файла индекса атомарно. Возвращаем номер версии.
+    """
+    path = os.fspath(path)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    n = int(ids.shape[0])
+    dim = int(matrix.shape[1]) if n else 0
+    version = (read_version(path) or 0) + 1
+
+    ids_off = _align(_HEADER_SIZE)
+    norms_off = _align(ids_off + n * 8)
+    matrix_off = _align(norms_off + n * 4)
+
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, 0, version, n, dim, 0, ids_off, norms_off, matrix_off)
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(header.ljust(_HEADER_SIZE, b"\x00"))
+        for offset, arr, dtype in (
+            (ids_off, ids, "<i8"),
+            (norms_off, norms, "<f4"),
+            (matrix_off, matrix, "<f4"),
+        ):
+            f.write(b"\x00" * (offset - f.tell()))
+            f.write(np.ascontiguousarray(arr, dtype=dtype).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+    return version
+
+
+class MappedIndexFile:
+    """
+    Открытый read-only файл индекса. Массивы — np.memmap, без копий в память процесса.
+    """
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        st = os.stat(self.path)
+        self.stat_key = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+        with open(self.path, "rb") as f:
+            header = f.read(_HEADER.size)
+        magic, fmt, _, version, n, dim, _, ids_off, norms_off, matrix_off = _HEADER.unpack(header)
+        if magic != MAGIC or fmt != FORMAT_VERSION:
+            raise ValueError(f"{self.path}: не файл индекса AINOVA или неизвестная версия формата")
+
+        self.version = version
+        if n == 0:
+            self.ids = np.zeros((0,), dtype=np.int64)
+            self.norms = np.zeros((0,), dtype=np.float32)
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+            return
+
+        self.ids = np.memmap(self.path, dtype="<i8", mode="r", offset=ids_off, shape=(n,))
+        self.norms = np.memmap(self.path, dtype="<f4", mode="r", offset=norms_off, shape=(n,))
+        self.matrix = np.memmap(self.path, dtype="<f4", mode="r", offset=matrix_off, shape=(n, dim))
+
+
+def current_stat_key(path) -> Optional[tuple]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def export_index(session, path) -> Tuple[int, int]:
+    """
+    Собираем индекс из таблицы documents и записываем файл. Возвращаем (версия, N).
+    """
+    ids, _, matrix, norms = load_document_vectors(session)
+    version = write_index_file(path, ids, matrix, norms)
+    return version, int(ids.shape[0])
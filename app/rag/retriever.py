@@ -1,13 +1,23 @@
 # app/rag/retriever.py
 
-import json
-from typing import List
+import threading
+from typing import List, Optional, Tuple
 
 import numpy as np
+from sqlalchemy import func, select
 
-from app.memory.db import SessionLocal
+from app.config import (
+    RAG_INDEX_PATH,
+    RAG_ANN_BACKEND,
+    RAG_ANN_MIN_DOCS,
+    RAG_IVF_NLIST,
+    RAG_IVF_NPROBE,
+)
+from app.memory.db import SessionLocal, run_in_db_thread
 from app.memory.models import Document
-from app.rag.embeddings import get_embedding
+from app.rag.ann import build_searcher
+from app.rag.embeddings import aget_embedding, get_embedding
+from app.rag.index_file import MappedIndexFile, current_stat_key, load_document_vectors
 
 
 def cosine_sim(a: np.ndarray, b: np.ndarray) -> float:
@@ -20,27 +30,188 @@ def cosine_sim(a: np.ndarray, b: np.ndarray) -> float:
     return float(np.dot(a, b) / denom)
 
 
-def retrieve_documents(query: str, top_k: int = 3) -> List[Document]:
+class EmbeddingIndex:
     """
-    Ищем top_k документов, наиболее похожих на запрос (по косинусному сходству).
+    Индекс эмбеддингов документов.
+
+    matrix — float32 (N x d), строки уже нормированы (обычный массив или np.memmap);
+    ids / titles — параллельные массивы с id и заголовками документов
+    (titles есть только у индекса, собранного из БД).
     """
-    query_emb = np.array(get_embedding(query), dtype=np.float32)
 
-    with SessionLocal() as session:
-        docs = session.query(Document).all()
-        if not docs:
+    def __init__(
+        self,
+        ids: np.ndarray,
+        titles: Optional[List[str]],
+        matrix: np.ndarray,
+        signature: tuple,
+    ):
+        self.ids = ids
+        self.titles = titles
+        self.matrix = matrix
+        self.signature = signature
+        self._searcher = None
+        self._searcher_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def searcher(self):
+        """
+        Движок поиска (exact / ivf) строим лениво, один раз на версию индекса.
+        """
+        if self._searcher is None:
+            with self._searcher_lock:
+                if self._searcher is None:
+                    self._searcher = build_searcher(
+                        self.matrix,
+                        backend=RAG_ANN_BACKEND,
+                        min_docs=RAG_ANN_MIN_DOCS,
+                        nlist=RAG_IVF_NLIST,
+                        nprobe=RAG_IVF_NPROBE,
+                    )
+        return self._searcher
+
+    def search(self, query_emb: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+        """
+        Возвращаем [(doc_id, score), ...] по убыванию сходства.
+        """
+        n = len(self.ids)
+        if n == 0 or top_k <= 0:
             return []
 
-        scored = []
-        for doc in docs:
+        q = np.asarray(query_emb, dtype=np.float32)
+        if q.shape[0] != self.matrix.shape[1]:
+            return []
+        q_norm = np.linalg.norm(q)
+        if q_norm == 0.0:
+            return []
+
+        positions, scores = self.searcher.search(q / q_norm, top_k)
+        return [(int(self.ids[i]), float(score)) for i, score in zip(positions, scores)]
+
+
+_index: Optional[EmbeddingIndex] = None
+_file_index: Optional[EmbeddingIndex] = None
+_index_lock = threading.Lock()
+
+
+def _documents_signature(session) -> tuple:
+    """
+    Дешёвый «отпечаток» таблицы documents: если он не изменился,
+    пересобирать матрицу не нужно.
+    """
+    row = session.execute(
+        select(func.count(Document.id), func.max(Document.id), func.max(Document.created_at))
+        .where(Document.pending.is_(False))
+    ).one()
+    return tuple(row)
+
+
+def _build_index(session, signature: tuple) -> EmbeddingIndex:
+    ids, titles, matrix, _ = load_document_vectors(session)
+    return EmbeddingIndex(ids=ids, titles=titles, matrix=matrix, signature=signature)
+
+
+def _get_db_index() -> EmbeddingIndex:
+    global _index
+    with SessionLocal() as session:
+        signature = _documents_signature(session)
+        current = _index
+        if current is not None and current.signature == signature:
+            return current
+
+        with _index_lock:
+            if _index is None or _index.signature != signature:
+                _index = _build_index(session, signature)
+            return _index
+
+
+def _get_file_index() -> Optional[EmbeddingIndex]:
+    """
+    Индекс из файла RAG_INDEX_PATH через np.memmap (общий page cache для всех воркеров).
+    На каждый запрос — только os.stat(); после атомарной подмены файла переоткрываем.
+    """
+    global _file_index
+    stat_key = current_stat_key(RAG_INDEX_PATH)
+    if stat_key is None:
+        return None
+
+    signature = ("file",) + stat_key
+    current = _file_index
+    if current is not None and current.signature == signature:
+        return current
+
+    with _index_lock:
+        if _file_index is None or _file_index.signature != signature:
             try:
-                doc_emb_list = json.loads(doc.embedding)
-                doc_emb = np.array(doc_emb_list, dtype=np.float32)
-                sim = cosine_sim(query_emb, doc_emb)
-                scored.append((doc, sim))
-            except Exception:
-                # Если какой-то документ битый — просто пропускаем, не валим запрос.
-                continue
-
-        scored.sort(key=lambda x: x[1], reverse=True)
-        return [doc for doc, _ in scored[:top_k]]
+                mapped = MappedIndexFile(RAG_INDEX_PATH)
+            except (OSError, ValueError) as e:
+                print("Не удалось открыть файл индекса RAG, используем БД:", repr(e))
+                return None
+            _file_index = EmbeddingIndex(
+                ids=mapped.ids,
+                titles=None,
+                matrix=mapped.matrix,
+                signature=("file",) + mapped.stat_key,
+            )
+        return _file_index
+
+
+def get_index() -> EmbeddingIndex:
+    """
+    Общий на процесс индекс.
+    Если есть файл индекса (RAG_INDEX_PATH) — мапим его, иначе собираем матрицу из БД
+    и пересобираем, только если изменилась таблица documents.
+    """
+    if RAG_INDEX_PATH:
+        index = _get_file_index()
+        if index is not None:
+            return index
+    return _get_db_index()
+
+
+def _search_documents(index: EmbeddingIndex, query_emb, top_k: int) -> List[Document]:
+    hits = index.search(np.asarray(query_emb, dtype=np.float32), top_k)
+    if not hits:
+        return []
+
+    doc_ids = [doc_id for doc_id, _ in hits]
+    with SessionLocal() as session:
+        docs = session.execute(select(Document).where(Document.id.in_(doc_ids))).scalars().all()
+
+    by_id = {doc.id: doc for doc in docs}
+    return [by_id[doc_id] for doc_id in doc_ids if doc_id in by_id]
+
+
+def retrieve_documents(query: str, top_k: int = 3) -> List[Document]:
+    """
+    Ищем top_k документов, наиболее похожих на запрос (по косинусному сходству).
+    Синхронная версия — для скриптов и отладки.
+    """
+    index = get_index()
+    if len(index) == 0:
+        return []
+    return _search_documents(index, get_embedding(query), top_k)
+
+
+def index_version() -> tuple:
+    """
+    Версия текущего индекса (меняется при переиндексации) — для кэшей, зависящих от базы знаний.
+    """
+    return get_index().signature
+
+
+async def aretrieve_documents(query: str, top_k: int = 3, query_emb: Optional[list] = None) -> List[Document]:
+    """
+    То же, что retrieve_documents, но для async-кода: эмбеддинг — через AsyncOpenAI,
+    работа с БД и матрицей — в пуле потоков БД, event loop не блокируется.
+    query_emb — эмбеддинг запроса, если он уже посчитан (кэш ответов).
+    """
+    index = await run_in_db_thread(get_index)
+    if len(index) == 0:
+        return []
+    if query_emb is None:
+        query_emb = await aget_embedding(query)
+    return await run_in_db_thread(_search_documents, index, query_emb, top_k)
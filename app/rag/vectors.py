@@ -0,0 +1,88 @@
+# app/rag/vectors.py
+
+"""
+Бинарный формат хранения эмбеддингов.
+
+Раскладка (little-endian):
+    magic      4 байта  b"AEV1"
+    dtype      1 байт   0 = float32, 1 = float16
+    model_len  1 байт   длина имени модели в байтах
+    reserved   2 байта
+    dim        4 байта  размерность вектора
+    model      model_len байт (utf-8), затем паддинг до кратности 4
+    data       dim * itemsize байт
+
+Старые строки (JSON-список в тексте) тоже читаем — на время миграции.
+"""
+
+import json
+import struct
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+MAGIC = b"AEV1"
+_HEADER = struct.Struct("<4sBBHI")
+
+_DTYPE_CODES = {
+    "float32": 0,
+    "float16": 1,
+}
+_CODE_DTYPES = {code: np.dtype(name).newbyteorder("<") for name, code in _DTYPE_CODES.items()}
+
+
+def _pad4(n: int) -> int:
+    return (n + 3) & ~3
+
+
+def encode_embedding(
+    vector: Union[Sequence[float], np.ndarray],
+    model: str = "",
+    dtype: str = "float32",
+) -> bytes:
+    """
+    Кодируем вектор в компактные байты с заголовком (размерность + модель).
+    """
+    if dtype not in _DTYPE_CODES:
+        raise ValueError(f"Неподдерживаемый dtype для эмбеддинга: {dtype}")
+
+    code = _DTYPE_CODES[dtype]
+    arr = np.asarray(vector, dtype=_CODE_DTYPES[code]).reshape(-1)
+    model_bytes = model.encode("utf-8")[:255]
+
+    header = _HEADER.pack(MAGIC, code, len(model_bytes), 0, arr.shape[0])
+    meta = model_bytes + b"\x00" * (_pad4(len(model_bytes)) - len(model_bytes))
+    return header + meta + arr.tobytes()
+
+
+def is_binary_embedding(raw) -> bool:
+    return isinstance(raw, (bytes, bytearray, memoryview)) and bytes(raw[:4]) == MAGIC
+
+
+def decode_embedding_with_model(raw) -> Tuple[np.ndarray, Optional[str]]:
+    """
+    Декодируем эмбеддинг из БД: бинарный формат или старый JSON.
+    Для бинарного формата возвращается view через np.frombuffer, без копирования.
+    """
+    if raw is None:
+        raise ValueError("Пустой эмбеддинг")
+
+    if is_binary_embedding(raw):
+        magic, code, model_len, _, dim = _HEADER.unpack_from(raw, 0)
+        if code not in _CODE_DTYPES:
+            raise ValueError(f"Неизвестный код dtype эмбеддинга: {code}")
+        model_start = _HEADER.size
+        model = bytes(raw[model_start:model_start + model_len]).decode("utf-8") or None
+        offset = model_start + _pad4(model_len)
+        vec = np.frombuffer(raw, dtype=_CODE_DTYPES[code], count=dim, offset=offset)
+        return vec, model
+
+    # Legacy: JSON-строка (str или bytes, если драйвер вернул BLOB)
+    if isinstance(raw, (bytes, bytearray, memoryview)):
+        raw = bytes(raw).decode("utf-8")
+    return np.asarray(json.loads(raw), dtype=np.float32), None
+
+
+def decode_embedding(raw) -> np.ndarray:
+    vec, _ = decode_embedding_with_model(raw)
+    return vec
@@ -0,0 +1,84 @@
+# app/ratelimit.py
+
+"""
+Ограничение частоты запросов к провайдеру: token bucket на каждую модель.
+
+Ведро на модель наполняется со скоростью rpm/60 запросов в секунду, вмещает burst
+запросов. Запрос забирает один жетон; если жетонов нет — ждёт, а не получает 429
+от провайдера (после которого ретраи всех клиентов только усиливают давку).
+Ожидающие обслуживаются по очереди (FIFO).
+
+rpm <= 0 — ограничение выключено.
+"""
+
+import asyncio
+import threading
+import time
+from typing import Dict, Optional
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate  # жетонов в секунду
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock: Optional[asyncio.Lock] = None
+
+        self.acquired = 0
+        self.waits = 0
+        self.waited = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens < 1.0:
+                delay = (1.0 - self._tokens) / self.rate
+                self.waits += 1
+                self.waited += delay
+                await asyncio.sleep(delay)
+                self._refill(time.monotonic())
+            self._tokens -= 1.0
+            self.acquired += 1
+
+
+class ModelRateLimiter:
+    """
+    Отдельное ведро на каждую модель (LLM_MODEL, SUMMARY_MODEL, модель эмбеддингов...).
+    """
+
+    def __init__(self, rpm: float = 0.0, burst: float = 0.0):
+        self.rpm = rpm
+        self.burst = burst if burst > 0 else max(1.0, rpm / 6)  # по умолчанию — 10 секунд лимита
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rpm > 0
+
+    async def acquire(self, model: str) -> None:
+        if not self.enabled:
+            return
+        bucket = self._buckets.get(model)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(model, TokenBucket(self.rpm / 60.0, self.burst))
+        await bucket.acquire()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                model: {
+                    "acquired": b.acquired,
+                    "waits": b.waits,
+                    "waited_seconds": round(b.waited, 3),
+                }
+                for model, b in self._buckets.items()
+            }
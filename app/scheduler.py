@@ -0,0 +1,296 @@
+# app/scheduler.py
+
+"""
+Планировщик ходов агента — слой перед run_ainova_agent для всех каналов
+(/agent, /agent/stream, вебхук Green API, Telegram).
+
+- У каждого пользователя своя FIFO-очередь: его сообщения обрабатываются строго
+  по одному, ходы не гоняются за историю и не перемешивают записи.
+- Опционально (AGENT_MERGE_WINDOW_MS > 0) сообщения, пришедшие подряд, склеиваются
+  в один ход: «привет» + «сколько стоит сайт?» + «для кафе» — один ответ вместо трёх.
+  Ответ получают все склеенные запросы, но отправить его пользователю должен только
+  последний (TurnResult.primary), остальные помечены merged.
+- Всего одновременно выполняется не больше AGENT_MAX_CONCURRENCY ходов (включая потоковые).
+  Частота запросов к самой модели ограничивается отдельно — token bucket в llm_client.
+- Очередь пользователя ограничена AGENT_MAX_QUEUE_PER_USER — сверх лимита QueueFullError.
+
+Очереди и воркеры живут в памяти процесса; воркер пользователя создаётся
+при первом сообщении и завершается, когда очередь опустела.
+"""
+
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Deque, Dict, List, Optional, Union
+
+from app.agent import run_ainova_agent, run_ainova_agent_stream
+from app.config import (
+    AGENT_MAX_CONCURRENCY,
+    AGENT_MERGE_WINDOW_MS,
+    AGENT_MERGE_MAX_MESSAGES,
+    AGENT_MAX_QUEUE_PER_USER,
+)
+
+
+class QueueFullError(RuntimeError):
+    """
+    У пользователя уже слишком много необработанных сообщений.
+    """
+
+
+@dataclass
+class TurnResult:
+    answer: str
+    primary: bool = True  # False — сообщение склеено с более поздним, ответ отправит тот запрос
+    merged_messages: int = 1
+
+
+@dataclass
+class _Pending:
+    user_external_id: Union[int, str]
+    username: Optional[str]
+    text: str
+    client_id: str
+    channel: str
+    stream: bool = False
+    future: Optional[asyncio.Future] = None  # для обычных ходов — результат TurnResult
+    started: asyncio.Event = field(default_factory=asyncio.Event)  # для потоковых — «твоя очередь»
+    finished: asyncio.Event = field(default_factory=asyncio.Event)
+    abandoned: bool = False
+    stopped: bool = False
+
+
+class _UserQueue:
+    def __init__(self):
+        self.items: Deque[_Pending] = deque()
+        self.worker: Optional[asyncio.Task] = None
+
+
+class AgentScheduler:
+    def __init__(
+        self,
+        max_concurrency: int = 16,
+        merge_window_ms: int = 0,
+        merge_max_messages: int = 5,
+        max_queue_per_user: int = 20,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.merge_window = max(0, merge_window_ms) / 1000.0
+        self.merge_max_messages = max(1, merge_max_messages)
+        self.max_queue_per_user = max(1, max_queue_per_user)
+
+        self._queues: Dict[str, _UserQueue] = {}
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._active = 0
+
+        self.turns = 0
+        self.merged = 0
+        self.rejected = 0
+        self.errors = 0
+        self.max_depth = 0
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        return self._slots
+
+    # --- постановка в очередь ---
+
+    def _enqueue(self, user_key: str, item: _Pending) -> None:
+        queue = self._queues.get(user_key)
+        if queue is None:
+            queue = self._queues[user_key] = _UserQueue()
+        if len(queue.items) >= self.max_queue_per_user:
+            self.rejected += 1
+            raise QueueFullError(f"очередь пользователя {user_key} переполнена")
+        queue.items.append(item)
+        self.max_depth = max(self.max_depth, len(queue.items))
+        if queue.worker is None or queue.worker.done():
+            queue.worker = asyncio.create_task(self._worker(user_key, queue), name=f"agent-user-{user_key}")
+
+    async def submit(
+        self,
+        user_external_id: Union[int, str],
+        username: Optional[str],
+        user_text: str,
+        client_id: str = "default",
+        channel: str = "web",
+    ) -> TurnResult:
+        """
+        Поставить сообщение в очередь пользователя и дождаться ответа.
+        """
+        item = _Pending(
+            user_external_id=user_external_id,
+            username=username,
+            text=user_text,
+            client_id=client_id,
+            channel=channel,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        self._enqueue(str(user_external_id), item)
+        return await item.future
+
+    async def stream(
+        self,
+        user_external_id: Union[int, str],
+        username: Optional[str],
+        user_text: str,
+        client_id: str = "default",
+        channel: str = "web",
+    ) -> AsyncIterator[str]:
+        """
+        Потоковый ход: ждём своей очереди (и свободного слота), дальше — run_ainova_agent_stream.
+        Слот занят, пока поток не закончится. Потоковые сообщения не склеиваются.
+        """
+        item = _Pending(
+            user_external_id=user_external_id,
+            username=username,
+            text=user_text,
+            client_id=client_id,
+            channel=channel,
+            stream=True,
+        )
+        self._enqueue(str(user_external_id), item)
+        try:
+            await item.started.wait()
+            if item.stopped:
+                raise RuntimeError("планировщик остановлен")
+            async for delta in run_ainova_agent_stream(
+                user_external_id=user_external_id,
+                username=username,
+                user_text=user_text,
+                client_id=client_id,
+                channel=channel,
+            ):
+                yield delta
+        finally:
+            item.abandoned = True  # если ещё не дошла очередь — воркер пропустит
+            item.finished.set()
+
+    # --- воркер очереди пользователя ---
+
+    def _take_batch(self, queue: _UserQueue, first: _Pending) -> List[_Pending]:
+        batch = [first]
+        while (
+            queue.items
+            and len(batch) < self.merge_max_messages
+            and not queue.items[0].stream
+            and queue.items[0].client_id == first.client_id
+            and queue.items[0].channel == first.channel
+        ):
+            item = queue.items.popleft()
+            if not item.future.done():
+                batch.append(item)
+        return batch
+
+    async def _worker(self, user_key: str, queue: _UserQueue) -> None:
+        try:
+            while queue.items:
+                item = queue.items.popleft()
+
+                if item.stream:
+                    if item.abandoned:
+                        continue
+                    async with self._semaphore():
+                        self._active += 1
+                        try:
+                            item.started.set()
+                            await item.finished.wait()
+                        finally:
+                            self._active -= 1
+                    continue
+
+                if item.future.done():  # запрос отменили, пока он ждал в очереди
+                    continue
+                batch = [item]
+                if self.merge_window > 0:
+                    # даём дописать: сообщения, пришедшие за окно, уйдут одним ходом
+                    try:
+                        await asyncio.sleep(self.merge_window)
+                    except asyncio.CancelledError:
+                        item.future.cancel()  # stop(): элемент уже не в очереди
+                        raise
+                    batch = self._take_batch(queue, item)
+                await self._run_batch(batch)
+        finally:
+            if self._queues.get(user_key) is queue and not queue.items:
+                del self._queues[user_key]
+
+    async def _run_batch(self, batch: List[_Pending]) -> None:
+        last = batch[-1]
+        text = "\n".join(item.text for item in batch)
+        try:
+            async with self._semaphore():
+                self._active += 1
+                try:
+                    answer = await run_ainova_agent(
+                        user_external_id=last.user_external_id,
+                        username=last.username,
+                        user_text=text,
+                        client_id=last.client_id,
+                        channel=last.channel,
+                    )
+                finally:
+                    self._active -= 1
+        except asyncio.CancelledError:
+            # stop() отменил воркер посреди хода — ждущие не должны висеть вечно
+            for item in batch:
+                if not item.future.done():
+                    item.future.cancel()
+            raise
+        except Exception as e:
+            self.errors += 1
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+
+        self.turns += 1
+        self.merged += len(batch) - 1
+        for i, item in enumerate(batch):
+            if not item.future.done():
+                item.future.set_result(TurnResult(
+                    answer=answer,
+                    primary=(i == len(batch) - 1),
+                    merged_messages=len(batch),
+                ))
+
+    async def stop(self) -> None:
+        """
+        Останавливаем воркеры; ждущие ответа (в очереди и в текущем ходе) получают отмену.
+        """
+        workers = [q.worker for q in self._queues.values() if q.worker is not None]
+        for queue in self._queues.values():
+            for item in queue.items:
+                if item.future is not None and not item.future.done():
+                    item.future.cancel()
+                item.abandoned = True
+                item.stopped = True
+                item.started.set()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._queues.clear()
+
+    def stats(self) -> Dict[str, int]:
+        depths = [len(q.items) for q in self._queues.values()]
+        return {
+            "users": len(self._queues),
+            "queued": sum(depths),
+            "max_queue_now": max(depths, default=0),
+            "max_queue_seen": self.max_depth,
+            "active": self._active,
+            "max_concurrency": self.max_concurrency,
+            "turns": self.turns,
+            "merged": self.merged,
+            "rejected": self.rejected,
+            "errors": self.errors,
+        }
+
+
+agent_scheduler = AgentScheduler(
+    max_concurrency=AGENT_MAX_CONCURRENCY,
+    merge_window_ms=AGENT_MERGE_WINDOW_MS,
+    merge_max_messages=AGENT_MERGE_MAX_MESSAGES,
+    max_queue_per_user=AGENT_MAX_QUEUE_PER_USER,
+)
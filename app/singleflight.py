@@ -0,0 +1,81 @@
+# app/singleflight.py
+
+"""
+Single-flight: одинаковые запросы, которые идут одновременно, делят один вызов.
+
+После рассылки десятки пользователей присылают один и тот же текст почти одновременно —
+без дедупликации каждый платит за свой запрос эмбеддинга / LLM. Здесь первый запрос
+с ключом запускает вызов (отдельной задачей), остальные с тем же ключом, пришедшие,
+пока вызов в полёте, ждут его результат (или ту же ошибку).
+
+Вызов — отдельная задача: если первый запросивший отменится (клиент ушёл),
+остальные всё равно получат ответ.
+
+Это не кэш: как только вызов завершился, ключ забывается. Кэширование результатов —
+забота вызывающего кода (query_cache, answer_cache).
+"""
+
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    def __init__(self, name: str, enabled: bool = True, max_tracked_keys: int = 256):
+        self.name = name
+        self.enabled = enabled
+        self.max_tracked_keys = max_tracked_keys
+
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._lock = threading.Lock()  # только для счётчиков (/metrics читается из другого потока)
+
+        self.calls = 0
+        self.upstream = 0
+        # сколько вызовов сэкономлено по ключам (label -> saved), последние max_tracked_keys ключей
+        self._saved_by_key: "OrderedDict[str, int]" = OrderedDict()
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]], label: Optional[str] = None) -> T:
+        """
+        Выполнить fn() или присоединиться к уже идущему вызову с тем же key.
+        label — читаемое имя ключа для метрик.
+        """
+        if not self.enabled:
+            return await fn()
+
+        loop = asyncio.get_running_loop()
+        task = self._inflight.get(key)
+        with self._lock:
+            self.calls += 1
+            if task is not None and task.get_loop() is loop and not task.done():
+                name = label or str(key)
+                self._saved_by_key[name] = self._saved_by_key.pop(name, 0) + 1
+                while len(self._saved_by_key) > self.max_tracked_keys:
+                    self._saved_by_key.popitem(last=False)
+            else:
+                self.upstream += 1
+                task = loop.create_task(fn())
+                self._inflight[key] = task
+                task.add_done_callback(lambda t, k=key: self._forget(k, t))
+
+        # shield: отмена одного ожидающего не отменяет общий вызов
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # помечаем ошибку как полученную, чтобы не было "never retrieved"
+
+    def stats(self, top: int = 10) -> Dict[str, object]:
+        with self._lock:
+            top_keys = sorted(self._saved_by_key.items(), key=lambda kv: kv[1], reverse=True)[:top]
+            return {
+                "calls": self.calls,
+                "upstream": self.upstream,
+                "saved": self.calls - self.upstream,
+                "in_flight": len(self._inflight),
+                "top_keys": [{"key": k, "saved": n} for k, n in top_keys],
+            }
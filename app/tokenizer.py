@@ -0,0 +1,128 @@
+# app/tokenizer.py
+
+"""
+Подсчёт токенов для бюджета промпта.
+
+Считаем точно через tiktoken (TOKENIZER_ENCODING, по умолчанию o200k_base — токенизатор
+gpt-4o / gpt-4o-mini). Словарь читается из каталога TIKTOKEN_CACHE_DIR (data/tiktoken);
+заполнить его при сборке: python -m app.tokenizer (единственное место, где словарь
+скачивается из сети). Загружает словарь прогрев (app/warmup.py), а не первый ход пользователя.
+Если словаря в каталоге нет или tiktoken не загрузился — громкое предупреждение и эвристика
+(в сеть процесс не ходит): латиница/цифры/
+пунктуация ~4 символа на токен, кириллица и прочее не-ASCII ~2.5 символа на токен.
+
+Бюджет — ограничение сверху, а не счёт за API: расхождение в несколько процентов
+между эвристикой и реальным токенизатором не страшно.
+"""
+
+import hashlib
+import math
+import os
+import threading
+from functools import lru_cache
+from typing import Dict
+
+from app.config import TIKTOKEN_CACHE_DIR, TOKENIZER, TOKENIZER_ENCODING
+
+# служебные токены на одно сообщение в chat completions (роль + разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+# откуда tiktoken берёт словари *_base; в кэше файл называется sha1 от этого адреса
+_VOCAB_URL = "https://openaipublic.blob.core.windows.net/encodings/{name}.tiktoken"
+
+
+def vocab_path() -> str:
+    url = _VOCAB_URL.format(name=TOKENIZER_ENCODING)
+    return os.path.join(TIKTOKEN_CACHE_DIR, hashlib.sha1(url.encode("utf-8")).hexdigest())
+
+
+def _load_tiktoken(download: bool = False):
+    # tiktoken ищет словарь в TIKTOKEN_CACHE_DIR и только при промахе идёт в сеть —
+    # поэтому без download промах до tiktoken не доходит
+    os.environ["TIKTOKEN_CACHE_DIR"] = TIKTOKEN_CACHE_DIR
+    if not download and not os.path.isfile(vocab_path()):
+        raise FileNotFoundError(
+            f"нет словаря {TOKENIZER_ENCODING} в {TIKTOKEN_CACHE_DIR} (заполнить: python -m app.tokenizer)"
+        )
+    import tiktoken
+
+    return tiktoken.get_encoding(TOKENIZER_ENCODING)
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if _encoding_loaded:
+        return _encoding
+    with _encoding_lock:
+        if not _encoding_loaded:
+            if TOKENIZER in ("auto", "tiktoken"):
+                try:
+                    _encoding = _load_tiktoken()
+                except Exception as e:
+                    print(
+                        "ВНИМАНИЕ: словарь tiktoken не загружен — токены считаются эвристикой, "
+                        f"бюджеты промпта приблизительные (TIKTOKEN_CACHE_DIR={TIKTOKEN_CACHE_DIR}):",
+                        repr(e),
+                    )
+                    _encoding = None
+            _encoding_loaded = True
+    return _encoding
+
+
+def tokenizer_name() -> str:
+    encoding = _get_encoding()
+    return f"tiktoken:{encoding.name}" if encoding is not None else "heuristic"
+
+
+def _heuristic_tokens(text: str) -> int:
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    other_chars = len(text) - ascii_chars
+    return math.ceil(ascii_chars / 4 + other_chars / 2.5)
+
+
+@lru_cache(maxsize=4096)
+def _count_cached(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return _heuristic_tokens(text)
+
+
+def count_tokens(text: str) -> int:
+    """
+    Число токенов в тексте. Повторяющиеся тексты (промпты, фрагменты базы знаний)
+    берутся из LRU-кэша.
+    """
+    if not text:
+        return 0
+    return _count_cached(text)
+
+
+def message_tokens(msg) -> int:
+    """
+    Токены сообщения истории (Message / CachedMessage) вместе со служебными.
+    Берём сохранённый token_count, если он есть, — не пересчитываем каждый ход.
+    """
+    count = getattr(msg, "token_count", None)
+    if count is None:
+        count = count_tokens(msg.content)
+    return count + MESSAGE_OVERHEAD_TOKENS
+
+
+def count_message_tokens(message: Dict[str, str]) -> int:
+    return count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+if __name__ == "__main__":
+    # при сборке: скачиваем словарь в TIKTOKEN_CACHE_DIR, чтобы процесс не ходил за ним в сеть
+    try:
+        encoding = _load_tiktoken(download=True)
+    except Exception as e:
+        print(f"Не удалось получить словарь {TOKENIZER_ENCODING}:", repr(e))
+        raise SystemExit(1)
+    print(f"Словарь {encoding.name}: {vocab_path()}")
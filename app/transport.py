@@ -0,0 +1,316 @@
+# app/transport.py
+
+"""
+Общий HTTP-транспорт для запросов к провайдеру (LLM и эмбеддинги через ProxyAPI).
+
+- Один пул соединений httpx на процесс: запросы LLM и эмбеддингов переиспользуют
+  тёплые keep-alive соединения (без нового TLS-рукопожатия на каждый запрос).
+  HTTP/2 — если установлен пакет h2 (HTTP_HTTP2=auto) или включён явно.
+- Явные таймауты: подключение / чтение / запись / ожидание соединения из пула.
+- Повторы (retry_call): при временных ошибках — пауза по Retry-After от провайдера,
+  иначе экспонента с джиттером.
+- Circuit breaker: после CIRCUIT_BREAKER_FAILURES сбоев подряд (таймауты, обрывы, 5xx)
+  запросы к этому апстриму CIRCUIT_BREAKER_RESET секунд сразу получают CircuitOpenError,
+  а не висят до таймаута. Потом — один пробный запрос: удался — работаем дальше.
+"""
+
+import asyncio
+import email.utils
+import functools
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Type, TypeVar
+
+import httpx
+
+from app.config import (
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE,
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP_WRITE_TIMEOUT,
+    HTTP_POOL_TIMEOUT,
+    HTTP_HTTP2,
+    CIRCUIT_BREAKER_FAILURES,
+    CIRCUIT_BREAKER_RESET,
+)
+
+T = TypeVar("T")
+
+
+# openai импортируем лениво (тяжёлый пакет, при старте воркера не нужен)
+@functools.lru_cache(maxsize=None)
+def retryable_errors() -> Tuple[Type[Exception], ...]:
+    """
+    Ошибки, при которых имеет смысл повторить запрос.
+    """
+    from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+
+    return (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+
+@functools.lru_cache(maxsize=None)
+def breaker_errors() -> Tuple[Type[Exception], ...]:
+    """
+    Ошибки, которые говорят, что апстрим недоступен (429 — не сбой, провайдер жив).
+    """
+    from openai import APIConnectionError, APITimeoutError, InternalServerError
+
+    return (APITimeoutError, APIConnectionError, InternalServerError)
+
+
+MAX_RETRY_DELAY = 30.0
+
+_async_client: Optional[httpx.AsyncClient] = None
+_sync_client: Optional[httpx.Client] = None
+_client_lock = threading.Lock()
+
+
+def http2_enabled() -> bool:
+    if HTTP_HTTP2 in ("0", "false", "no", "off"):
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        if HTTP_HTTP2 in ("1", "true", "yes", "on"):
+            print("HTTP/2 включён, но пакет h2 не установлен — работаем по HTTP/1.1")
+        return False
+    return True
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def http_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        connect=HTTP_CONNECT_TIMEOUT,
+        read=HTTP_READ_TIMEOUT,
+        write=HTTP_WRITE_TIMEOUT,
+        pool=HTTP_POOL_TIMEOUT,
+    )
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Общий асинхронный пул соединений (создаётся лениво).
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        with _client_lock:
+            if _async_client is None or _async_client.is_closed:
+                _async_client = httpx.AsyncClient(
+                    http2=http2_enabled(),
+                    limits=_limits(),
+                    timeout=http_timeout(),
+                )
+    return _async_client
+
+
+def get_sync_http_client() -> httpx.Client:
+    """
+    Синхронный пул — для редких синхронных вызовов (CLI, отладка).
+    """
+    global _sync_client
+    if _sync_client is None or _sync_client.is_closed:
+        with _client_lock:
+            if _sync_client is None or _sync_client.is_closed:
+                _sync_client = httpx.Client(
+                    http2=http2_enabled(),
+                    limits=_limits(),
+                    timeout=http_timeout(),
+                )
+    return _sync_client
+
+
+async def aclose_http_clients() -> None:
+    """
+    Закрываем пулы при остановке приложения.
+    """
+    global _async_client, _sync_client
+    client, _async_client = _async_client, None
+    if client is not None:
+        await client.aclose()
+    sync_client, _sync_client = _sync_client, None
+    if sync_client is not None:
+        sync_client.close()
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return max(0.0, float(value) / 1000.0)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    # Retry-After может быть датой (RFC 7231)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """
+    Пауза перед повтором: Retry-After от провайдера, иначе экспонента с джиттером.
+    """
+    delay = _retry_after(error)
+    if delay is not None:
+        return min(MAX_RETRY_DELAY, delay)
+    return min(MAX_RETRY_DELAY, 2 ** attempt) * (0.5 + random.random())
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Апстрим считается недоступным — запрос не отправляем.
+    """
+
+
+class CircuitBreaker:
+    """
+    closed -> (failure_threshold сбоев подряд) -> open -> (reset_timeout) -> half-open:
+    пропускаем один пробный запрос; успех — closed, сбой — снова open.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold  # <= 0 — выключен
+        self.reset_timeout = reset_timeout
+
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+        self.opens = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def before_call(self) -> None:
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"{self.name}: апстрим недоступен, повторим позже")
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            self._failures += 1
+            if self._probe_in_flight or (self._opened_at is None and self._failures >= self.failure_threshold):
+                self.opens += 1
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def record_neutral(self) -> None:
+        """
+        Ответ получен, но это не сбой апстрима и не успех (429, 4xx) — только снимаем пробу.
+        """
+        with self._lock:
+            self._probe_in_flight = False
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self._failures,
+                "opens": self.opens,
+                "rejected": self.rejected,
+            }
+
+
+llm_breaker = CircuitBreaker("llm", CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_RESET)
+embedding_breaker = CircuitBreaker("embeddings", CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_RESET)
+
+
+async def guarded_call(breaker: CircuitBreaker, fn: Callable[[], Awaitable[T]]) -> T:
+    """
+    Один вызов через circuit breaker (без повторов).
+    """
+    breaker.before_call()
+    try:
+        result = await fn()
+    except breaker_errors():
+        breaker.record_failure()
+        raise
+    except BaseException:
+        breaker.record_neutral()
+        raise
+    breaker.record_success()
+    return result
+
+
+async def retry_call(
+    fn: Callable[[], Awaitable[T]],
+    breaker: CircuitBreaker,
+    max_retries: int,
+    label: str,
+    before_attempt: Optional[Callable[[], Awaitable[None]]] = None,
+) -> T:
+    """
+    fn() через circuit breaker с повторами при временных ошибках.
+    before_attempt — что сделать перед каждой попыткой (например, взять жетон rate limiter).
+    """
+    attempt = 0
+    while True:
+        if before_attempt is not None:
+            await before_attempt()
+        try:
+            return await guarded_call(breaker, fn)
+        except retryable_errors() as e:
+            if attempt >= max_retries:
+                raise
+            delay = retry_delay(e, attempt)
+            attempt += 1
+            print(f"{label}: {type(e).__name__}, повтор {attempt} через {delay:.1f} с")
+            await asyncio.sleep(delay)
+
+
+def transport_stats() -> Dict[str, object]:
+    client = _async_client
+    return {
+        "http2": http2_enabled(),
+        "pool_open": client is not None and not client.is_closed,
+        "breakers": {
+            "llm": llm_breaker.stats(),
+            "embeddings": embedding_breaker.stats(),
+        },
+    }
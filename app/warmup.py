@@ -0,0 +1,122 @@
+# app/warmup.py
+
+"""
+Прогрев процесса после старта.
+
+Импорт модулей приложения лёгкий: клиенты провайдера, индекс RAG, токенайзер и промпты
+создаются/загружаются лениво, при первом использовании. Чтобы первый пользователь
+не платил за это своим ответом, после старта (сервер — в фоне, в lifespan; бот — перед
+polling) всё это прогревается заранее. /ready отвечает 200 только после прогрева.
+
+Ошибка шага не останавливает прогрев и не делает процесс «неготовым» навсегда:
+ленивая инициализация повторится при первом запросе. Ошибки видны в /ready.
+"""
+
+import asyncio
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.config import EMBED_CACHE_DB_PATH, ENABLE_RAG, PROXYAPI_API_KEY, WARMUP_ENABLED
+from app.memory.db import run_in_db_thread
+
+
+def _warm_openai() -> None:
+    # тяжёлый пакет openai (~1 с импорта) и клиенты с общим пулом соединений
+    from app.llm_client import get_client
+    from app.rag.embeddings import get_async_client
+    from app.transport import breaker_errors, retryable_errors
+
+    retryable_errors()
+    breaker_errors()
+    if PROXYAPI_API_KEY:
+        get_client()
+        get_async_client()
+
+
+def _warm_rag() -> None:
+    from app.rag.retriever import get_index
+
+    index = get_index()
+    if len(index):
+        index.searcher  # движок поиска (exact / ivf) строится лениво
+
+
+def _warm_embedding_cache() -> None:
+    from app.rag.embeddings import query_cache
+
+    # протухшие строки SQLite-уровня (TTL проверяется только при чтении)
+    query_cache.prune_disk()
+
+
+def _warm_tokenizer() -> None:
+    from app.tokenizer import tokenizer_name
+
+    tokenizer_name()
+
+
+def _warm_prompts() -> None:
+    from app.prompts import prompt_fingerprint
+
+    prompt_fingerprint()
+
+
+def _steps() -> List[Tuple[str, Callable[[], None]]]:
+    steps = [
+        ("openai", _warm_openai),
+        ("tokenizer", _warm_tokenizer),
+        ("prompts", _warm_prompts),
+    ]
+    if ENABLE_RAG:
+        steps.append(("rag_index", _warm_rag))
+    if EMBED_CACHE_DB_PATH:
+        steps.append(("embedding_cache", _warm_embedding_cache))
+    return steps
+
+
+class Warmup:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.ready = not enabled
+        self.seconds: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def run(self) -> None:
+        """
+        Прогреть всё по очереди (шаги — синхронные, в пуле потоков БД).
+        """
+        if self.ready:
+            return
+        for name, step in _steps():
+            started = time.perf_counter()
+            try:
+                await run_in_db_thread(step)
+            except Exception as e:
+                self.errors[name] = repr(e)
+                print(f"Прогрев: шаг {name} не удался:", repr(e))
+            self.seconds[name] = round(time.perf_counter() - started, 3)
+        self.ready = True
+        print(f"Прогрев завершён за {sum(self.seconds.values()):.2f} с")
+
+    def start(self) -> None:
+        """
+        Прогрев в фоне: процесс уже принимает запросы, /ready — после прогрева.
+        """
+        if self._task is None and not self.ready:
+            self._task = asyncio.create_task(self.run(), name="warmup")
+
+    async def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def status(self) -> Dict[str, object]:
+        return {
+            "ready": self.ready,
+            "seconds": dict(self.seconds),
+            "errors": dict(self.errors),
+        }
+
+
+warmup = Warmup(enabled=WARMUP_ENABLED)
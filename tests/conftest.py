@@ -0,0 +1,30 @@
+# tests/conftest.py
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# Конфиг читается при импорте app.config: до него — отдельная БД и без фоновых задач
+_TMP = Path(tempfile.mkdtemp(prefix="ainova-tests-"))
+os.environ["DB_URL"] = f"sqlite:///{(_TMP / 'test.db').as_posix()}"
+os.environ.setdefault("PROXYAPI_API_KEY", "test")
+os.environ["RETENTION_INTERVAL"] = "0"
+os.environ["MEMORY_WRITE_BEHIND"] = "false"
+os.environ["WARMUP_ENABLED"] = "false"
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _schema():
+    from app.memory.db import migrate_db
+
+    migrate_db()
+
+
+@pytest.fixture
+def tmp_dir() -> Path:
+    return _TMP
@@ -0,0 +1,41 @@
+# tests/test_embedding_cache.py
+
+import sqlite3
+
+import app.rag.embedding_cache as embedding_cache
+from app.rag.embedding_cache import EmbeddingCache
+
+
+def _disk_rows(path) -> int:
+    with sqlite3.connect(path) as db:
+        return db.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+
+
+def _put_at(monkeypatch, cache: EmbeddingCache, text: str, at: float) -> None:
+    monkeypatch.setattr(embedding_cache.time, "time", lambda: at)
+    cache.put(text, "m", [1.0, 0.0])
+
+
+def test_prune_disk_removes_expired_rows(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.db")
+    cache = EmbeddingCache(max_size=10, ttl=100, db_path=path, prune_every=0)
+    _put_at(monkeypatch, cache, "old", 1000.0)
+    _put_at(monkeypatch, cache, "fresh", 1950.0)
+
+    monkeypatch.setattr(embedding_cache.time, "time", lambda: 2000.0)
+    assert cache.prune_disk() == 1
+    assert _disk_rows(path) == 1
+    assert cache.get("fresh", "m") == [1.0, 0.0]
+
+
+def test_disk_tier_is_pruned_every_n_puts(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.db")
+    cache = EmbeddingCache(max_size=10, ttl=100, db_path=path, prune_every=3)
+    _put_at(monkeypatch, cache, "a", 1000.0)
+    _put_at(monkeypatch, cache, "b", 1000.0)
+    assert _disk_rows(path) == 2
+
+    # третья запись — уже после TTL первых двух: они удаляются без явного prune_disk
+    _put_at(monkeypatch, cache, "c", 2000.0)
+    assert _disk_rows(path) == 1
+    assert cache.stats()["pruned"] == 2
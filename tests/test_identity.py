@@ -0,0 +1,28 @@
+# tests/test_identity.py
+
+from app.memory.identity import identity_cache, legacy_user_key, stable_user_id, user_key
+from app.memory.repository import load_turn, save_turn
+
+
+def test_user_key_keeps_legacy_key_only_for_owner_channel():
+    assert user_key("telegram", 777) == 777
+    assert user_key("whatsapp", "wa:7999@c.us") == legacy_user_key("wa:7999@c.us")
+    assert user_key("web", 777) == stable_user_id("web:777")
+    assert user_key("web", 777) != user_key("telegram", 777)
+
+
+def test_same_id_in_web_and_telegram_has_separate_history():
+    identity_cache.clear()
+    telegram = load_turn(777, "tg_user", channel="telegram")
+    save_turn(telegram.user_id, "привет из telegram", "ответ telegram")
+
+    web = load_turn(777, "web_user", channel="web")
+    assert web.user_id != telegram.user_id
+    save_turn(web.user_id, "secret from web", "ответ web")
+
+    identity_cache.clear()
+    telegram_history = [m.content for m in load_turn(777, channel="telegram").history]
+    web_history = [m.content for m in load_turn(777, channel="web").history]
+    assert "secret from web" not in telegram_history
+    assert "привет из telegram" in telegram_history
+    assert web_history == ["secret from web", "ответ web"]
@@ -0,0 +1,64 @@
+# tests/test_index_docs.py
+
+import pytest
+from sqlalchemy import func, select
+
+import app.rag.index_docs as index_docs
+from app.memory.db import SessionLocal
+from app.memory.models import Document, DocumentSource
+
+
+@pytest.fixture
+def docs_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_docs, "DOCUMENTS_PATH", str(tmp_path))
+    monkeypatch.setattr(index_docs, "RAG_INDEX_PATH", "")
+    monkeypatch.setattr(index_docs, "RAG_CHUNK_SIZE", 200)
+    monkeypatch.setattr(index_docs, "RAG_CHUNK_OVERLAP", 0)
+    # окно в 2 фрагмента: файл гарантированно не помещается в одно окно
+    monkeypatch.setattr(index_docs, "EMBED_BATCH_MAX_ITEMS", 2)
+    monkeypatch.setattr(index_docs, "EMBED_CONCURRENCY", 1)
+    with SessionLocal() as session:
+        session.query(Document).delete()
+        session.query(DocumentSource).delete()
+        session.commit()
+    return tmp_path
+
+
+def _chunks(pending: bool):
+    with SessionLocal() as session:
+        return session.scalar(
+            select(func.count()).select_from(Document).where(Document.pending.is_(pending))
+        )
+
+
+def _fake_embeddings(monkeypatch, fail_after=None):
+    calls = {"n": 0}
+
+    async def embed(texts):
+        calls["n"] += 1
+        if fail_after is not None and calls["n"] > fail_after:
+            raise RuntimeError("embeddings down")
+        return [[1.0, 0.0, 0.0] for _ in texts]
+
+    monkeypatch.setattr(index_docs, "embed_texts", embed)
+
+
+def test_failed_reindex_keeps_previous_chunks(docs_dir, monkeypatch):
+    (docs_dir / "a.txt").write_text("Alpha. " * 200, encoding="utf-8")
+    _fake_embeddings(monkeypatch)
+    index_docs.index_documents()
+    before = _chunks(pending=False)
+    assert before > 2
+
+    (docs_dir / "a.txt").write_text("Gamma. " * 300, encoding="utf-8")
+    _fake_embeddings(monkeypatch, fail_after=2)
+    with pytest.raises(RuntimeError):
+        index_docs.index_documents()
+    # старая версия на месте, недописанная новая в поиск не попадает
+    assert _chunks(pending=False) == before
+    assert _chunks(pending=True) > 0
+
+    _fake_embeddings(monkeypatch)
+    index_docs.index_documents()
+    assert _chunks(pending=True) == 0
+    assert _chunks(pending=False) > before